@@ -0,0 +1,227 @@
+"""Static analysis of pending PostgreSQL migrations: each statement is classified
+by the lock it takes and whether it rewrites or scans a whole table while holding
+the lock. Sizes of existing tables are read from ``pg_class`` to estimate the cost.
+"""
+
+import re
+
+import sqlparse
+
+from mschematool import core
+
+
+DEFAULT_MB_PER_SECOND = 100.0
+
+ACCESS_EXCLUSIVE = 'ACCESS EXCLUSIVE'
+EXCLUSIVE = 'EXCLUSIVE'
+SHARE_ROW_EXCLUSIVE = 'SHARE ROW EXCLUSIVE'
+SHARE = 'SHARE'
+SHARE_UPDATE_EXCLUSIVE = 'SHARE UPDATE EXCLUSIVE'
+ROW_EXCLUSIVE = 'ROW EXCLUSIVE'
+
+# Locks blocking writes (and, for ACCESS EXCLUSIVE, reads) of a table
+BLOCKING_LOCKS = set([ACCESS_EXCLUSIVE, EXCLUSIVE, SHARE_ROW_EXCLUSIVE, SHARE])
+
+# Effects of a statement on a whole table
+REWRITE = 'rewrite'
+SCAN = 'scan'
+
+DANGER = 'DANGER'
+WARNING = 'warning'
+ERROR = 'error'
+
+_NAME = r'((?:"[^"]+"|[\w$]+)(?:\.(?:"[^"]+"|[\w$]+))?)'
+# An optional (and not captured) name of a created index
+_INDEX_NAME = r'(?:IF NOT EXISTS )?(?:(?:"[^"]+"|[\w$]+) )?'
+_ALTER_TABLE = r'^ALTER TABLE (?:IF EXISTS )?(?:ONLY )?' + _NAME + r' '
+# Functions making a column default volatile, so adding a column rewrites the table
+_VOLATILE_DEFAULT = r'\bDEFAULT\b.*\b(?:RANDOM|CLOCK_TIMESTAMP|TIMEOFDAY|NEXTVAL|GEN_RANDOM_UUID|UUID_GENERATE_V\d\w*)\s*\('
+
+
+def _rule(pattern, lock, effect, hint):
+    return re.compile(pattern, re.I | re.S), lock, effect, hint
+
+# (pattern, lock, effect, hint) - the first matching rule is used. The first non-empty
+# group of a pattern is the table name, an optional "mode" group overrides the lock.
+RULES = [
+    _rule(r'^CREATE (?:UNIQUE )?INDEX CONCURRENTLY ' + _INDEX_NAME + r'ON (?:ONLY )?' + _NAME,
+          SHARE_UPDATE_EXCLUSIVE, SCAN, None),
+    _rule(r'^CREATE (?:UNIQUE )?INDEX ' + _INDEX_NAME + r'ON (?:ONLY )?' + _NAME, SHARE, SCAN,
+          'use CREATE INDEX CONCURRENTLY in a migration marked as non-transactional'),
+    _rule(r'^DROP INDEX (?!CONCURRENTLY)()', ACCESS_EXCLUSIVE, None,
+          'use DROP INDEX CONCURRENTLY in a migration marked as non-transactional'),
+    _rule(r'^REINDEX (?!.*\bCONCURRENTLY\b)(?:TABLE )?' + _NAME, ACCESS_EXCLUSIVE, REWRITE,
+          'use REINDEX ... CONCURRENTLY'),
+    _rule(r'^VACUUM .*\bFULL\b.*?' + _NAME + r'\s*$', ACCESS_EXCLUSIVE, REWRITE, None),
+    _rule(r'^CLUSTER (?:VERBOSE )?' + _NAME, ACCESS_EXCLUSIVE, REWRITE, None),
+    _rule(_ALTER_TABLE + r'.*\bALTER (?:COLUMN )?\S+ (?:SET DATA )?TYPE\b', ACCESS_EXCLUSIVE, REWRITE,
+          'changing a type rewrites the table and its indexes unless the types are binary '
+          'coercible (e.g. increasing a varchar length); add a new column and backfill it instead'),
+    _rule(_ALTER_TABLE + r'.*\bADD (?:COLUMN )?.*\bGENERATED ALWAYS AS\b.*\bSTORED\b', ACCESS_EXCLUSIVE,
+          REWRITE, 'add a nullable column and backfill it in batches'),
+    _rule(_ALTER_TABLE + r'.*\bADD (?:COLUMN )?(?:IF NOT EXISTS )?\S+ (?:SMALL|BIG)?SERIAL[248]?\b',
+          ACCESS_EXCLUSIVE, REWRITE, 'a serial column is filled from its sequence for every row; add '
+          'a nullable column, backfill it in batches, then set the default'),
+    _rule(_ALTER_TABLE + r'.*\bADD (?:COLUMN )?.*\bGENERATED (?:ALWAYS|BY DEFAULT) AS IDENTITY\b',
+          ACCESS_EXCLUSIVE, REWRITE, 'an identity column is filled from its sequence for every row; '
+          'add a nullable column, backfill it in batches, then ADD GENERATED ... AS IDENTITY'),
+    _rule(_ALTER_TABLE + r'.*\bADD (?:COLUMN )?' + _VOLATILE_DEFAULT, ACCESS_EXCLUSIVE, REWRITE,
+          'a volatile default is computed for every row; add the column without a default, '
+          'set the default and backfill existing rows in batches'),
+    _rule(_ALTER_TABLE + r'.*\bALTER (?:COLUMN )?\S+ SET NOT NULL\b', ACCESS_EXCLUSIVE, SCAN,
+          'add CHECK (column IS NOT NULL) NOT VALID, VALIDATE it in a separate migration, '
+          'then SET NOT NULL (PostgreSQL 12+ skips the scan)'),
+    _rule(_ALTER_TABLE + r'(?!.*\bNOT VALID\b).*\bADD (?:CONSTRAINT \S+ )?FOREIGN KEY\b', SHARE_ROW_EXCLUSIVE,
+          SCAN, 'add the constraint as NOT VALID and VALIDATE CONSTRAINT in a separate migration'),
+    _rule(_ALTER_TABLE + r'(?!.*\bNOT VALID\b).*\bADD (?:CONSTRAINT \S+ )?CHECK\b', ACCESS_EXCLUSIVE,
+          SCAN, 'add the constraint as NOT VALID and VALIDATE CONSTRAINT in a separate migration'),
+    _rule(_ALTER_TABLE + r'.*\bADD (?:CONSTRAINT \S+ )?(?:PRIMARY KEY|UNIQUE)\b(?!.*\bUSING INDEX\b)',
+          ACCESS_EXCLUSIVE, SCAN,
+          'create a unique index CONCURRENTLY and add the constraint USING INDEX'),
+    _rule(_ALTER_TABLE + r'.*\bVALIDATE CONSTRAINT\b', SHARE_UPDATE_EXCLUSIVE, SCAN, None),
+    _rule(_ALTER_TABLE + r'.*\bSET (?:TABLESPACE|LOGGED|UNLOGGED)\b', ACCESS_EXCLUSIVE, REWRITE, None),
+    _rule(_ALTER_TABLE, ACCESS_EXCLUSIVE, None, None),
+    _rule(r'^(?:UPDATE (?:ONLY )?' + _NAME + r'|DELETE FROM (?:ONLY )?' + _NAME + r')(?!.*\bWHERE\b)',
+          ROW_EXCLUSIVE, SCAN, 'update or delete rows in batches'),
+    _rule(r'^TRUNCATE (?:TABLE )?(?:ONLY )?' + _NAME, ACCESS_EXCLUSIVE, None, None),
+    _rule(r'^DROP TABLE (?:IF EXISTS )?' + _NAME, ACCESS_EXCLUSIVE, None, None),
+    _rule(r'^LOCK (?:TABLE )?(?:ONLY )?' + _NAME + r'(?:.*\bIN (?P<mode>.+) MODE\b)?', ACCESS_EXCLUSIVE, None, None),
+]
+
+
+class Finding(object):
+    """A statement of ``migration`` taking ``lock`` on ``table`` (``None`` if not known).
+    ``effect`` is :data:`REWRITE`, :data:`SCAN` or ``None`` for statements which don't
+    process the whole table. ``size`` and ``rows`` are read from ``pg_class``
+    (``None`` for tables which don't exist yet).
+    """
+
+    def __init__(self, migration, statement, table, lock, effect, hint):
+        self.migration = migration
+        self.statement = statement
+        self.table = table
+        self.lock = lock
+        self.effect = effect
+        self.hint = hint
+        self.size = None
+        self.rows = None
+        self.new = False
+        self.level = None
+
+    def classify(self):
+        """Set :attr:`level`: :data:`DANGER` when a blocking lock is held while processing
+        an existing table, :data:`WARNING` for other ``ACCESS EXCLUSIVE`` locks and for
+        statements processing an existing table, ``None`` otherwise and for tables created
+        by analyzed migrations.
+        """
+        if self.level == ERROR:
+            return
+        if self.new:
+            self.level = None
+            return
+        if self.effect is not None and self.size is not None:
+            self.level = DANGER if self.lock in BLOCKING_LOCKS else WARNING
+        elif self.lock == ACCESS_EXCLUSIVE:
+            self.level = WARNING
+        else:
+            self.level = None
+
+    def describe(self, mb_per_second):
+        parts = ['%s lock' % self.lock]
+        if self.table is not None:
+            parts[0] += ' on %s' % self.table
+        if self.new:
+            parts.append('new table')
+        elif self.effect is not None:
+            if self.size is None:
+                parts.append('%s of a table which does not exist' % self.effect)
+            else:
+                parts.append('%s of %.1f MB, ~%d rows, ~%s' % (
+                    self.effect, self.size / 1024.0 / 1024.0, self.rows,
+                    core.format_duration(self.size / 1024.0 / 1024.0 / mb_per_second)))
+        return ', '.join(parts)
+
+
+def _normalize(statement):
+    statement = sqlparse.format(statement, strip_comments=True)
+    return ' '.join(statement.split()).rstrip(';').strip()
+
+
+def analyze_statement(migration, statement):
+    """Return a :class:`Finding` for ``statement`` or ``None`` if it doesn't take
+    a lock worth reporting.
+    """
+    normalized = _normalize(statement)
+    for pattern, lock, effect, hint in RULES:
+        match = pattern.match(normalized)
+        if match is None:
+            continue
+        table = next((group for group in match.groups() if group), None)
+        if match.groupdict().get('mode'):
+            lock = match.group('mode').upper()
+        return Finding(migration, normalized, table, lock, effect, hint)
+    return None
+
+
+def analyze(executor, migrations):
+    """Return a list of :class:`Finding` objects for statements of ``migrations`` (Python
+    migrations are skipped) and the number of analyzed statements. Tables created by
+    analyzed migrations are new, so their sizes aren't looked up.
+    """
+    repository = executor.repository
+    findings = []
+    created = set()
+    count = 0
+    for migration in migrations:
+        path = repository.migration_path(migration)
+        if repository.migration_type(path) != 'native':
+            continue
+        non_transactional = repository.is_non_transactional(path)
+        with repository.open_migration(path) as f:
+            for statement in executor._iter_statements(f):
+                count += 1
+                match = re.match(r'^\s*CREATE (?:UNLOGGED )?TABLE (?:IF NOT EXISTS )?' + _NAME,
+                                 _normalize(statement), re.I)
+                if match is not None:
+                    created.add(_unquoted(match.group(1)))
+                finding = analyze_statement(migration, statement)
+                if finding is None:
+                    continue
+                if 'CONCURRENTLY' in finding.statement.upper() and not non_transactional:
+                    finding.level = ERROR
+                    finding.hint = 'CONCURRENTLY fails inside a transaction; mark the migration ' \
+                        'with a "-- mschematool: no-transaction" comment'
+                findings.append(finding)
+    for finding in findings:
+        finding.new = finding.table is not None and _unquoted(finding.table) in created
+    sizes = executor.table_sizes(sorted(set(f.table for f in findings
+                                            if f.table is not None and not f.new)))
+    for finding in findings:
+        if finding.table in sizes:
+            finding.size, finding.rows = sizes[finding.table]
+        finding.classify()
+    return findings, count
+
+
+def report(findings, count, mb_per_second=DEFAULT_MB_PER_SECOND):
+    """Return lines describing ``findings`` grouped by migrations, and a summary line.
+    """
+    lines = []
+    migration = None
+    for finding in findings:
+        if finding.migration != migration:
+            migration = finding.migration
+            lines.append(migration)
+        statement = core._statement_for_log(finding.statement)
+        lines.append('  %-7s %s' % (finding.level or 'ok', statement))
+        lines.append('          %s' % finding.describe(mb_per_second))
+        if finding.hint and finding.level is not None:
+            lines.append('          hint: %s' % finding.hint)
+    levels = [f.level for f in findings]
+    lines.append('%d statements analyzed: %d dangerous, %d warnings, %d errors' % (
+        count, levels.count(DANGER), levels.count(WARNING), levels.count(ERROR)))
+    return lines
+
+
+def _unquoted(name):
+    return name.replace('"', '') if '"' in name else name.lower()
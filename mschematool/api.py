@@ -0,0 +1,242 @@
+"""An API for using mschematool from Python code in-process, e.g. for running migrations
+when an application starts or in test suites. Unlike the command line interface, it
+doesn't print results but returns :class:`Migration` and :class:`SyncResult` objects.
+
+Example::
+
+    from mschematool import api
+
+    schema = api.open('mschematool_config.py', 'default')
+    result = schema.sync()
+    if not result.ok:
+        raise result.errors[0]
+
+An existing connection (of the type passed to Python migrations) can be used
+instead of connecting according to a config::
+
+    schema = api.from_db_config({'engine': 'sqlite3', 'migrations_dir': 'migrations'},
+                                connection=sqlite3.connect('app.db'))
+"""
+
+import functools
+import time
+import types
+
+from mschematool import core
+
+
+class Migration(object):
+    """A migration of a single target. ``target`` is ``None`` unless a dbnick tracks
+    migrations of multiple tenants (it's a tenant name then). ``duration`` is a number
+    of seconds the execution took (or ``None`` if not known) and ``error`` is an exception
+    which made the execution fail.
+    """
+
+    def __init__(self, name, target=None, duration=None, error=None):
+        self.name = name
+        self.target = target
+        self.duration = duration
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __eq__(self, other):
+        return isinstance(other, Migration) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Migration(%r, target=%r, duration=%r, error=%r)' % (self.name, self.target,
+                                                                     self.duration, self.error)
+
+
+class MigrationFailed(Exception):
+    """Set as :attr:`Migration.error` when a migration failed without raising
+    an exception (a CQL statement error).
+    """
+
+
+class SyncResult(object):
+    """Result of :method:`MSchema.sync`. ``migrations`` is a list of executed migrations
+    followed by a failed one for each target which failed.
+    """
+
+    def __init__(self, migrations):
+        self.migrations = migrations
+
+    @property
+    def executed(self):
+        return [m for m in self.migrations if m.ok]
+
+    @property
+    def errors(self):
+        return [m.error for m in self.migrations if not m.ok]
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    @property
+    def duration(self):
+        return sum(m.duration for m in self.migrations)
+
+    def __repr__(self):
+        return 'SyncResult(%r)' % self.migrations
+
+
+def _execute(label, target, name):
+    """Execute migration ``name`` using ``target`` tool and return a :class:`Migration`.
+    """
+    started = time.time()
+    error = None
+    try:
+        if target.migrations.execute_migration(name) is False:
+            error = MigrationFailed('Migration %s failed, see the log' % name)
+    except Exception as e:
+        core.log.exception('While executing %s', name)
+        error = e
+    return Migration(name, label, time.time() - started, error)
+
+
+def _own_connections(method):
+    """Make connections opened by ``method`` belong to the :class:`MSchema` object.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with core.connections.using(self._connections):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class MSchema(object):
+    """Migrations of a single dbnick. Use :func:`open` or :func:`from_db_config`
+    to create it. Connections opened by the object aren't shared with other objects
+    and are closed by :method:`close` (or when used as a context manager).
+
+    :param tool: a :class:`core.MSchemaTool` object.
+    :param connections: a dictionary of connections registered while creating
+        ``tool`` (see :method:`core.ConnectionRegistry.using`)
+    """
+
+    def __init__(self, tool, connections=None):
+        self.tool = tool
+        self._connections = connections if connections is not None else {}
+
+    @property
+    def dbnick(self):
+        return self.tool.dbnick
+
+    def close(self):
+        """Close connections opened by this object. A connection passed by a caller
+        isn't closed.
+        """
+        core.close_connections(self._connections)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @_own_connections
+    def initialize(self):
+        """Create tables tracking migrations, like the `init_db` command.
+        """
+        for _, target in self.tool.targets():
+            target.migrations.initialize()
+
+    @_own_connections
+    def pending(self):
+        """Return a list of :class:`Migration` objects for migrations waiting for execution.
+        """
+        return [Migration(name, label)
+                for label, target in self.tool.targets()
+                for name in target.not_executed_migration_files()]
+
+    @_own_connections
+    def applied(self):
+        """Return a list of :class:`Migration` objects for executed migrations, with
+        recorded durations.
+        """
+        result = []
+        for label, target in self.tool.targets():
+            durations = target.migrations.fetch_durations()
+            for name in target.migrations.fetch_executed_migrations():
+                result.append(Migration(name, label, durations.get(name)))
+        return result
+
+    @_own_connections
+    def is_synced(self):
+        return all(target.is_synced() for _, target in self.tool.targets())
+
+    @_own_connections
+    def sync(self, after_sync=True, before_migration=None):
+        """Execute all pending migrations and return a :class:`SyncResult`. Exceptions
+        raised by migrations aren't propagated - executing migrations of a target
+        stops at the first failed migration and the exception is stored in the result.
+        Tenants of a fan-out dbnick are synced sequentially on the dbnick's connection.
+
+        :param after_sync: run the `after_sync` command if it's configured
+        :param before_migration: a function called without arguments before each
+            migration. An exception raised by it stops the sync and is propagated.
+        """
+        if after_sync:
+            self.tool.prepare_after_sync()
+        migrations = []
+        for label, target in self.tool.targets():
+            for name in target.not_executed_migration_files():
+                if before_migration is not None:
+                    before_migration()
+                migration = _execute(label, target, name)
+                migrations.append(migration)
+                if not migration.ok:
+                    break
+        if after_sync and any(m.ok for m in migrations):
+            self.tool.execute_after_sync()
+        return SyncResult(migrations)
+
+    @_own_connections
+    def sync_single(self, name):
+        """Execute a single migration without executing older ones, like
+        the `force_sync_single` command. Return a :class:`SyncResult`.
+        """
+        migrations = []
+        for label, target in self.tool.targets():
+            if name in target.migrations.fetch_executed_migrations():
+                continue
+            migrations.append(_execute(label, target, name))
+        return SyncResult(migrations)
+
+
+def open(config_path, dbnick, connection=None):
+    """Return :class:`MSchema` for ``dbnick`` defined in a config module ``config_path``.
+
+    Logging isn't configured (`LOG_FILE` and other logging options of the config are
+    ignored) - configure the ``mschematool`` logger in the application instead.
+
+    :param connection: an existing connection to use instead of connecting
+        according to the config
+    """
+    config = core.Config(False, config_path, setup_logging=False)
+    return _open(config, dbnick, connection)
+
+
+def from_db_config(db_config, connection=None, dbnick='default'):
+    """Return :class:`MSchema` for a database specified by a ``db_config`` dictionary,
+    with the same content as an entry of `DATABASES` in a config module.
+    A config module isn't needed then and logging isn't configured.
+    """
+    module = types.ModuleType(core.DEFAULT_CONFIG_MODULE_NAME)
+    module.DATABASES = {dbnick: db_config}
+    config = core.Config(False, None, module=module)
+    return _open(config, dbnick, connection)
+
+
+def _open(config, dbnick, connection):
+    connections = {}
+    with core.connections.using(connections):
+        tool = core.MSchemaTool(config, dbnick, connection)
+    return MSchema(tool, connections)
@@ -1,8 +1,16 @@
 #!/usr/bin/env python
 
+import json
+import time
+import contextlib
+import cProfile
+
 import click
 
 from mschematool import core
+from mschematool import analysis
+from mschematool import status as fleet_status
+from mschematool import workqueue
 
 
 log = core.log
@@ -15,64 +23,270 @@ $ mschematool default init_db
 A database nickname defined in the configuration module must be passed as the first argument.
 After it a command must be specified.
 
+Multiple dbnicks can be passed as a comma-separated list or a shell-style pattern:
+
+$ mschematool 'tenant_*' sync
+
 """
 
 @click.group(help=HELP)
 @click.option('--config', type=click.Path(exists=True, dir_okay=False), envvar='MSCHEMATOOL_CONFIG', help='Path to configuration module, e.g. "mydir/mschematool_config.py". Environment variable MSCHEMATOOL_CONFIG can be specified instead.', required=True)
 @click.option('--verbose/--no-verbose', default=False, help='Print executed SQL/CQL? Default: no.')
+@click.option('--profile', is_flag=True, help='Print time spent in phases of the command (loading config, listing migrations, fetching executed migrations, parsing, executing, after_sync) to stderr on exit.')
+@click.option('--profile-out', type=click.Path(dir_okay=False), default=None, help='Write a cProfile dump of the command, readable with pstats, to a file. Implies --profile.')
 @click.argument('dbnick', type=str)
 @click.pass_context
-def main(ctx, config, verbose, dbnick):
+def main(ctx, config, verbose, profile, profile_out, dbnick):
+    if profile or profile_out:
+        _start_profiling(ctx, profile_out)
     config_obj = core.Config(verbose, config)
-    run_ctx = core.MSchemaTool(config_obj, dbnick)
-    ctx.obj = run_ctx
+    ctx.obj = core.DbnickSelection(config_obj, dbnick)
+
+def _start_profiling(ctx, profile_out):
+    """Enable :data:`core.profiler` and print its summary when the command exits.
+    If ``profile_out`` is given, a cProfile dump is written there.
+    """
+    core.profiler.enable()
+    if profile_out:
+        prof = cProfile.Profile()
+        prof.enable()
+
+        def dump():
+            prof.disable()
+            prof.dump_stats(profile_out)
+        ctx.call_on_close(dump)
+
+    def summary():
+        for line in core.profiler.summary():
+            click.echo(line, err=True)
+        if profile_out:
+            click.echo('cProfile dump written to %s' % profile_out, err=True)
+    ctx.call_on_close(summary)
+
+def _tools(ctx):
+    """Yield :class:`core.MSchemaTool` objects for selected dbnicks. When multiple dbnicks
+    are selected, a line with a dbnick is printed before processing each one.
+    """
+    for tool in ctx.obj.tools():
+        if ctx.obj.multiple:
+            click.echo('[%s]' % tool.dbnick)
+        yield tool
+
+def _targets(ctx):
+    """Yield ``(label, tool)`` pairs for all targets of selected dbnicks. The label
+    is ``None`` unless a dbnick tracks migrations of multiple tenants.
+    """
+    for tool in _tools(ctx):
+        for label, target in tool.targets():
+            yield label, target
+
+def _echo(label, msg):
+    click.echo(msg if label is None else '%s: %s' % (label, msg))
 
 @main.command(help='Creates a DB table used for tracking migrations.')
 @click.pass_context
 def init_db(ctx):
-    ctx.obj.migrations.initialize()
+    for _, target in _targets(ctx):
+        target.migrations.initialize()
 
 @main.command(help='Show synced migrations.')
 @click.pass_context
 def synced(ctx):
-    migrations = ctx.obj.migrations.fetch_executed_migrations()
-    for migration in migrations:
-        click.echo(migration)
+    for label, target in _targets(ctx):
+        migrations = target.migrations.fetch_executed_migrations()
+        for migration in migrations:
+            _echo(label, migration)
 
 
 @main.command(help='Show migrations available for syncing.')
+@click.option('--check', is_flag=True, help='Do not list migrations, exit with status 0 if the database is synced and 1 otherwise.')
+@click.pass_context
+def to_sync(ctx, check):
+    if check:
+        all_synced = all(target.is_synced()
+                         for tool in ctx.obj.tools() for _, target in tool.targets())
+        ctx.exit(0 if all_synced else 1)
+    for label, target in _targets(ctx):
+        migrations = target.not_executed_migration_files()
+        for migration in migrations:
+            _echo(label, migration)
+
+@main.command(help='Show numbers of applied and pending migrations and the latest migration of selected databases, queried concurrently. Exits with status 1 if any database could not be queried.')
+@click.option('--format', 'output_format', type=click.Choice(['table', 'json']), default='table', help='Output format. Default: table.')
+@click.option('--timeout', type=float, default=fleet_status.DEFAULT_TIMEOUT, help='Seconds after which connecting to a database (and, on PostgreSQL, a query) fails. Default: %d.' % fleet_status.DEFAULT_TIMEOUT)
+@click.option('--jobs', type=int, default=fleet_status.DEFAULT_JOBS, help='Number of databases queried at the same time. Default: %d.' % fleet_status.DEFAULT_JOBS)
+@click.pass_context
+def status(ctx, output_format, timeout, jobs):
+    statuses = fleet_status.collect(ctx.obj.config, list(ctx.obj.dbnicks()), timeout, jobs)
+    if output_format == 'json':
+        click.echo(json.dumps([s.as_dict() for s in statuses], indent=2, sort_keys=True))
+    else:
+        for line in fleet_status.format_table(statuses):
+            click.echo(line)
+    if any(s.error is not None for s in statuses):
+        ctx.exit(1)
+
+def _history_sources(ctx, tool, source):
+    if source is None:
+        return tool.history_sources()
+    return list(core.DbnickSelection(ctx.obj.config, source).dbnicks())
+
+@main.command(help='Estimate duration of syncing, based on durations recorded for the same migrations in other databases, or on sizes of migrations.')
+@click.option('--source', type=str, default=None, help='Dbnicks (a comma-separated list or a pattern) to read recorded durations from. Default: the dbnick itself and dbnicks using the same engine and migrations directory.')
 @click.pass_context
-def to_sync(ctx):
-    migrations = ctx.obj.not_executed_migration_files()
-    for migration in migrations:
-        click.echo(migration)
+def estimate(ctx, source):
+    for tool in _tools(ctx):
+        durations = tool.recorded_durations(_history_sources(ctx, tool, source))
+        for label, target in tool.targets():
+            estimated = target.estimate(target.not_executed_migration_files(), durations)
+            if not estimated:
+                _echo(label, 'No migrations to sync')
+                continue
+            for migration, seconds, dbnick in estimated:
+                basis = 'heuristic' if dbnick is None else 'recorded on %s' % dbnick
+                _echo(label, '%s ~%s (%s)' % (migration, core.format_duration(seconds), basis))
+            _echo(label, 'Total: ~%s for %d migrations' % (
+                core.format_duration(sum(seconds for _, seconds, _ in estimated)), len(estimated)))
+
+def _sync_fanout(tool):
+    tool.prepare_after_sync()
+    failed = []
+    for label, executed, error in tool.migrations.sync_fanout():
+        if error is not None:
+            failed.append(label)
+            migration, exc = error
+            _echo(label, 'Error while executing %s after %d migrations: %s' % (migration, len(executed), exc))
+        elif executed:
+            _echo(label, 'Executed %d migrations, latest %s' % (len(executed), executed[-1]))
+        else:
+            _echo(label, 'No migrations to sync')
+    tool.execute_after_sync()
+    if failed:
+        raise click.ClickException('Sync failed for %d tenants: %s' % (len(failed), ', '.join(failed)))
+
+def _execute_migrations(tool, to_execute, estimated=None, prefetch=0):
+    """Execute ``to_execute`` migrations, parsing up to ``prefetch`` upcoming ones in
+    the background. After each migration, progress is printed if ``estimated`` durations
+    (as returned by :method:`core.MSchemaTool.estimate`) are given.
+    """
+    if estimated is not None:
+        remaining = sum(seconds for _, seconds, _ in estimated)
+        click.echo('Estimated time: ~%s' % core.format_duration(remaining))
+    with contextlib.closing(core.MigrationPrefetcher(tool.migrations, to_execute, prefetch)) as prefetcher:
+        for i, migration_file in enumerate(to_execute):
+            msg = 'Executing %s' % migration_file
+            log.info(msg)
+            click.echo(msg)
+            started = time.time()
+            tool.migrations.execute_migration(migration_file, prefetcher.get(migration_file))
+            if tool.migrations.worker_peak_rss is not None:
+                click.echo('Peak RSS of the worker process: %.1f MB above its start' %
+                           (tool.migrations.worker_peak_rss / 1024.0 / 1024.0))
+            if estimated is not None:
+                remaining -= estimated[i][1]
+                click.echo('Done %d/%d in %s (estimated %s), remaining ~%s' % (
+                    i + 1, len(to_execute), core.format_duration(time.time() - started),
+                    core.format_duration(estimated[i][1]), core.format_duration(max(remaining, 0))))
+
+def _report_throttling(tool):
+    if tool.migrations.throttled:
+        click.echo('Throttled for %s waiting for replication lag' %
+                   core.format_duration(tool.migrations.throttled))
 
 @main.command(help='Sync all available migrations.')
+@click.option('--progress', is_flag=True, help='After each migration, print progress against the duration estimated like in the "estimate" command.')
+@click.option('--prefetch', type=int, default=core.DEFAULT_PREFETCH, help='Number of upcoming SQL/CQL migrations read and parsed in the background while a migration is executed. 0 disables prefetching. Default: %d.' % core.DEFAULT_PREFETCH)
+@click.option('--single-transaction', is_flag=True, help='Execute all migrations in a single transaction with one commit (PostgreSQL only). Migrations marked as non-transactional are rejected.')
+@click.option('--shadow-swap', is_flag=True, help='Offline mode: execute migrations on a copy of the database and replace the database with it. The database must not be open in other processes (SQLite3 on Linux only).')
+@click.pass_context
+def sync(ctx, progress, prefetch, single_transaction, shadow_swap):
+    if single_transaction and shadow_swap:
+        raise click.ClickException('--single-transaction and --shadow-swap can\'t be used together')
+    for tool in _tools(ctx):
+        if tool.migrations.fanout:
+            if single_transaction or shadow_swap:
+                raise click.ClickException('--single-transaction and --shadow-swap are not supported '
+                                           'for fan-out dbnicks')
+            _sync_fanout(tool)
+            _report_throttling(tool)
+            continue
+        to_execute = tool.not_executed_migration_files()
+        if not to_execute:
+            click.echo('No migrations to sync')
+            continue
+        estimated = None
+        if progress:
+            estimated = tool.estimate(to_execute, tool.recorded_durations(tool.history_sources()))
+        tool.prepare_after_sync()
+        if single_transaction:
+            with tool.migrations.single_transaction(to_execute):
+                _execute_migrations(tool, to_execute, estimated, prefetch)
+            click.echo('Committed %d migrations' % len(to_execute))
+        elif shadow_swap:
+            with tool.migrations.shadow_swap():
+                _execute_migrations(tool, to_execute, estimated, prefetch)
+            click.echo('Replaced the database with a migrated copy')
+        else:
+            _execute_migrations(tool, to_execute, estimated, prefetch)
+        _report_throttling(tool)
+        tool.execute_after_sync()
+
+@main.command(help='Execute migrations available for syncing on a temporary clone of the database and report durations of statements and times for which locks were held. The clone is dropped afterwards (PostgreSQL, SQLite3).')
+@click.option('--top', type=int, default=5, help='Number of the slowest statements reported for each migration. Default: 5.')
+@click.pass_context
+def rehearse(ctx, top):
+    failed = False
+    for tool in _tools(ctx):
+        to_execute = tool.not_executed_migration_files()
+        if not to_execute:
+            click.echo('No migrations to sync')
+            continue
+        rehearsal = tool.rehearse(to_execute)
+        for line in rehearsal.report(top):
+            click.echo(line)
+        failed = failed or any(m.error is not None for m in rehearsal.migrations)
+    if failed:
+        raise click.ClickException('Rehearsal failed')
+
+@main.command(help='Statically analyze SQL migrations available for syncing: report locks taken by statements and statements rewriting or scanning whole tables, with costs estimated from sizes of existing tables. Exits with status 1 if any statement is dangerous (PostgreSQL only).')
+@click.option('--fail-on-warning', is_flag=True, help='Exit with status 1 also if any statement has a warning.')
 @click.pass_context
-def sync(ctx):
-    to_execute = ctx.obj.not_executed_migration_files()
-    if not to_execute:
-        click.echo('No migrations to sync')
-        return
-    for migration_file in to_execute:
-        msg = 'Executing %s' % migration_file
-        log.info(msg)
-        click.echo(msg)
-        ctx.obj.migrations.execute_migration(migration_file)
-    ctx.obj.execute_after_sync()
+def analyze(ctx, fail_on_warning):
+    failing = set([analysis.DANGER, analysis.ERROR])
+    if fail_on_warning:
+        failing.add(analysis.WARNING)
+    failed = False
+    for label, target in _targets(ctx):
+        to_execute = target.not_executed_migration_files()
+        if not to_execute:
+            _echo(label, 'No migrations to sync')
+            continue
+        findings, count = analysis.analyze(target.migrations, to_execute)
+        mb_per_second = target.db_config.get('analyze_mb_per_second', analysis.DEFAULT_MB_PER_SECOND)
+        for line in analysis.report(findings, count, mb_per_second):
+            _echo(label, line)
+        failed = failed or any(f.level in failing for f in findings)
+    if failed:
+        ctx.exit(1)
 
 @main.command(help='Sync a single migration, without syncing older ones.')
 @click.argument('migration_file', type=str)
 @click.pass_context
 def force_sync_single(ctx, migration_file):
-    if migration_file in ctx.obj.migrations.fetch_executed_migrations():
-        click.echo('This migration is already executed')
-        return
-    msg = 'Force executing %s' % migration_file
-    log.info(msg)
-    click.echo(msg)
-    ctx.obj.migrations.execute_migration(migration_file)
-    ctx.obj.execute_after_sync()
+    for tool in _tools(ctx):
+        tool.prepare_after_sync()
+        executed = False
+        for label, target in tool.targets():
+            if migration_file in target.migrations.fetch_executed_migrations():
+                _echo(label, 'This migration is already executed')
+                continue
+            msg = 'Force executing %s' % migration_file
+            log.info(msg)
+            _echo(label, msg)
+            target.migrations.execute_migration(migration_file)
+            executed = True
+        if executed:
+            tool.execute_after_sync()
 
 @main.command(help='Print a filename for a new migration.')
 @click.argument('name', type=str)
@@ -80,16 +294,56 @@ def force_sync_single(ctx, migration_file):
 @click.pass_context
 def print_new(ctx, name, migration_type):
     """Prints filename of a new migration"""
-    click.echo(ctx.obj.repository.generate_migration_name(name, migration_type))
+    for tool in _tools(ctx):
+        click.echo(tool.repository.generate_migration_name(name, migration_type))
 
 @main.command(help='Show latest synced migration.')
 @click.pass_context
 def latest_synced(ctx):
-    migrations = ctx.obj.migrations.fetch_executed_migrations()
-    if not migrations:
-        click.echo('No synced migrations')
-    else:
-        click.echo(migrations[-1])
+    for label, target in _targets(ctx):
+        migrations = target.migrations.fetch_executed_migrations()
+        if not migrations:
+            _echo(label, 'No synced migrations')
+        else:
+            _echo(label, migrations[-1])
+
+def _coordinator(ctx):
+    if ctx.obj.multiple:
+        raise click.ClickException('A single coordinator dbnick must be specified')
+    return ctx.obj.spec
+
+@main.command(help='Add dbnicks (a comma-separated list or a pattern) to a queue of databases to sync by "queue_work" workers. The queue is stored in the database of the dbnick passed before the command (a coordinator).')
+@click.argument('dbnicks', type=str)
+@click.pass_context
+def queue_add(ctx, dbnicks):
+    queue = workqueue.open_queue(ctx.obj.config, _coordinator(ctx))
+    queue.initialize()
+    selected = list(core.DbnickSelection(ctx.obj.config, dbnicks).dbnicks())
+    queue.add(selected)
+    click.echo('Added %d dbnicks' % len(selected))
+
+@main.command(help='Claim and sync databases from a queue of the coordinator dbnick until the queue is empty. Multiple workers can run on different hosts.')
+@click.option('--worker-id', type=str, default=None, help='Worker identifier stored in the queue. Default: hostname:pid.')
+@click.option('--lease', type=float, default=workqueue.DEFAULT_LEASE_SECONDS, help='Lease time in seconds, renewed while syncing. Databases claimed by crashed workers are claimed again after it expires.')
+@click.option('--max-attempts', type=int, default=workqueue.DEFAULT_MAX_ATTEMPTS, help='Mark a database as failed after its lease expired this number of times.')
+@click.pass_context
+def queue_work(ctx, worker_id, lease, max_attempts):
+    failed = 0
+    for dbnick, ok, result in workqueue.work(ctx.obj.config, _coordinator(ctx), worker_id, lease,
+                                             max_attempts):
+        _echo(dbnick, result)
+        if not ok:
+            failed += 1
+    if failed:
+        raise click.ClickException('Sync failed for %d dbnicks' % failed)
+
+@main.command(help='Show the state of a queue of the coordinator dbnick.')
+@click.pass_context
+def queue_status(ctx):
+    queue = workqueue.open_queue(ctx.obj.config, _coordinator(ctx))
+    for dbnick, status, worker, attempts, result in queue.entries():
+        _echo(dbnick, ' '.join(str(part) for part in [status, worker, attempts, result]
+                               if part not in (None, '')))
 
 if __name__ == '__main__':
     main()
@@ -1,16 +1,40 @@
 import logging
+import logging.handlers
+import atexit
 import glob
+import fnmatch
+import threading
 import os
 import os.path
 import sys
 import re
 import subprocess
+import signal
+import time
 import datetime
 import imp
+import types
 import warnings
 import traceback
 import importlib
 import inspect
+import hashlib
+import copy
+import contextlib
+import io
+import itertools
+import gzip
+import bz2
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import resource
+except ImportError:
+    resource = None
 import sqlparse
 
 import click
@@ -29,7 +53,26 @@ warnings.filterwarnings('ignore')
 ### Utility functions
 
 def _simplify_whitespace(s):
-    return b' '.join(s.split())
+    return (b' ' if isinstance(s, bytes) else ' ').join(s.split())
+
+# Set from LOG_STATEMENT_MAX_LENGTH config value
+_log_statement_max_length = None
+
+def _statement_for_log(s):
+    """Return a statement (str or bytes) prepared for logging: with simplified whitespace,
+    truncated to LOG_STATEMENT_MAX_LENGTH characters. A long statement is truncated before
+    processing it.
+    """
+    limit = _log_statement_max_length
+    length = len(s)
+    if limit is not None and length > limit:
+        s = s[:limit]
+    if isinstance(s, bytes):
+        s = s.decode('utf-8', 'replace')
+    s = _simplify_whitespace(s)
+    if limit is not None and length > limit:
+        s = '%s... [%d characters]' % (s, length)
+    return s
 
 def _assert_values_exist(d, *keys):
     for k in keys:
@@ -41,18 +84,181 @@ def _import_class(cls_path):
     return getattr(mod, clsname)
 
 
+### Digests of migration sets
+
+EMPTY_DIGEST = (0, '%016x' % 0)
+
+def _migration_hash(migration):
+    return int(hashlib.md5(migration.encode('utf-8')).hexdigest()[:16], 16)
+
+def _digest_add(digest, migration):
+    """Return a digest ``(count, hash)`` extended with a single migration. The hash is
+    a sum of hashes of migration names, so it doesn't depend on the order of execution.
+    """
+    count, hash_hex = digest
+    value = (int(hash_hex, 16) + _migration_hash(migration)) % 2 ** 64
+    return count + 1, '%016x' % value
+
+def migrations_digest(migrations):
+    """Return a digest ``(count, hash)`` of a collection of migrations.
+    """
+    digest = EMPTY_DIGEST
+    for migration in migrations:
+        digest = _digest_add(digest, migration)
+    return digest
+
+
+### Profiling
+
+class Profiler(object):
+    """Accumulates wall-clock time spent in named phases of a command. Time spent
+    in a nested phase is not counted for the enclosing phase. Until :method:`enable`
+    is called, phases are not timed.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = None
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.time()
+
+    def _add(self, name, calls, seconds):
+        with self._lock:
+            totals = self._totals.setdefault(name, [0, 0.0])
+            totals[0] += calls
+            totals[1] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, name, calls=1):
+        if not self.enabled:
+            yield
+            return
+        # each element is the time spent in nested phases
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self._add(name, calls, elapsed - nested)
+
+    def timed_iter(self, name, iterable):
+        """Return ``iterable`` with the time spent on getting its items counted
+        for phase ``name``.
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(name, iter(iterable))
+
+    def _timed_iter(self, name, it):
+        calls = 1
+        while True:
+            with self.phase(name, calls):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            calls = 0
+            yield item
+
+    def summary(self):
+        """Return lines of a table with times of phases, in order of decreasing time. Times
+        of phases executed by multiple threads are summed up.
+        """
+        total = time.time() - self.started
+        with self._lock:
+            rows = sorted(self._totals.items(), key=lambda item: -item[1][1])
+        other = max(total - sum(seconds for _, (_, seconds) in rows), 0.0)
+        lines = ['%-26s %7s %10s %6s' % ('phase', 'calls', 'seconds', '%')]
+        for name, (calls, seconds) in rows + [('other', ('', other))]:
+            lines.append('%-26s %7s %10.3f %6.1f' % (name, calls, seconds,
+                                                      100.0 * seconds / total if total else 0.0))
+        lines.append('%-26s %7s %10.3f' % ('total', '', total))
+        return lines
+
+
+profiler = Profiler()
+
+
 ### Loading and processing configuration
 
+def _background_handler(handler):
+    """Return a handler passing records through a queue to ``handler``, which is
+    called from a background thread. Logging doesn't block on I/O then.
+    """
+    records = queue.Queue()
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    # write out queued records
+    atexit.register(listener.stop)
+    return logging.handlers.QueueHandler(records)
+
+class Databases(object):
+    """Access to database configs specified by `DATABASES` in a config module, which
+    can be a dict, a mapping-like object or a function accepting a dbnick and returning
+    a config dict or ``None``. Each config is requested once and only when needed.
+
+    :param dbnicks: an iterable or a function returning an iterable of all dbnicks,
+        specified by `DATABASE_NICKS` in a config module. If not given, iterating
+        `DATABASES` is used (which isn't possible for a function).
+    """
+
+    def __init__(self, databases, dbnicks=None):
+        self._databases = databases
+        self._dbnicks = dbnicks
+        self._cache = {}
+
+    @property
+    def is_dict(self):
+        return isinstance(self._databases, dict)
+
+    def get(self, dbnick):
+        """Return a config of ``dbnick`` or ``None`` if it isn't defined.
+        """
+        if dbnick not in self._cache:
+            if callable(self._databases) and not hasattr(self._databases, '__getitem__'):
+                db_config = self._databases(dbnick)
+            else:
+                try:
+                    db_config = self._databases[dbnick]
+                except KeyError:
+                    db_config = None
+            self._cache[dbnick] = db_config
+        return self._cache[dbnick]
+
+    def dbnicks(self):
+        """Return an iterator over all dbnicks, which is consumed lazily.
+        """
+        if self._dbnicks is not None:
+            return iter(self._dbnicks() if callable(self._dbnicks) else self._dbnicks)
+        if callable(self._databases) and not hasattr(self._databases, '__getitem__'):
+            raise click.ClickException('DATABASES in config is a function, DATABASE_NICKS must be '
+                                       'specified to list dbnicks')
+        return iter(self._databases)
+
+
 class Config(object):
 
-    def __init__(self, verbose, config_path):
+    def __init__(self, verbose, config_path, module=None, setup_logging=True):
         self.verbose = verbose
         self.config_path = config_path
-        self._module = None
+        # a module (or any object with config attributes) given explicitly
+        # isn't loaded and doesn't configure logging
+        self._module = module
+        self.setup_logging = setup_logging
+        self._databases = None
 
     def _setup_logging(self):
-        global log
-        log.setLevel(logging.DEBUG)
+        global log, _log_statement_max_length
         formatter = logging.Formatter('%(asctime)-15s %(message)s')
         console_handler = logging.StreamHandler(sys.stderr)
         console_handler.setFormatter(formatter)
@@ -63,7 +269,13 @@ class Config(object):
             file_handler = logging.FileHandler(self.module.LOG_FILE)
             file_handler.setLevel(logging.DEBUG)
             file_handler.setFormatter(formatter)
+            if getattr(self.module, 'LOG_ASYNC', False):
+                file_handler = _background_handler(file_handler)
             log.addHandler(file_handler)
+        # Without handlers only warnings are printed, so don't spend time on formatting
+        # executed statements.
+        log.setLevel(logging.DEBUG if log.handlers else logging.WARNING)
+        _log_statement_max_length = getattr(self.module, 'LOG_STATEMENT_MAX_LENGTH', None)
 
     def _load_config(self):
         if self._module is not None:
@@ -76,20 +288,31 @@ class Config(object):
             raise Exception(msg)
 
         try:
-            self._module = imp.load_source('mschematool_config', self.config_path)
+            with profiler.phase('load config'):
+                self._module = imp.load_source('mschematool_config', self.config_path)
         except ImportError:
             msg = 'Cannot import mschematool config module'
             sys.stderr.write(msg + '\n')
             log.critical(msg)
             raise
 
-        self._setup_logging()
+        if self.setup_logging:
+            self._setup_logging()
 
     @property
     def module(self):
         self._load_config()
         return self._module
 
+    @property
+    def databases(self):
+        """:class:`Databases` object for `DATABASES` specified in the config module.
+        """
+        if self._databases is None:
+            self._databases = Databases(self.module.DATABASES,
+                                        getattr(self.module, 'DATABASE_NICKS', None))
+        return self._databases
+
 
 def _sqlfile_to_statements(sql):
     """
@@ -100,8 +323,307 @@ def _sqlfile_to_statements(sql):
     statements = (sqlparse.format(stmt, strip_comments=True).strip() for stmt in sqlparse.split(sql))
     return [stmt for stmt in statements if stmt]
 
+_SPECIAL_SQL_RE = re.compile(r"'|\"|/\*|--|\$(?:[A-Za-z_]\w*)?\$")
+_SPECIAL_CQL_RE = re.compile(r"'|\"|/\*|--|//|\$\$")
+_SINGLE_QUOTE_END_RE = re.compile(r"(?:\\.|[^'\\])*'", re.DOTALL)
+
+def _statement_chunks(lines, cql=False, min_size=64 * 1024):
+    """Group ``lines`` of an SQL or CQL file into chunks that can be parsed separately:
+    each chunk ends outside of a string, a quoted identifier and a comment. Chunks have
+    at least ``min_size`` characters (except the last one). For CQL, chunks
+    additionally end with ``;``.
+    """
+    special_re = _SPECIAL_CQL_RE if cql else _SPECIAL_SQL_RE
+    chunk = []
+    size = 0
+    # a delimiter ending a multi-line string/identifier/comment
+    closing = None
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        last = None
+        i = 0
+        while i < len(line):
+            if closing == "'":
+                m = _SINGLE_QUOTE_END_RE.match(line, i)
+                found = m is not None
+                i = m.end() if found else len(line)
+            elif closing:
+                end = line.find(closing, i)
+                found = end != -1
+                i = end + len(closing) if found else len(line)
+            if closing:
+                if found:
+                    closing = None
+                    last = None
+                continue
+            m = special_re.search(line, i)
+            normal = line[i:m.start()] if m else line[i:]
+            if normal.strip():
+                last = normal.strip()[-1]
+            if not m:
+                break
+            token = m.group(0)
+            if token in ('--', '//'):
+                break
+            closing = '*/' if token == '/*' else token
+            i = m.end()
+        if closing is None and size >= min_size and (not cql or last == ';'):
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+def _iter_sql_statements(f):
+    """Like :func:`_sqlfile_to_statements`, but reads SQL from a file object ``f``
+    and yields statements without reading the whole file into memory.
+    """
+    tokens = itertools.chain.from_iterable(sqlparse.lexer.tokenize(chunk)
+                                           for chunk in _statement_chunks(f))
+    for stmt in sqlparse.engine.StatementSplitter().process(tokens):
+        stmt = sqlparse.format(str(stmt), strip_comments=True).strip()
+        if stmt:
+            yield stmt
+
+### Coalescing INSERT statements
+
+DEFAULT_COALESCE_BATCH_SIZE = 100
+
+_INSERT_RE = re.compile(r'^INSERT\s+INTO\s+(?P<table>[\w."]+)\s*\((?P<columns>[^()]*)\)\s*'
+                        r'VALUES\s*(?P<values>\(.*\))\s*;?$', re.IGNORECASE | re.DOTALL)
+
+def _closing_paren(s):
+    """Return an index of a parenthesis closing the one at index 0, skipping quoted strings.
+    """
+    depth = 0
+    quote = None
+    for i, c in enumerate(s):
+        if quote:
+            # a doubled quote inside a string toggles the state twice
+            if c == quote:
+                quote = None
+        elif c in '\'"':
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    return -1
+
+# A string, a number, NULL or a boolean
+_LITERAL = r"\s*(?:'(?:[^']|'')*'|[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?|NULL|TRUE|FALSE)\s*"
+_LITERAL_ROW_RE = re.compile(r'^\(%s(?:,%s)*\)$' % (_LITERAL, _LITERAL), re.IGNORECASE)
+
+def _single_row_insert(statement):
+    """If ``statement`` is an ``INSERT INTO table (columns) VALUES (...)`` statement
+    with a single row of literals, return ``((table, columns), values)``. Otherwise return
+    ``None``. Rows with subqueries or function calls aren't merged, as their values could
+    depend on rows inserted by preceding statements.
+    """
+    m = _INSERT_RE.match(statement)
+    if not m:
+        return None
+    values = m.group('values')
+    # backslash escapes and dollar quoting aren't handled by _closing_paren
+    if '\\' in values or '$' in values or _closing_paren(values) != len(values) - 1:
+        return None
+    if not _LITERAL_ROW_RE.match(values):
+        return None
+    return (m.group('table'), m.group('columns')), values
+
+def _merge_inserts(key, run):
+    if len(run) == 1:
+        return run[0][0], [run[0][0]]
+    table, columns = key
+    statement = 'INSERT INTO %s (%s) VALUES %s;' % (table, columns,
+                                                    ', '.join(values for _, values in run))
+    return statement, [original for original, _ in run]
+
+def _coalesce_inserts(statements, batch_size):
+    """Merge runs of single-row INSERT statements into the same table and columns into
+    multi-row INSERT statements having at most ``batch_size`` rows. Yields pairs
+    ``(statement, originals)``, where ``originals`` is a list of statements merged into
+    ``statement`` (a single statement if it wasn't merged).
+    """
+    key, run = None, []
+    for statement in statements:
+        insert = _single_row_insert(statement)
+        if insert is not None and insert[0] == key and len(run) < batch_size:
+            run.append((statement, insert[1]))
+            continue
+        if run:
+            yield _merge_inserts(key, run)
+        if insert is not None:
+            key, run = insert[0], [(statement, insert[1])]
+        else:
+            key, run = None, []
+            yield statement, [statement]
+    if run:
+        yield _merge_inserts(key, run)
+
+
+#### Sharing database connections
+
+class ConnectionRegistry(object):
+    """A registry of database connections shared by executors pointing at the same
+    database, so operations on multiple dbnicks don't open a connection per dbnick.
+    Connections are shared only within a single thread.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _connections(self):
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        return self._local.connections
+
+    def get(self, key, connect, reuse=None):
+        """Return a connection registered for ``key``. If there is none, it's created
+        by calling ``connect``. An existing connection is passed to ``reuse`` (if given)
+        before it's returned, e.g. to reset a session left by the previous executor.
+        """
+        connections = self._connections()
+        if key not in connections:
+            with profiler.phase('connect'):
+                connections[key] = [connect(), 0]
+        elif reuse is not None:
+            reuse(connections[key][0])
+        connections[key][1] += 1
+        return connections[key][0]
+
+    def replace(self, key, conn):
+        """Register ``conn`` for ``key`` instead of the current connection, e.g. after
+        the database was replaced by another file.
+        """
+        self._connections()[key][0] = conn
+
+    def is_shared(self, key):
+        """Check if a connection was requested by more than one executor.
+        """
+        entry = self._connections().get(key)
+        return entry is not None and entry[1] > 1
+
+    @contextlib.contextmanager
+    def using(self, connections):
+        """Within the context, connections are registered in a ``connections`` dictionary
+        owned by the caller, who closes them with :func:`close_connections`.
+        """
+        saved = self._connections()
+        self._local.connections = connections
+        try:
+            yield
+        finally:
+            self._local.connections = saved
+
+    @contextlib.contextmanager
+    def scope(self):
+        """Within the context, connections are registered separately and closed
+        when the context exits, so a long-running process doesn't keep them open.
+        """
+        connections = {}
+        try:
+            with self.using(connections):
+                yield
+        finally:
+            close_connections(connections)
+
+
+def close_connections(connections):
+    """Close connections of a dictionary passed to :method:`ConnectionRegistry.using`
+    and remove them from it.
+    """
+    for conn, _ in connections.values():
+        try:
+            # Cassandra's Cluster has shutdown() instead of close()
+            close = getattr(conn, 'close', None) or conn.shutdown
+            close()
+        except Exception:
+            log.exception('While closing a connection')
+    connections.clear()
+
+
+connections = ConnectionRegistry()
+
+def _connection_key(engine, *params):
+    """Return a registry key from connection parameters (strings and dicts).
+    """
+    return repr((engine,) + tuple(sorted(p.items()) if isinstance(p, dict) else p
+                                  for p in params))
+
+
+#### Compressed migration files
+
+# Filename suffixes of supported compression formats
+COMPRESSION_SUFFIXES = ['gz', 'bz2', 'xz', 'zst']
+
+def _logical_migration_name(filename):
+    """Return a migration name for a possibly compressed file, without a compression
+    suffix (e.g. ``m1_init.sql`` for ``m1_init.sql.gz``).
+    """
+    base, ext = os.path.splitext(filename)
+    if ext[1:] in COMPRESSION_SUFFIXES:
+        return base
+    return filename
+
+def _migration_name(migration_file):
+    """Return a migration name stored in a migration table for a path.
+    """
+    return _logical_migration_name(os.path.split(migration_file)[1])
+
+@contextlib.contextmanager
+def _open_migration_stream(name, raw):
+    """Read text from a binary file object ``raw`` storing a migration file ``name``.
+    Compressed content is decompressed while reading.
+    """
+    ext = os.path.splitext(name)[1][1:]
+    if ext == 'gz':
+        raw = gzip.GzipFile(fileobj=raw)
+    elif ext == 'bz2':
+        raw = bz2.BZ2File(raw)
+    elif ext == 'xz':
+        import lzma
+        raw = lzma.LZMAFile(raw)
+    elif ext == 'zst':
+        # optional dependency
+        import zstandard
+        raw = zstandard.ZstdDecompressor().stream_reader(raw)
+    with io.TextIOWrapper(raw) as f:
+        yield f
+
+def _open_migration_file(path):
+    """Open a migration file for reading text. Compressed files are decompressed
+    while reading.
+    """
+    ext = os.path.splitext(path)[1][1:]
+    if ext == 'gz':
+        return gzip.open(path, 'rt')
+    if ext == 'bz2':
+        return bz2.open(path, 'rt')
+    if ext == 'xz':
+        import lzma
+        return lzma.open(path, 'rt')
+    if ext == 'zst':
+        # optional dependency
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+    return open(path)
+
+
 #### Migrations repositories
 
+NON_TRANSACTIONAL_RE = re.compile(r'(?:--|#)\s*mschematool:\s*no-transaction\b')
+
+def _new_migration_filename(name, suffix):
+    return 'm{datestr}_{name}.{suffix}'.format(
+        datestr=datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'),
+        name=name.replace(' ', '_'),
+        suffix=suffix)
+
+
 class MigrationsRepository(object):
     """A repository of migrations is a place where all available migrations are stored
     (for example a directory with migrations as files).
@@ -115,6 +637,11 @@ class MigrationsRepository(object):
         """
         raise NotImplementedError()
 
+    def get_digest(self):
+        """Return a digest of all migrations, as computed by :func:`migrations_digest`.
+        """
+        return migrations_digest(self.get_migrations())
+
     def generate_migration_name(self, name, suffix):
         """Returns a name of a new migration. It will usually be a filename with
         a valid and unique name.
@@ -122,11 +649,43 @@ class MigrationsRepository(object):
         :param name: human-readable name of a migration
         :param suffix: file suffix (extension) - eg. 'sql'
         """
-        return os.path.join(self.dir,
-                            'm{datestr}_{name}.{suffix}'.format(
-                                datestr=datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'),
-                                name=name.replace(' ', '_'),
-                                suffix=suffix))
+        return os.path.join(self.dir, _new_migration_filename(name, suffix))
+
+    def migration_path(self, migration):
+        """Return a path of a file storing ``migration``, which can be passed
+        to :method:`open_migration` and :method:`load_module`.
+        """
+        raise NotImplementedError()
+
+    def open_migration(self, path):
+        """Open a migration file for reading text.
+        """
+        return _open_migration_file(path)
+
+    def load_module(self, path):
+        """Import a Python migration.
+        """
+        return imp.load_source('migration_module', path)
+
+    def migration_size(self, path):
+        """Return a size of a migration file in bytes.
+        """
+        return os.path.getsize(path)
+
+    def is_non_transactional(self, path):
+        """Check if a migration file is marked with a ``mschematool: no-transaction``
+        comment (starting with ``--`` or ``#``) in leading comment lines.
+        """
+        with self.open_migration(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if not line.startswith(('--', '#')):
+                    return False
+                if NON_TRANSACTIONAL_RE.match(line):
+                    return True
+        return False
 
     def migration_type(self, migration):
         """Recognize migration type based on a migration (usually a filename).
@@ -143,6 +702,9 @@ class DirRepository(MigrationsRepository):
     inside a directory ``dir``. Example filenames:
     - m20140615132455_init.sql
     - m20140615135414_insert3.py
+    - m20140615135500_seed.sql.gz
+
+    A compressed file is a migration named without the compression suffix.
 
     :param migration_patterns: a list of glob expressions for selecting valid
         migration filenames, relative to ``dir``.
@@ -151,24 +713,186 @@ class DirRepository(MigrationsRepository):
     def __init__(self, dir, migration_patterns):
         self.dir = dir
         self.migration_patterns = migration_patterns
+        self._filenames = None
+        self._paths = None
 
     def _get_all_filenames(self):
+        if self._filenames is not None:
+            return self._filenames
+        with profiler.phase('list migrations'):
+            filenames = self._list_filenames()
+        # lexicographical ordering of migration names
+        filenames.sort(key=_logical_migration_name)
+        paths = {}
+        for fn in filenames:
+            migration = _migration_name(fn)
+            if migration in paths:
+                raise click.ClickException('Migration %s is stored in multiple files: %s, %s' %
+                                           (migration, paths[migration], fn))
+            paths[migration] = fn
+        # other threads may list the repository concurrently - they must see either
+        # nothing or complete results, with _paths set before _filenames
+        self._paths = paths
+        self._filenames = filenames
+        return filenames
+
+    def _list_filenames(self):
         filenames = []
         for pattern in self.migration_patterns:
             p_filenames = glob.glob(os.path.join(self.dir, pattern))
             filenames.extend(p_filenames)
-        # lexicographical ordering
-        filenames.sort()
         return filenames
 
     def get_migrations(self, exclude=None):
         filenames = self._get_all_filenames()
-        filenames = [os.path.split(fn)[1] for fn in filenames]
+        filenames = [_migration_name(fn) for fn in filenames]
         if exclude:
             filenames = set(filenames) - set(exclude)
             filenames = sorted(filenames)
         return filenames
 
+    def migration_path(self, migration):
+        """Return a path of a file storing ``migration``.
+        """
+        self._get_all_filenames()
+        return self._paths.get(migration, os.path.join(self.dir, migration))
+
+
+class ResourceRepository(DirRepository):
+    """:class:`MigrationsRepository` implementation reading migrations from
+    a directory-like ``root`` object implementing ``importlib.abc.Traversable``,
+    like a :class:`zipfile.Path` or a result of :func:`importlib.resources.files`.
+    Files aren't extracted: a zip archive is listed using its central directory and
+    migrations are read directly from the archive.
+
+    :param name: a name of ``root`` used in paths of migrations
+    """
+
+    def __init__(self, root, name, migration_patterns):
+        DirRepository.__init__(self, name, migration_patterns)
+        self.root = root
+        self._entries = {}
+        # arguments of :method:`_open_root` recreating ``root`` after unpickling
+        self._source = None
+
+    def __getstate__(self):
+        # a zip archive is an open file, so it's opened again by a worker process started
+        # using the `spawn` method
+        state = self.__dict__.copy()
+        if self._source is not None:
+            state.update(root=None, _entries={}, _filenames=None, _paths=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.root is None:
+            self.root = self._open_root(*self._source)
+
+    @staticmethod
+    def _open_root(kind, location, subdir=None):
+        if kind == 'zip':
+            import zipfile
+
+            return zipfile.Path(location, at=subdir)
+        import importlib.resources
+
+        return importlib.resources.files(location)
+
+    @classmethod
+    def from_zip(cls, archive, subdir, migration_patterns):
+        """Create a repository for migrations stored in directory ``subdir`` of a zip
+        ``archive`` (e.g. a wheel).
+        """
+        import zipfile
+
+        at = subdir.strip('/') + '/' if subdir else ''
+        repository = cls(cls._open_root('zip', archive, at), os.path.join(archive, at.rstrip('/')),
+                         migration_patterns)
+        repository._source = ('zip', archive, at)
+        return repository
+
+    @classmethod
+    def from_package(cls, package, migration_patterns):
+        """Create a repository for migrations stored as resources of a Python ``package``,
+        which can be imported from a zip archive.
+        """
+        repository = cls(cls._open_root('package', package), package, migration_patterns)
+        repository._source = ('package', package)
+        return repository
+
+    def _list_filenames(self):
+        filenames = []
+        for entry in self.root.iterdir():
+            if not entry.is_file():
+                continue
+            if any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in self.migration_patterns):
+                path = os.path.join(self.dir, entry.name)
+                self._entries[path] = entry
+                filenames.append(path)
+        return filenames
+
+    def _entry(self, path):
+        self._get_all_filenames()
+        if path not in self._entries:
+            raise click.ClickException('Migration file %s does not exist' % path)
+        return self._entries[path]
+
+    def generate_migration_name(self, name, suffix):
+        return _new_migration_filename(name, suffix)
+
+    @contextlib.contextmanager
+    def open_migration(self, path):
+        with self._entry(path).open('rb') as raw:
+            with _open_migration_stream(path, raw) as f:
+                yield f
+
+    def load_module(self, path):
+        module = types.ModuleType('migration_module')
+        module.__file__ = path
+        exec(compile(self._entry(path).read_bytes(), path, 'exec'), module.__dict__)
+        return module
+
+    def migration_size(self, path):
+        entry = self._entry(path)
+        if hasattr(entry, 'stat'):
+            # a package stored on disk
+            return entry.stat().st_size
+        archive = getattr(entry, 'root', None)
+        if hasattr(archive, 'getinfo'):
+            # zipfile.Path - the uncompressed size from the central directory
+            return archive.getinfo(entry.at).file_size
+        size = 0
+        with entry.open('rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                size += len(chunk)
+        return size
+
+
+def _repository_location(db_config):
+    """Return a tuple identifying a repository configured in ``db_config``.
+    """
+    if 'migrations_zip' in db_config:
+        return ('zip', os.path.abspath(db_config['migrations_zip']),
+                db_config.get('migrations_zip_dir', '').strip('/'))
+    if 'migrations_package' in db_config:
+        return ('package', db_config['migrations_package'])
+    return ('dir', os.path.abspath(db_config.get('migrations_dir', '')))
+
+
+def _make_repository(db_config, migration_patterns):
+    """Create a repository configured with one of `migrations_dir`, `migrations_zip`
+    or `migrations_package` options.
+    """
+    if 'migrations_zip' in db_config:
+        return ResourceRepository.from_zip(db_config['migrations_zip'],
+                                           db_config.get('migrations_zip_dir'), migration_patterns)
+    if 'migrations_package' in db_config:
+        return ResourceRepository.from_package(db_config['migrations_package'], migration_patterns)
+    if 'migrations_dir' not in db_config:
+        raise click.ClickException('One of migrations_dir, migrations_zip, migrations_package '
+                                   'must be specified')
+    return DirRepository(db_config['migrations_dir'], migration_patterns)
+
 
 #### Database-independent interface for migration-related operations
 
@@ -185,14 +909,28 @@ class MigrationsExecutor(object):
 
     :param db_config: a dictionary with configuration for a single dbnick.
     :param repository: :class:`MigrationsRepository` implementation.
+    :param connection: an existing connection object (of the type passed to Python
+        migrations) to use instead of connecting according to ``db_config``.
     """
 
     engine = 'unknown'
     filename_extensions = []
-
-    def __init__(self, db_config, repository):
+    fanout = False
+    # seconds for which executing migrations was paused by throttling
+    throttled = 0.0
+    # a Rehearsal recording statements, set when rehearsing migrations on a clone
+    rehearsal = None
+    # peak RSS in bytes of a worker process which executed the last migration
+    # (see :method:`execute_migration`), or None
+    worker_peak_rss = None
+    # set to False in a worker process, as the parent records executed migrations
+    record_executed = True
+
+    def __init__(self, db_config, repository, connection=None):
         self.db_config = db_config
         self.repository = repository
+        self._migration_started = None
+        self._prefetched = None
 
     @classmethod
     def supported_filename_globs(cls):
@@ -200,7 +938,31 @@ class MigrationsExecutor(object):
             return '*.%s' % ext
         default_globs = [glob_from_ext('py'), glob_from_ext(cls.engine)]
         custom_globs = [glob_from_ext(ext) for ext in cls.filename_extensions]
-        return default_globs + custom_globs
+        native_exts = [cls.engine] + cls.filename_extensions
+        compressed_globs = [glob_from_ext('%s.%s' % (ext, suffix))
+                            for ext in native_exts for suffix in COMPRESSION_SUFFIXES]
+        return default_globs + custom_globs + compressed_globs
+
+    @classmethod
+    def with_connect_timeout(cls, db_config, seconds):
+        """Return a copy of ``db_config`` making connecting (and waiting for a locked
+        database or a statement, where it applies) fail after ``seconds``.
+        """
+        return db_config
+
+    def targets(self):
+        """Return a list of ``(label, executor)`` pairs for places in which migrations are
+        tracked independently. Usually it's only the executor itself with ``None`` label.
+        Executors with :attr:`fanout` set return a target for each tenant and implement
+        :method:`sync_fanout`.
+        """
+        return [(None, self)]
+
+    def sync_fanout(self):
+        """Sync all targets. Return an iterable of ``(label, executed migrations, error)``
+        tuples, where ``error`` is ``None`` or a ``(migration, exception)`` pair.
+        """
+        raise NotImplementedError()
 
     def initialize(self):
         """Initialize resources needed for tracking migrations. It will usually
@@ -213,6 +975,32 @@ class MigrationsExecutor(object):
         """
         raise NotImplementedError()
 
+    def fetch_durations(self):
+        """Return a dictionary mapping executed migrations to their execution times
+        in seconds. Migrations without a recorded duration are skipped.
+        """
+        raise NotImplementedError()
+
+    def fetch_digest(self):
+        """Return a digest ``(count, hash)`` of executed migrations, stored in a single row
+        by :method:`initialize` and `_migration_success`. Return ``None`` if the digest isn't
+        stored (the database was initialized by an older version of the tool).
+        """
+        raise NotImplementedError()
+
+    def _store_digest(self, digest):
+        """Overwrite the stored digest of executed migrations.
+        """
+        raise NotImplementedError()
+
+    def _update_digest(self, migration):
+        """Subclasses should call this method when recording an executed migration,
+        in the same transaction.
+        """
+        digest = self.fetch_digest()
+        if digest is not None:
+            self._store_digest(_digest_add(digest, migration))
+
     def execute_python_migration(self, migration, module):
         """Execute a migration written as Python code, and store information about it.
 
@@ -221,6 +1009,17 @@ class MigrationsExecutor(object):
         """
         raise NotImplementedError()
 
+    def record_migration(self, migration):
+        """Store information about ``migration`` executed by a worker process.
+        """
+        raise NotImplementedError()
+
+    def worker_config(self):
+        """Return ``db_config`` from which a worker process executing a Python migration
+        creates an executor with its own connection.
+        """
+        return self.db_config
+
     def execute_native_migration(self, migration):
         """Execute a migration in a format native to the DB (SQL file, CQL file etc.),
         and store information about it.
@@ -229,6 +1028,95 @@ class MigrationsExecutor(object):
         """
         raise NotImplementedError()
 
+    def schema_fingerprint(self):
+        """Return a value that changes when the database schema changes (but not when
+        only data changes). Used for skipping the `after_sync` command.
+        """
+        raise NotImplementedError()
+
+    def single_transaction(self, migrations):
+        """Return a context manager within which ``migrations`` can be executed
+        in a single transaction, committed when the context exits.
+        """
+        raise click.ClickException('Executing migrations in a single transaction is not '
+                                   'supported by the %s engine' % self.engine)
+
+    def rehearsal_clone(self):
+        """Return a context manager creating a temporary clone of the database, yielding
+        a ``db_config`` dictionary pointing at the clone, and dropping the clone when
+        the context exits.
+        """
+        raise click.ClickException('Rehearsing migrations is not supported by the %s engine' %
+                                   self.engine)
+
+    def table_sizes(self, tables):
+        """Return a dictionary mapping names of existing ``tables`` to ``(size in bytes,
+        estimated number of rows)`` pairs, used by static analysis of migrations.
+        """
+        raise click.ClickException('Analyzing migrations is not supported by the %s engine' %
+                                   self.engine)
+
+    def held_locks(self):
+        """Return descriptions of locks held by the current transaction of a migration.
+        """
+        return []
+
+    def _statement_executed(self, statement, started):
+        """Subclasses should call this method after executing each statement of
+        a migration (or a whole Python migration) started at time ``started``.
+        """
+        if self.rehearsal is not None:
+            self.rehearsal.statement(statement, started, self.held_locks())
+
+    def _committed(self):
+        """Subclasses should call this method after committing a migration.
+        """
+        if self.rehearsal is not None:
+            self.rehearsal.committed()
+
+    def shadow_swap(self):
+        """Return a context manager within which migrations are executed on a copy
+        of the database, which replaces the database when the context exits.
+        """
+        raise click.ClickException('Migrating a copy of the database is not '
+                                   'supported by the %s engine' % self.engine)
+
+    def _iter_statements(self, f):
+        """Yield statements of a native migration read from a file object ``f``.
+        """
+        return profiler.timed_iter('parse', _iter_sql_statements(f))
+
+    @contextlib.contextmanager
+    def _native_statements(self, migration):
+        """Return a context manager yielding statements of a native migration: prefetched
+        ones passed to :method:`execute_migration`, or ones parsed while reading the file.
+        """
+        if self._prefetched is not None:
+            yield self._prefetched
+            return
+        with self.repository.open_migration(migration) as f:
+            yield self._iter_statements(f)
+
+    def _migration_duration(self):
+        """Return the number of seconds elapsed since starting the current migration.
+        """
+        if self._migration_started is None:
+            return None
+        return time.time() - self._migration_started
+
+    def _coalesced(self, statements):
+        """Return ``(statement, originals)`` pairs for statements to execute. When
+        `coalesce_inserts` is set, consecutive single-row INSERTs are merged (see
+        :func:`_coalesce_inserts`). When a merged statement fails, subclasses should
+        execute the original statements, to report an error for a single statement.
+        """
+        batch_size = self.db_config.get('coalesce_inserts')
+        if not batch_size:
+            return ((statement, [statement]) for statement in statements)
+        if batch_size is True:
+            batch_size = DEFAULT_COALESCE_BATCH_SIZE
+        return _coalesce_inserts(statements, batch_size)
+
     def _call_migrate(self, module, connection_param):
         """Subclasses should call this method instead of `module.migrate` directly,
         to support `db_config` optional argument.
@@ -239,19 +1127,225 @@ class MigrationsExecutor(object):
             args.append(self.db_config)
         return module.migrate(*args)
 
-    def execute_migration(self, migration_file_relative):
+    def execute_migration(self, migration_file_relative, statements=None):
         """This recognizes migration type and executes either
-        :method:`execute_python_migration` or :method:`execute_native_migration`
+        :method:`execute_python_migration` or :method:`execute_native_migration`.
+        ``False`` is returned when a failed migration was reported without raising
+        an exception.
+
+        :param statements: statements of a native migration parsed in advance
+            (see :class:`MigrationPrefetcher`)
         """
-        migration_file = os.path.join(self.db_config['migrations_dir'], migration_file_relative)
+        migration_file = self.repository.migration_path(migration_file_relative)
+        self._migration_started = time.time()
+        self.worker_peak_rss = None
         m_type = self.repository.migration_type(migration_file)
-        if m_type == 'native':
-            return self.execute_native_migration(migration_file)
-        if m_type == 'py':
-            module = imp.load_source('migration_module', migration_file)
-            return self.execute_python_migration(migration_file, module)
+        with profiler.phase('execute'):
+            if m_type == 'native':
+                self._prefetched = statements
+                try:
+                    return self.execute_native_migration(migration_file)
+                finally:
+                    self._prefetched = None
+            if m_type == 'py':
+                if self.db_config.get('python_migration_worker'):
+                    return self._execute_python_in_worker(migration_file)
+                module = self.repository.load_module(migration_file)
+                return self.execute_python_migration(migration_file, module)
         assert False, 'Unknown migration type %s' % migration_file
 
+    def _execute_python_in_worker(self, migration_file):
+        """Execute a Python migration in a worker process started using the
+        `python_migration_worker` start method, so memory and modules of the migration
+        are released when it exits. The migration is recorded only after the worker
+        exits successfully.
+        """
+        if multiprocessing.current_process().daemon:
+            raise click.ClickException('Python migrations can\'t be executed in worker processes '
+                                       'by processes of `fanout_processes`')
+        context = _process_context(self.db_config['python_migration_worker'])
+        if _start_method(context) == 'fork' and threading.active_count() > 1:
+            # a lock held by another thread at the time of fork (e.g. of logging handlers)
+            # would never be released in the worker
+            raise click.ClickException('Python migrations can\'t be executed in forked worker '
+                                       'processes while other threads are running (e.g. with '
+                                       '`sync --prefetch`); use the `spawn` or `forkserver` start '
+                                       'method')
+        reader, writer = context.Pipe(duplex=False)
+        process = context.Process(target=_python_migration_worker, name='mschematool-migration',
+                                  args=(type(self), self.worker_config(), self.repository, migration_file,
+                                        self.db_config.get('python_migration_memory_limit'), writer))
+        started = time.time()
+        process.start()
+        writer.close()
+        try:
+            error, self.worker_peak_rss = reader.recv()
+        except EOFError:
+            # the worker was killed
+            error = None
+        finally:
+            reader.close()
+        process.join()
+        if self.worker_peak_rss is not None:
+            log.info('Peak RSS of the worker executing %s: %.1f MB above its start', migration_file,
+                     self.worker_peak_rss / 1024.0 / 1024.0)
+        if process.exitcode != 0:
+            if error is None:
+                error = 'killed by signal %d' % -process.exitcode if process.exitcode < 0 else \
+                    'exit code %d' % process.exitcode
+            raise MigrationWorkerError('Python migration %s failed in a worker process: %s' %
+                                       (os.path.basename(migration_file), error))
+        self._statement_executed('migrate() of %s in a worker process' % os.path.basename(migration_file),
+                                 started)
+        self.record_migration(migration_file)
+
+
+class MigrationWorkerError(Exception):
+    """Raised when a worker process executing a Python migration failed or was killed.
+    """
+
+
+def _process_context(method):
+    """Return a :mod:`multiprocessing` context for a start method of worker processes.
+    ``True`` means `spawn`, so a worker doesn't inherit the address space, threads and
+    locks of the parent. Python 2 only forks, so the module itself is returned.
+    """
+    if not hasattr(multiprocessing, 'get_context'):
+        if method is not True:
+            raise click.ClickException('Choosing a start method of worker processes requires Python 3')
+        return multiprocessing
+    try:
+        return multiprocessing.get_context('spawn' if method is True else method)
+    except ValueError as e:
+        raise click.ClickException('Invalid `python_migration_worker`: %s' % e)
+
+
+def _start_method(context):
+    if not hasattr(context, 'get_start_method'):
+        return 'fork'
+    return context.get_start_method()
+
+
+def _process_memory():
+    """Return the address space size and RSS of the current process in bytes, read from
+    ``/proc/self/statm``, or ``None`` if it's not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            size, resident = f.read().split()[:2]
+    except (IOError, OSError):
+        return None
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    return int(size) * page_size, int(resident) * page_size
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _python_migration_worker(engine_cls, db_config, repository, migration_file, memory_limit, pipe):
+    """Execute a Python migration without recording it, in a worker process. The address
+    space of the process may grow by ``memory_limit`` megabytes from its size at the start.
+    An error message (or ``None``) and the peak RSS above the RSS at the start are sent
+    through ``pipe``.
+    """
+    error = None
+    # memory of the interpreter and modules loaded before executing the migration
+    memory = _process_memory()
+    baseline_rss = memory[1] if memory is not None else _peak_rss()
+    # connections inherited from a forked parent are neither used nor closed
+    with connections.scope():
+        try:
+            if memory_limit is not None and resource is not None:
+                _, hard = resource.getrlimit(resource.RLIMIT_AS)
+                baseline_size = memory[0] if memory is not None else 0
+                resource.setrlimit(resource.RLIMIT_AS,
+                                   (baseline_size + int(memory_limit * 1024 * 1024), hard))
+            module = repository.load_module(migration_file)
+            for _, executor in engine_cls(db_config, repository).targets():
+                executor.record_executed = False
+                executor.execute_python_migration(migration_file, module)
+        except MemoryError:
+            log.exception('While executing %s in a worker process', migration_file)
+            error = 'out of memory' if memory_limit is None else \
+                'memory limit of %s MB exceeded' % memory_limit
+        except Exception as e:
+            log.exception('While executing %s in a worker process', migration_file)
+            error = '%s: %s' % (e.__class__.__name__, e)
+    peak_rss = _peak_rss()
+    if peak_rss is not None and baseline_rss is not None:
+        peak_rss = max(0, peak_rss - baseline_rss)
+    pipe.send((error, peak_rss))
+    pipe.close()
+    if error is not None:
+        sys.exit(1)
+
+
+
+DEFAULT_PREFETCH = 2
+DEFAULT_PREFETCH_MAX_SIZE = 64 * 1024 * 1024
+
+
+class MigrationPrefetcher(object):
+    """Reads and parses native migrations from ``migrations`` in a background thread
+    while earlier migrations are executed. At most ``lookahead`` parsed migrations are
+    kept in memory, and migrations bigger than ``max_size`` bytes aren't prefetched
+    (they are parsed while executing, as usual). Compressed migrations aren't prefetched
+    either, as their decompressed size isn't known in advance. Python migrations are
+    imported when they are executed. An error while parsing is raised by :method:`get` called
+    for the failing migration, so errors are reported in order.
+
+    :param executor: a :class:`MigrationsExecutor` used for parsing
+    """
+
+    def __init__(self, executor, migrations, lookahead=DEFAULT_PREFETCH,
+                 max_size=DEFAULT_PREFETCH_MAX_SIZE):
+        self.executor = executor
+        self.repository = executor.repository
+        self.migrations = list(migrations)
+        self.lookahead = lookahead
+        self.max_size = max_size
+        self._pending = {}
+        self._next = 0
+        # parsing is CPU-bound, so more threads wouldn't help because of the GIL -
+        # one thread is enough to parse while the database executes statements
+        self._pool = ThreadPool(1) if lookahead > 0 else None
+        self._fill()
+
+    def _parse(self, path):
+        with self.repository.open_migration(path) as f:
+            return list(self.executor._iter_statements(f))
+
+    def _fill(self):
+        while self._pool is not None and len(self._pending) < self.lookahead and \
+                self._next < len(self.migrations):
+            migration = self.migrations[self._next]
+            self._next += 1
+            path = self.repository.migration_path(migration)
+            if self.repository.migration_type(path) != 'native' or \
+                    _logical_migration_name(path) != path or \
+                    self.repository.migration_size(path) > self.max_size:
+                continue
+            self._pending[migration] = self._pool.apply_async(self._parse, (path,))
+
+    def get(self, migration):
+        """Return a list of statements of ``migration``, waiting until it's parsed,
+        or ``None`` if it isn't prefetched.
+        """
+        result = self._pending.pop(migration, None)
+        self._fill()
+        if result is None:
+            return None
+        return result.get()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
 
 
 ENGINE_TO_IMPL = {
@@ -262,34 +1356,334 @@ ENGINE_TO_IMPL = {
 
 
 
+### Rehearsing migrations
+
+class RehearsedMigration(object):
+    """Results of executing a migration on a clone of a database. ``statements`` is a list
+    of ``(seconds, statement)`` pairs and ``locks`` maps descriptions of locks to numbers
+    of seconds they were held for.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.duration = None
+        self.statements = []
+        self.locks = {}
+        self.error = None
+
+
+class Rehearsal(object):
+    """Records durations of statements and how long locks were held while migrations
+    are executed on a clone of a database. A lock is counted as held from the start of
+    the statement after which it was first seen until the commit.
+    """
+
+    def __init__(self):
+        self.migrations = []
+        self._started = None
+        self._acquired = {}
+
+    def start(self, migration):
+        self.migrations.append(RehearsedMigration(migration))
+        self._started = time.time()
+        self._acquired = {}
+
+    def statement(self, statement, started, locks):
+        self.migrations[-1].statements.append((time.time() - started, statement))
+        for lock in locks:
+            self._acquired.setdefault(lock, started)
+
+    def committed(self):
+        migration = self.migrations[-1]
+        now = time.time()
+        for lock, acquired in self._acquired.items():
+            migration.locks[lock] = max(migration.locks.get(lock, 0.0), now - acquired)
+        self._acquired = {}
+
+    def finished(self, error=None):
+        self.migrations[-1].duration = time.time() - self._started
+        self.migrations[-1].error = error
+
+    def report(self, top=5):
+        """Return lines of a report with durations of migrations, ``top`` slowest statements
+        of each migration and the longest held locks.
+        """
+        lines = []
+        longest_lock = None
+        for migration in self.migrations:
+            lines.append('%s %s%s' % (migration.name, format_duration(migration.duration),
+                                      ', failed: %s' % migration.error if migration.error else ''))
+            statements = sorted(migration.statements, key=lambda item: -item[0])[:top]
+            for seconds, statement in statements:
+                lines.append('  %8s  %s' % (format_duration(seconds),
+                                            ' '.join(statement.split())[:70]))
+            for lock, seconds in sorted(migration.locks.items(), key=lambda item: -item[1]):
+                lines.append('  lock %s held %s' % (lock, format_duration(seconds)))
+                if longest_lock is None or seconds > longest_lock[1]:
+                    longest_lock = (lock, seconds, migration.name)
+        lines.append('Total: %s for %d migrations' % (
+            format_duration(sum(m.duration for m in self.migrations)), len(self.migrations)))
+        if longest_lock is not None:
+            lines.append('Longest lock: %s held %s (%s)' % (longest_lock[0],
+                                                            format_duration(longest_lock[1]),
+                                                            longest_lock[2]))
+        return lines
+
+
+### Estimating execution times
+
+DEFAULT_ESTIMATE_SECONDS_PER_STATEMENT = 0.01
+DEFAULT_ESTIMATE_SECONDS_PER_MB = 1.0
+
+
+def format_duration(seconds):
+    """Format a number of seconds in a human readable form, e.g. ``1h 02m 05s``.
+    """
+    if seconds < 60:
+        return '%.1fs' % seconds
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    if minutes < 60:
+        return '%dm %02ds' % (minutes, seconds)
+    hours, minutes = divmod(minutes, 60)
+    return '%dh %02dm %02ds' % (hours, minutes, seconds)
+
+
 ### Integrating all the classes
 
+def _is_dbnick_pattern(s):
+    return any(c in s for c in '*?[')
+
+
+class DbnickSelection(object):
+    """Dbnicks selected by a command line argument: a comma-separated list of dbnicks
+    or shell-style patterns matched against dbnicks from the config (e.g. ``tenant_*``).
+    """
+
+    def __init__(self, config, spec):
+        self.config = config
+        self.spec = spec
+        self.parts = [part.strip() for part in spec.split(',') if part.strip()]
+
+    @property
+    def multiple(self):
+        return len(self.parts) > 1 or any(_is_dbnick_pattern(part) for part in self.parts)
+
+    def dbnicks(self):
+        seen = set()
+        for part in self.parts:
+            if _is_dbnick_pattern(part):
+                # dbnicks are matched while iterating, so processing starts without
+                # listing all of them
+                matched = (dbnick for dbnick in self.config.databases.dbnicks()
+                           if fnmatch.fnmatchcase(dbnick, part))
+            else:
+                matched = [part]
+            found = False
+            for dbnick in matched:
+                found = True
+                if dbnick not in seen:
+                    seen.add(dbnick)
+                    yield dbnick
+            if not found:
+                raise click.ClickException('No dbnicks in DATABASES in config match %r' % part)
+
+    def tools(self):
+        """Yield :class:`MSchemaTool` objects for selected dbnicks, created lazily.
+        Executors pointing at the same database share a connection.
+        """
+        for dbnick in self.dbnicks():
+            yield MSchemaTool(self.config, dbnick)
+
+
+def engine_class(dbnick, db_config):
+    """Return a :class:`MigrationsExecutor` subclass implementing the engine of ``db_config``.
+    """
+    if 'engine' not in db_config or db_config['engine'] not in ENGINE_TO_IMPL:
+        raise click.ClickException('Unknown or invalid engine specified for the database %s, choose one of %s' % (dbnick, ENGINE_TO_IMPL.keys()))
+    return _import_class(ENGINE_TO_IMPL[db_config['engine']])
+
+
 class MSchemaTool(object):
 
-    def __init__(self, config, dbnick):
+    def __init__(self, config, dbnick, connection=None):
         self.config = config
         self.dbnick = dbnick
 
-        if dbnick not in config.module.DATABASES:
-            raise click.ClickException('Not found in DATABASES in config: %s, available: %s' % (dbnick, ', '.join(config.module.DATABASES.keys())))
-        self.db_config = config.module.DATABASES[dbnick]
+        self.db_config = config.databases.get(dbnick)
+        if self.db_config is None:
+            if config.databases.is_dict:
+                raise click.ClickException('Not found in DATABASES in config: %s, available: %s' % (dbnick, ', '.join(config.module.DATABASES.keys())))
+            raise click.ClickException('Not found in DATABASES in config: %s' % dbnick)
 
-        if 'engine' not in self.db_config or self.db_config['engine'] not in ENGINE_TO_IMPL:
-            raise click.ClickException('Unknown or invalid engine specified for the database %s, choose one of %s' % (dbnick, ENGINE_TO_IMPL.keys()))
-        engine_cls = _import_class(ENGINE_TO_IMPL[self.db_config['engine']])
+        engine_cls = engine_class(dbnick, self.db_config)
 
-        self.repository = DirRepository(self.db_config['migrations_dir'], engine_cls.supported_filename_globs())
-        self.migrations = engine_cls(self.db_config, self.repository)
+        self.repository = _make_repository(self.db_config, engine_cls.supported_filename_globs())
+        self.migrations = engine_cls(self.db_config, self.repository, connection)
+        self._fingerprint = None
+
+    def targets(self):
+        """Yield ``(label, tool)`` pairs for targets returned by
+        :method:`MigrationsExecutor.targets`, with ``tool`` being a copy of this object
+        using the target's executor.
+        """
+        for label, migrations in self.migrations.targets():
+            target = copy.copy(self)
+            target.migrations = migrations
+            yield label, target
+
+    def history_sources(self):
+        """Return dbnicks whose recorded migration durations can be used for estimating
+        durations for this dbnick: this dbnick and the ones using the same engine and migrations
+        repository.
+        """
+        location = _repository_location(self.db_config)
+        sources = [self.dbnick]
+        try:
+            dbnicks = sorted(self.config.databases.dbnicks())
+        except click.ClickException:
+            # dbnicks can't be listed
+            dbnicks = []
+        for dbnick in dbnicks:
+            if dbnick == self.dbnick:
+                continue
+            db_config = self.config.databases.get(dbnick)
+            if db_config is None:
+                continue
+            if db_config.get('engine') != self.db_config['engine']:
+                continue
+            if _repository_location(db_config) != location:
+                continue
+            sources.append(dbnick)
+        return sources
+
+    def recorded_durations(self, sources):
+        """Return a dictionary mapping migrations to ``(seconds, dbnick)`` pairs with the longest
+        duration recorded in databases of ``sources`` dbnicks (all targets of each dbnick are
+        checked). Sources which can't be read are skipped with a warning.
+        """
+        durations = {}
+        for dbnick in sources:
+            try:
+                source = self if dbnick == self.dbnick else MSchemaTool(self.config, dbnick)
+                for _, target in source.targets():
+                    for migration, seconds in target.migrations.fetch_durations().items():
+                        if migration not in durations or durations[migration][0] < seconds:
+                            durations[migration] = (seconds, dbnick)
+            except Exception as e:
+                log.warning('Cannot read recorded durations from %s: %s', dbnick, e)
+                click.echo('Skipping %s: cannot read recorded durations: %s' % (dbnick, e), err=True)
+        return durations
+
+    def heuristic_duration(self, migration):
+        """Guess a duration of a migration that wasn't executed anywhere, based on the number of
+        statements and the file size. The factors can be set with `estimate_seconds_per_statement`
+        and `estimate_seconds_per_mb` options.
+        """
+        per_statement = self.db_config.get('estimate_seconds_per_statement',
+                                           DEFAULT_ESTIMATE_SECONDS_PER_STATEMENT)
+        per_mb = self.db_config.get('estimate_seconds_per_mb', DEFAULT_ESTIMATE_SECONDS_PER_MB)
+        path = self.repository.migration_path(migration)
+        if self.repository.migration_type(migration) == 'py':
+            return per_statement + per_mb * self.repository.migration_size(path) / (1024.0 * 1024.0)
+        count = 0
+        size = 0
+        with self.repository.open_migration(path) as f:
+            for statement in self.migrations._iter_statements(f):
+                count += 1
+                size += len(statement)
+        return per_statement * count + per_mb * size / (1024.0 * 1024.0)
+
+    def estimate(self, migrations, durations):
+        """Return a list of ``(migration, seconds, dbnick)`` tuples with estimated durations of
+        ``migrations``. ``durations`` is a result of :method:`recorded_durations`. ``dbnick``
+        is ``None`` when a duration is a heuristic guess.
+        """
+        result = []
+        for migration in migrations:
+            if migration in durations:
+                seconds, dbnick = durations[migration]
+            else:
+                seconds, dbnick = self.heuristic_duration(migration), None
+            result.append((migration, seconds, dbnick))
+        return result
+
+    def rehearse(self, migrations):
+        """Execute ``migrations`` on a temporary clone of the database and return
+        a :class:`Rehearsal`. Executing stops at the first failed migration.
+        """
+        if self.migrations.fanout:
+            raise click.ClickException('Rehearsing migrations is not supported for fan-out dbnicks')
+        rehearsal = Rehearsal()
+        with self.migrations.rehearsal_clone() as clone_config, connections.scope():
+            clone = type(self.migrations)(clone_config, self.repository)
+            clone.rehearsal = rehearsal
+            for migration in migrations:
+                log.info('Rehearsing %s', migration)
+                rehearsal.start(migration)
+                try:
+                    failed = clone.execute_migration(migration) is False
+                except Exception as e:
+                    log.exception('While rehearsing %s', migration)
+                    rehearsal.finished(e)
+                    break
+                rehearsal.finished('see the log' if failed else None)
+                if failed:
+                    break
+        return rehearsal
 
     def not_executed_migration_files(self):
-        return self.repository.get_migrations(exclude=self.migrations.fetch_executed_migrations())
+        with profiler.phase('fetch executed migrations'):
+            executed = self.migrations.fetch_executed_migrations()
+        return self.repository.get_migrations(exclude=executed)
+
+    def is_synced(self):
+        """Check if there are no migrations to sync. The digest stored in the database is
+        compared with the repository digest first, so usually only a single row is read.
+        """
+        digest = self.migrations.fetch_digest()
+        if digest is not None and digest == self.repository.get_digest():
+            return True
+        return not self.not_executed_migration_files()
+
+    def prepare_after_sync(self):
+        """Should be called before executing migrations. When
+        `after_sync_if_schema_changed` is set, it remembers a schema fingerprint
+        to compare with in :method:`execute_after_sync`.
+        """
+        if self.db_config.get('after_sync') and self.db_config.get('after_sync_if_schema_changed'):
+            with profiler.phase('schema fingerprint'):
+                self._fingerprint = self.migrations.schema_fingerprint()
 
     def execute_after_sync(self):
         after_sync = self.db_config.get('after_sync')
         if not after_sync:
             return
+        if self._fingerprint is not None:
+            with profiler.phase('schema fingerprint'):
+                changed = self._fingerprint != self.migrations.schema_fingerprint()
+        else:
+            changed = True
+        if not changed:
+            msg = 'Schema not changed, skipping after_sync command %r' % after_sync
+            log.info(msg)
+            click.echo(msg)
+            return
         msg = 'Executing after_sync command %r' % after_sync
         log.info(msg)
         click.echo(msg)
-        os.system(after_sync)
+        timeout = self.db_config.get('after_sync_timeout')
+        started = time.time()
+        # a new session allows killing the whole process group on timeout
+        with profiler.phase('after_sync'):
+            proc = subprocess.Popen(after_sync, shell=True, start_new_session=True)
+            try:
+                retcode = proc.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+                msg = 'after_sync command %r killed after timeout of %s seconds' % (after_sync, timeout)
+                log.critical(msg)
+                raise click.ClickException(msg)
+        log.info('after_sync command finished with status %d in %.3f seconds', retcode,
+                 time.time() - started)
 
@@ -1,8 +1,12 @@
+import logging
 import os.path
 import sys
+import re
 import imp
 import datetime
+import contextlib
 
+import cassandra
 import cassandra.cluster
 import cassandra.protocol
 import click
@@ -12,6 +16,13 @@ from mschematool import core
 
 log = core.log
 
+SCHEMA_AGREEMENT_MODES = ['statement', 'batch']
+
+# ends a batch; chunks of a batch without it aren't parsed until the batch ends
+APPLY_BATCH_RE = re.compile(r'\bAPPLY\s+BATCH\b', re.I)
+# statements changing the schema, possibly preceded by comments
+DDL_RE = re.compile(r'(?:\s+|--[^\n]*\n|//[^\n]*\n|/\*.*?\*/)*(?:CREATE|ALTER|DROP)\b', re.I | re.S)
+
 
 class CassandraMigrations(core.MigrationsExecutor):
 
@@ -19,10 +30,13 @@ class CassandraMigrations(core.MigrationsExecutor):
     filename_extensions = ['cql']
 
     TABLE = 'migration'
+    DIGEST_TABLE = 'migration_digest'
 
-    def __init__(self, db_config, repository):
-        core.MigrationsExecutor.__init__(self, db_config, repository)
-        core._assert_values_exist(db_config, 'cqlsh_path', 'pylib_path', 'keyspace', 'cluster_kwargs')
+    def __init__(self, db_config, repository, connection=None):
+        core.MigrationsExecutor.__init__(self, db_config, repository, connection)
+        core._assert_values_exist(db_config, 'cqlsh_path', 'pylib_path', 'keyspace')
+        if connection is None:
+            core._assert_values_exist(db_config, 'cluster_kwargs')
         if db_config['pylib_path'] not in sys.path:
             sys.path.append(db_config['pylib_path'])
 
@@ -36,8 +50,24 @@ class CassandraMigrations(core.MigrationsExecutor):
 
         from cqlshlib import cql3handling
         cqlsh.setup_cqlruleset(cql3handling)
-        
-        self.cluster = cassandra.cluster.Cluster(**self.db_config['cluster_kwargs'])
+
+        self.schema_agreement = db_config.get('schema_agreement', 'statement')
+        if self.schema_agreement not in SCHEMA_AGREEMENT_MODES:
+            raise click.ClickException('Invalid schema_agreement %r, choose one of %s' %
+                                       (self.schema_agreement, SCHEMA_AGREEMENT_MODES))
+        self._duration_column = None
+        if connection is not None:
+            self.cluster = connection
+        else:
+            self.cluster = core.connections.get(
+                core._connection_key('cassandra', self.db_config['cluster_kwargs']),
+                lambda: cassandra.cluster.Cluster(**self.db_config['cluster_kwargs']))
+
+    @classmethod
+    def with_connect_timeout(cls, db_config, seconds):
+        return dict(db_config, cluster_kwargs=dict(db_config.get('cluster_kwargs', {}),
+                                                   connect_timeout=seconds,
+                                                   control_connection_timeout=seconds))
 
     def _session(self):
         return self.cluster.connect(self.db_config['keyspace'])
@@ -47,8 +77,20 @@ class CassandraMigrations(core.MigrationsExecutor):
         session.execute("""CREATE TABLE IF NOT EXISTS {table} (
             file text,
             executed timestamp,
+            duration double,
             PRIMARY KEY (file))
             """.format(table=self.TABLE))
+        if not self._has_duration_column():
+            # a table created by an older version
+            session.execute("""ALTER TABLE {table} ADD duration double""".format(table=self.TABLE))
+            self._duration_column = True
+        session.execute("""CREATE TABLE IF NOT EXISTS {table} (
+            id int,
+            migration_count int,
+            digest text,
+            PRIMARY KEY (id))
+            """.format(table=self.DIGEST_TABLE))
+        self._store_digest(core.migrations_digest(self.fetch_executed_migrations()))
 
     def fetch_executed_migrations(self):
         session = self._session()
@@ -56,25 +98,93 @@ class CassandraMigrations(core.MigrationsExecutor):
         rows.sort(key=lambda row: row.executed)
         return [row.file for row in rows]
 
+    def _has_duration_column(self):
+        if self._duration_column is None:
+            session = self._session()
+            rows = session.execute("""SELECT * FROM {table} LIMIT 1""".format(table=self.TABLE))
+            self._duration_column = 'duration' in rows.column_names
+        return self._duration_column
+
+    def fetch_durations(self):
+        if not self._has_duration_column():
+            return {}
+        session = self._session()
+        rows = session.execute("""SELECT file, duration FROM {table}""".format(table=self.TABLE))
+        return dict((row.file, row.duration) for row in rows if row.duration is not None)
+
+    def fetch_digest(self):
+        session = self._session()
+        try:
+            rows = session.execute("""SELECT migration_count, digest FROM {table}
+                WHERE id = 1""".format(table=self.DIGEST_TABLE))
+        except cassandra.InvalidRequest:
+            # no digest table
+            return None
+        rows = list(rows)
+        return (rows[0].migration_count, rows[0].digest) if rows else None
+
+    def _store_digest(self, digest):
+        session = self._session()
+        session.execute("""INSERT INTO {table} (id, migration_count, digest) VALUES (1, %s, %s)""".\
+                        format(table=self.DIGEST_TABLE), list(digest))
+
     def _migration_success(self, migration_file):
-        migration = os.path.split(migration_file)[1]
+        migration = core._migration_name(migration_file)
         session = self._session()
-        session.execute("""INSERT INTO {table} (file, executed) VALUES (%s, %s)""".\
-                        format(table=self.TABLE),
-                        [migration, datetime.datetime.now()])
+        if self._has_duration_column():
+            session.execute("""INSERT INTO {table} (file, executed, duration) VALUES (%s, %s, %s)""".\
+                            format(table=self.TABLE),
+                            [migration, datetime.datetime.now(), self._migration_duration()])
+        else:
+            session.execute("""INSERT INTO {table} (file, executed) VALUES (%s, %s)""".\
+                            format(table=self.TABLE),
+                            [migration, datetime.datetime.now()])
+        self._update_digest(migration)
+
+    def schema_fingerprint(self):
+        # Cassandra changes the schema version on every schema change in the cluster
+        session = self._session()
+        rows = list(session.execute("""SELECT schema_version FROM system.local"""))
+        return str(rows[0].schema_version)
+
+    @contextlib.contextmanager
+    def _schema_agreement_wait(self, seconds):
+        """Set ``max_schema_agreement_wait`` of the cluster to ``seconds`` (unless it's ``None``)
+        while executing a migration.
+        """
+        if seconds is None:
+            yield
+            return
+        orig_seconds = self.cluster.max_schema_agreement_wait
+        self.cluster.max_schema_agreement_wait = seconds
+        try:
+            yield
+        finally:
+            self.cluster.max_schema_agreement_wait = orig_seconds
+
+    def _wait_for_schema_agreement(self, statement, seconds):
+        log.info('Waiting up to %s seconds for schema agreement', seconds)
+        if not self.cluster.control_connection.wait_for_schema_agreement(wait_time=seconds):
+            msg = 'Schema agreement not reached within %s seconds after executing %r' % \
+                (seconds, statement)
+            log.critical(msg)
+            raise click.ClickException(msg)
 
     def execute_python_migration(self, migration_file, module):
         assert hasattr(module, 'migrate'), 'Python module must have `migrate` function accepting ' \
             'a Cluster object'
-        self._call_migrate(module, self.cluster)
+        with self._schema_agreement_wait(self.db_config.get('schema_agreement_wait')):
+            self._call_migrate(module, self.cluster)
+        if self.record_executed:
+            self._migration_success(migration_file)
+
+    def record_migration(self, migration_file):
         self._migration_success(migration_file)
 
-    def execute_native_migration(self, migration_file):
+    def _extract_statements(self, content):
         import cqlsh
 
-        with open(migration_file) as f:
-            content = f.read()
-        statements, _ = cqlsh.cqlruleset.cql_split_statements(content)
+        statements, in_batch = cqlsh.cqlruleset.cql_split_statements(content)
         to_execute = []
         for statement in statements:
             if not statement:
@@ -85,17 +195,63 @@ class CassandraMigrations(core.MigrationsExecutor):
             if not extracted:
                 continue
             to_execute.append(extracted)
+        return to_execute, in_batch
+
+    def _iter_statements(self, f):
+        """Yield CQL statements from a file object ``f``, without reading the whole file
+        into memory.
+        """
+        chunks = []
+        for chunk in core._statement_chunks(f, cql=True, min_size=0):
+            chunks.append(chunk)
+            if len(chunks) > 1 and APPLY_BATCH_RE.search(chunk) is None:
+                # inside a batch, which must be split as a whole once it's applied
+                continue
+            to_execute, in_batch = self._extract_statements(''.join(chunks))
+            if in_batch:
+                continue
+            for statement in to_execute:
+                yield statement
+            chunks = []
+        if chunks:
+            for statement in self._extract_statements(''.join(chunks))[0]:
+                yield statement
+
+    def execute_native_migration(self, migration_file):
+        with self._native_statements(migration_file) as statements:
+            return self._execute_statements(migration_file,
+                                            core.profiler.timed_iter('parse', statements))
+
+    def _execute_statements(self, migration_file, to_execute):
+        wait = self.db_config.get('schema_agreement_wait')
+        batch = self.schema_agreement == 'batch'
+        if batch:
+            # the driver doesn't wait, a single check is done after a run of DDL statements
+            agreement_wait = self.cluster.max_schema_agreement_wait if wait is None else wait
+            wait = 0
         session = self._session()
-        for statement in to_execute:
-            log.info('Executing CQL: <<%s>>', core._simplify_whitespace(statement))
-            try:
-                session.execute(statement)
-            except cassandra.protocol.ErrorMessage as e:
-                click.echo('Error while executing statement %r' % statement)
-                click.echo(repr(e))
-                return
-            except:
-                log.exception('While executing statement %r', statement)
-                raise
+        unagreed_ddl = None
+        with self._schema_agreement_wait(wait):
+            for statement in to_execute:
+                is_ddl = batch and DDL_RE.match(statement) is not None
+                if unagreed_ddl is not None and not is_ddl:
+                    self._wait_for_schema_agreement(unagreed_ddl, agreement_wait)
+                    unagreed_ddl = None
+                if log.isEnabledFor(logging.INFO):
+                    log.info('Executing CQL: <<%s>>', core._statement_for_log(statement))
+                try:
+                    session.execute(statement)
+                except cassandra.protocol.ErrorMessage as e:
+                    log.error('Error while executing statement %r: %r', statement, e)
+                    click.echo('Error while executing statement %r' % statement)
+                    click.echo(repr(e))
+                    return False
+                except:
+                    log.exception('While executing statement %r', statement)
+                    raise
+                if is_ddl:
+                    unagreed_ddl = statement
+            if unagreed_ddl is not None:
+                self._wait_for_schema_agreement(unagreed_ddl, agreement_wait)
         self._migration_success(migration_file)
 
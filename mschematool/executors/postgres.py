@@ -1,5 +1,15 @@
 import logging
+import math
 import os
+import time
+import copy
+import contextlib
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import click
 import psycopg2
@@ -11,6 +21,10 @@ from mschematool import core
 log = core.log
 
 
+def _quote_ident(name):
+    return '"%s"' % name.replace('"', '""')
+
+
 class PostgresLoggingDictCursor(psycopg2.extras.DictCursor):
     """Postgres cursor subclass: log all SQL executed in the database.
     """
@@ -20,8 +34,9 @@ class PostgresLoggingDictCursor(psycopg2.extras.DictCursor):
 
     def execute(self, sql, args=None):
         if log.isEnabledFor(logging.INFO):
-            realsql = self.mogrify(sql, args)
-            log.info('Executing SQL: <<%s>>', core._simplify_whitespace(realsql))
+            # mogrify is needed only for substituting arguments
+            realsql = sql if args is None else self.mogrify(sql, args)
+            log.info('Executing SQL: <<%s>>', core._statement_for_log(realsql))
         try:
             psycopg2.extras.DictCursor.execute(self, sql, args)
         except:
@@ -29,30 +44,364 @@ class PostgresLoggingDictCursor(psycopg2.extras.DictCursor):
             raise
 
 
+# Views reporting progress of commands, with (done, total, unit) column triples
+# in order of preference. Views missing in older PostgreSQL versions are skipped.
+PROGRESS_VIEWS = [
+    ('pg_stat_progress_create_index', [('blocks_done', 'blocks_total', 'blocks'),
+                                       ('tuples_done', 'tuples_total', 'tuples')]),
+    ('pg_stat_progress_cluster', [('heap_blks_scanned', 'heap_blks_total', 'blocks'),
+                                  ('heap_tuples_written', None, 'tuples')]),
+    ('pg_stat_progress_vacuum', [('heap_blks_scanned', 'heap_blks_total', 'blocks')]),
+    ('pg_stat_progress_analyze', [('sample_blks_scanned', 'sample_blks_total', 'blocks')]),
+    ('pg_stat_progress_copy', [('bytes_processed', 'bytes_total', 'bytes'),
+                               ('tuples_processed', None, 'tuples')]),
+]
+
+
+class ProgressMonitor(threading.Thread):
+    """A thread reporting progress of statements executed by a backend ``pid``,
+    polling progress views and ``pg_locks`` every ``interval`` seconds using a separate
+    connection. Errors are logged and stop the monitor without affecting a migration.
+    """
+
+    def __init__(self, dsn, pid, interval):
+        threading.Thread.__init__(self, name='mschematool-progress')
+        self.daemon = True
+        self.dsn = dsn
+        self.pid = pid
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._previous = {}
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        try:
+            conn = psycopg2.connect(self.dsn)
+        except psycopg2.Error as e:
+            log.warning('Cannot connect for monitoring progress: %s', e)
+            return
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("""SELECT current_setting('block_size')::int""")
+                self.block_size = cur.fetchone()[0]
+                cur.execute("""SELECT v FROM unnest(%s::text[]) v WHERE to_regclass(v) IS NOT NULL""",
+                            [[view for view, _ in PROGRESS_VIEWS]])
+                available = set(row[0] for row in cur.fetchall())
+            self.views = [(view, columns) for view, columns in PROGRESS_VIEWS if view in available]
+            while not self._stopped.wait(self.interval):
+                for line in self.report(conn):
+                    log.info('Progress: %s', line)
+                    click.echo('  [progress] %s' % line)
+        except psycopg2.Error as e:
+            log.warning('Stopped monitoring progress: %s', e)
+        finally:
+            conn.close()
+
+    def report(self, conn):
+        """Return lines describing the current state of the monitored backend.
+        """
+        lines = []
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("""SELECT state, wait_event_type, wait_event,
+                extract(epoch FROM now() - query_start) AS elapsed, left(query, 60) AS query
+                FROM pg_stat_activity WHERE pid = %s""", [self.pid])
+            activity = cur.fetchone()
+            if activity is None or activity['state'] != 'active':
+                return lines
+            line = '%s running %s' % (core.format_duration(activity['elapsed'] or 0),
+                                      ' '.join(activity['query'].split()))
+            if activity['wait_event']:
+                line += ', waiting for %s %s' % (activity['wait_event_type'], activity['wait_event'])
+            lines.append(line)
+            for view, columns in self.views:
+                cur.execute("""SELECT * FROM {view} WHERE pid = %s""".format(view=view), [self.pid])
+                row = cur.fetchone()
+                if row is not None:
+                    lines.append(self._describe_progress(view, columns, row))
+            cur.execute("""SELECT l.locktype, l.mode, l.relation::regclass::text AS relation,
+                pg_blocking_pids(l.pid) AS blocking
+                FROM pg_locks l WHERE l.pid = %s AND NOT l.granted""", [self.pid])
+            for lock in cur.fetchall():
+                lines.append('waiting for %s on %s %s, blocked by %s' % (
+                    lock['mode'], lock['locktype'], lock['relation'] or '',
+                    ', '.join(str(pid) for pid in lock['blocking']) or 'unknown'))
+        return lines
+
+    def _describe_progress(self, view, columns, row):
+        parts = [row.get('command') or view[len('pg_stat_progress_'):].upper()]
+        if row.get('phase'):
+            parts.append(row['phase'])
+        for done_column, total_column, unit in columns:
+            done = row.get(done_column)
+            if not done:
+                continue
+            total = row.get(total_column) if total_column else None
+            if total:
+                parts.append('%s %d/%d (%.1f%%)' % (unit, done, total, 100.0 * done / total))
+            else:
+                parts.append('%s %d' % (unit, done))
+            now = time.time()
+            previous = self._previous.get((view, done_column))
+            self._previous[(view, done_column)] = (now, done)
+            if previous is not None and done >= previous[1]:
+                rate = (done - previous[1]) / (now - previous[0])
+                if unit == 'blocks':
+                    parts.append('%.1f MB/s' % (rate * self.block_size / 1024 / 1024))
+                elif unit == 'bytes':
+                    parts.append('%.1f MB/s' % (rate / 1024 / 1024))
+                else:
+                    parts.append('%.0f tuples/s' % rate)
+            break
+        return ', '.join(parts)
+
+
+# Lag (in seconds) of the slowest replica, read on a primary
+PRIMARY_LAG_QUERY = """SELECT max(extract(epoch FROM replay_lag)) FROM pg_stat_replication"""
+# Lag of a replica. A replica which replayed everything it received isn't lagging,
+# even if nothing was committed on the primary for a while.
+REPLICA_LAG_QUERY = """SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"""
+
+
+class ReplicationLagGovernor(object):
+    """Pauses execution of migrations while replication lag is above ``max_lag`` seconds.
+    Lag is read from ``pg_stat_replication`` on the primary ``dsn`` or, if ``replica_dsns``
+    are given, from the replicas, using separate connections. ``query`` returning a lag
+    in seconds replaces the built-in queries. Lag is checked at most every ``interval``
+    seconds. When it can't be read, a warning is logged and execution continues.
+    """
+
+    def __init__(self, dsn, replica_dsns, max_lag, interval, query=None):
+        self.max_lag = max_lag
+        self.interval = interval
+        if replica_dsns:
+            self.sources = [(replica_dsn, query or REPLICA_LAG_QUERY) for replica_dsn in replica_dsns]
+        else:
+            self.sources = [(dsn, query or PRIMARY_LAG_QUERY)]
+        self.throttled = 0.0
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _connect(self, dsn):
+        conn = psycopg2.connect(dsn)
+        conn.autocommit = True
+        return conn
+
+    def lag(self):
+        """Return the highest lag of all sources, in seconds.
+        """
+        lags = [0.0]
+        for dsn, query in self.sources:
+            # a separate connection even for the primary, outside of a migration transaction
+            conn = core.connections.get(core._connection_key('postgres', dsn, 'replication lag'),
+                                        lambda: self._connect(dsn))
+            with conn.cursor() as cur:
+                cur.execute(query)
+                row = cur.fetchone()
+            if row is not None and row[0] is not None:
+                lags.append(float(row[0]))
+        return max(lags)
+
+    def _lag_or_none(self):
+        try:
+            return self.lag()
+        except psycopg2.Error as e:
+            log.warning('Cannot read replication lag, not throttling: %s', e)
+            return None
+
+    def wait(self):
+        """Return when replication lag is below the threshold, sleeping while it isn't.
+        """
+        if time.time() - self._checked < self.interval:
+            return
+        self._checked = time.time()
+        lag = self._lag_or_none()
+        if lag is None or lag <= self.max_lag:
+            return
+        msg = 'Replication lag %.1fs is above %ss, pausing' % (lag, self.max_lag)
+        log.info(msg)
+        click.echo('  [throttle] %s' % msg)
+        started = time.time()
+        with core.profiler.phase('throttle'):
+            while lag is not None and lag > self.max_lag:
+                time.sleep(self.interval)
+                lag = self._lag_or_none()
+        paused = time.time() - started
+        with self._lock:
+            self.throttled += paused
+        self._checked = time.time()
+        log.info('Replication lag is below %ss, resuming after %s', self.max_lag,
+                 core.format_duration(paused))
+
+
+def _throttled_cursor_class(base, governor):
+    """Return a subclass of cursor class ``base`` waiting for ``governor`` before executing
+    statements. It's used as a ``cursor_factory`` of a connection passed to Python migrations.
+    """
+    class ThrottledCursor(base):
+
+        def execute(self, sql, args=None):
+            governor.wait()
+            return base.execute(self, sql, args)
+
+        def executemany(self, sql, args_list):
+            governor.wait()
+            return base.executemany(self, sql, args_list)
+
+    return ThrottledCursor
+
+
+DEFAULT_REPLICATION_LAG_INTERVAL = 1.0
+# `search_path` of tenant migrations; objects of extensions are usually installed in public
+DEFAULT_TENANT_SEARCH_PATH = '{schema}, public'
+
+# SQLSTATE of an error raised when cloning a database used by other sessions
+OBJECT_IN_USE = '55006'
+# SQLSTATE of an error raised when querying a table which doesn't exist
+UNDEFINED_TABLE = '42P01'
+
+
+def _reset_session(conn):
+    """Reset settings changed by migrations using SET, so they don't leak into migrations
+    of other dbnicks sharing the connection.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""RESET ALL""")
+    conn.commit()
+
+
 class PostgresMigrations(core.MigrationsExecutor):
 
     engine = 'postgres'
     filename_extensions = ['sql']
 
-    def __init__(self, db_config, repository):
-        core.MigrationsExecutor.__init__(self, db_config, repository)
-        self.conn = psycopg2.connect(self.db_config['dsn'])
-        self.migration_table = self.db_config.get('migration_table', 'public.migration')
+    def __init__(self, db_config, repository, connection=None):
+        core.MigrationsExecutor.__init__(self, db_config, repository, connection)
+        if connection is not None:
+            self.conn_key = None
+            self.conn = connection
+        else:
+            self.conn_key = core._connection_key('postgres', self.db_config['dsn'])
+            self.conn = core.connections.get(self.conn_key, self._connect, reuse=_reset_session)
+        self.schema = None
+        self._duration_column = None
+        self._single_transaction = False
+        self.fanout = 'schemas' in self.db_config or 'schemas_query' in self.db_config
+
+        if self.fanout:
+            # the table is created inside each tenant schema
+            self.migration_table = self.db_config.get('migration_table', 'migration')
+            if '.' in self.migration_table:
+                msg = "Migration table name '%s' must not include schema when `schemas` " \
+                    "or `schemas_query` is specified" % self.migration_table
+                log.critical(msg)
+                raise click.ClickException(msg)
+        else:
+            self.migration_table = self.db_config.get('migration_table', 'public.migration')
+            if '.' not in self.migration_table:
+                msg = "Migration table name '%s' must include schema" % self.migration_table
+                log.critical(msg)
+                raise click.ClickException(msg)
+        self.digest_table = self.migration_table + '_digest'
+        # known after the first read of the digest table, which doesn't exist in databases
+        # initialized by older versions
+        self._digest_table_exists = None
+        # side connections need a DSN with a password, which isn't available from
+        # a connection passed by a caller (psycopg2 masks it in `conn.dsn`)
+        dsn = self.db_config.get('dsn')
+        if self.db_config.get('progress_interval') and dsn is None:
+            log.warning('`progress_interval` requires `dsn` in the config, progress is not reported')
+        self.governor = None
+        if self.db_config.get('max_replication_lag') is not None and dsn is None and \
+                not self.db_config.get('replica_dsns'):
+            log.warning('`max_replication_lag` requires `dsn` or `replica_dsns` in the config, '
+                        'migrations are not throttled')
+        elif self.db_config.get('max_replication_lag') is not None:
+            self.governor = ReplicationLagGovernor(
+                dsn, self.db_config.get('replica_dsns'),
+                self.db_config['max_replication_lag'],
+                self.db_config.get('replication_lag_interval', DEFAULT_REPLICATION_LAG_INTERVAL),
+                self.db_config.get('replication_lag_query'))
 
-        if '.' not in self.migration_table:
-            msg = "Migration table name '%s' must include schema" % self.migration_table
-            log.critical(msg)
-            raise click.ClickException(msg)
+    @property
+    def throttled(self):
+        return self.governor.throttled if self.governor is not None else 0.0
+
+    @classmethod
+    def with_connect_timeout(cls, db_config, seconds):
+        # a server accepting connections can still hang on a query (e.g. waiting for a lock)
+        return dict(db_config, connect_timeout=seconds, statement_timeout=seconds)
+
+    def _connect(self):
+        kwargs = {}
+        if self.db_config.get('connect_timeout') is not None:
+            # libpq accepts whole seconds only
+            kwargs['connect_timeout'] = max(int(math.ceil(self.db_config['connect_timeout'])), 1)
+        if self.db_config.get('statement_timeout') is not None:
+            # appended to options of the DSN, which would be replaced by the argument
+            options = psycopg2.extensions.parse_dsn(self.db_config['dsn']).get('options', '')
+            kwargs['options'] = ('%s -c statement_timeout=%d' % (
+                options, max(int(self.db_config['statement_timeout'] * 1000), 1))).strip()
+        return psycopg2.connect(self.db_config['dsn'], **kwargs)
 
     def cursor(self):
         return self.conn.cursor(cursor_factory=PostgresLoggingDictCursor)
 
+    def fetch_schemas(self):
+        """Return tenant schemas of a fan-out dbnick, specified by `schemas` or returned
+        by `schemas_query`.
+        """
+        if 'schemas' in self.db_config:
+            return list(self.db_config['schemas'])
+        with self.cursor() as cur:
+            cur.execute(self.db_config['schemas_query'])
+            schemas = [row[0] for row in cur.fetchall()]
+        self.conn.commit()
+        return schemas
+
+    def for_schema(self, schema, conn):
+        """Return an executor tracking migrations of a single tenant ``schema``,
+        executing them on ``conn`` with ``search_path`` starting with the schema.
+        """
+        executor = copy.copy(self)
+        executor.fanout = False
+        executor.schema = schema
+        executor.migration_table = '%s.%s' % (_quote_ident(schema), self.migration_table)
+        executor.digest_table = executor.migration_table + '_digest'
+        executor._digest_table_exists = None
+        executor._duration_column = None
+        if conn is not self.conn:
+            executor.conn = conn
+            executor.conn_key = None
+        return executor
+
+    def targets(self):
+        if not self.fanout:
+            return [(None, self)]
+        return [(schema, self.for_schema(schema, self.conn)) for schema in self.fetch_schemas()]
+
     def initialize(self):
         with self.cursor() as cur:
             cur.execute("""CREATE TABLE IF NOT EXISTS {table} (
                 file TEXT,
-                executed TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                executed TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                duration DOUBLE PRECISION
             )""".format(table=self.migration_table))
+            # tables created by older versions don't have the column
+            cur.execute("""ALTER TABLE {table} ADD COLUMN IF NOT EXISTS duration DOUBLE PRECISION""".\
+                        format(table=self.migration_table))
+            self._duration_column = True
+            cur.execute("""CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY,
+                migration_count INTEGER NOT NULL,
+                digest TEXT NOT NULL
+            )""".format(table=self.digest_table))
+            self._store_digest(core.migrations_digest(self.fetch_executed_migrations()))
+            self._digest_table_exists = True
             cur.connection.commit()
 
     def fetch_executed_migrations(self):
@@ -61,26 +410,432 @@ class PostgresMigrations(core.MigrationsExecutor):
             ORDER BY executed""".format(table=self.migration_table))
             return [row[0] for row in cur.fetchall()]
 
+    def _has_duration_column(self):
+        if self._duration_column is None:
+            with self.cursor() as cur:
+                cur.execute("""SELECT EXISTS(SELECT * FROM pg_attribute
+                WHERE attrelid = to_regclass(%s) AND attname = 'duration'
+                AND NOT attisdropped)""", [self.migration_table])
+                self._duration_column = cur.fetchone()[0]
+        return self._duration_column
+
+    def fetch_durations(self):
+        if not self._has_duration_column():
+            return {}
+        with self.cursor() as cur:
+            cur.execute("""SELECT file, duration FROM {table}
+            WHERE duration IS NOT NULL""".format(table=self.migration_table))
+            return dict((row[0], row[1]) for row in cur.fetchall())
+
+    def fetch_digest(self):
+        # an error aborts the transaction, so a savepoint is needed only when it was
+        # already started (by a caller's connection)
+        savepoint = self.conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        with self.cursor() as cur:
+            if savepoint:
+                cur.execute("""SAVEPOINT mschematool_digest""")
+            try:
+                cur.execute("""SELECT migration_count, digest FROM {table}
+                WHERE id = 1""".format(table=self.digest_table))
+            except psycopg2.Error as e:
+                if e.pgcode != UNDEFINED_TABLE:
+                    raise
+                # created by an older version, without the digest table
+                if savepoint:
+                    cur.execute("""ROLLBACK TO SAVEPOINT mschematool_digest""")
+                else:
+                    self.conn.rollback()
+                self._digest_table_exists = False
+                return None
+            row = cur.fetchone()
+            if savepoint:
+                cur.execute("""RELEASE SAVEPOINT mschematool_digest""")
+        self._digest_table_exists = True
+        return tuple(row) if row else None
+
+    def _store_digest(self, digest):
+        with self.cursor() as cur:
+            cur.execute("""INSERT INTO {table} (id, migration_count, digest) VALUES (1, %s, %s)
+            ON CONFLICT (id) DO UPDATE
+            SET migration_count = EXCLUDED.migration_count, digest = EXCLUDED.digest""".\
+                        format(table=self.digest_table), list(digest))
+
+    def _update_digest(self, migration):
+        """Add ``migration`` to the stored digest using a single atomic ``UPDATE``, so
+        concurrent syncs don't lose updates. The hash is added modulo 2 ** 64 in
+        ``numeric`` arithmetic, after shifting the signed value of ``bit(64)::bigint``.
+        """
+        if self._digest_table_exists is None:
+            with self.cursor() as cur:
+                cur.execute("""SELECT to_regclass(%s) IS NOT NULL""", [self.digest_table])
+                self._digest_table_exists = cur.fetchone()[0]
+        if not self._digest_table_exists:
+            return
+        with self.cursor() as cur:
+            cur.execute("""UPDATE {table} SET migration_count = migration_count + 1,
+            digest = lpad(to_hex(((('x' || digest)::bit(64)::bigint::numeric + %s
+                                   + 27670116110564327424) %% 18446744073709551616
+                                  - 9223372036854775808)::bigint), 16, '0')
+            WHERE id = 1""".format(table=self.digest_table), [core._migration_hash(migration)])
+
     def _migration_success(self, migration_file):
-        migration = os.path.split(migration_file)[1]
+        migration = core._migration_name(migration_file)
+        with self.cursor() as cur:
+            if self._has_duration_column():
+                cur.execute("""INSERT INTO {table} (file, duration) VALUES (%s, %s)""".\
+                            format(table=self.migration_table),
+                            [migration, self._migration_duration()])
+            else:
+                cur.execute("""INSERT INTO {table} (file) VALUES (%s)""".format(table=self.migration_table),
+                        [migration])
+        self._update_digest(migration)
+
+    def schema_fingerprint(self):
+        with self.cursor() as cur:
+            cur.execute("""SELECT md5(coalesce(string_agg(item, E'\\n' ORDER BY item), '')) FROM (
+                SELECT 'rel ' || c.oid::regclass::text || ' ' || c.relkind::text || ' ' ||
+                    coalesce(pg_get_viewdef(c.oid), '') AS item
+                FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+                    AND n.nspname NOT LIKE 'pg\_toast%' AND n.nspname NOT LIKE 'pg\_temp%'
+                UNION ALL
+                SELECT 'col ' || a.attrelid::regclass::text || ' ' || a.attname || ' ' ||
+                    format_type(a.atttypid, a.atttypmod) || ' ' || a.attnotnull::text || ' ' ||
+                    coalesce(pg_get_expr(d.adbin, d.adrelid), '')
+                FROM pg_attribute a
+                JOIN pg_class c ON c.oid = a.attrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+                WHERE a.attnum > 0 AND NOT a.attisdropped
+                    AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                    AND n.nspname NOT LIKE 'pg\_toast%' AND n.nspname NOT LIKE 'pg\_temp%'
+                UNION ALL
+                SELECT 'con ' || co.conrelid::regclass::text || ' ' || co.conname || ' ' ||
+                    pg_get_constraintdef(co.oid)
+                FROM pg_constraint co JOIN pg_namespace n ON n.oid = co.connamespace
+                WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+                UNION ALL
+                SELECT 'idx ' || pg_get_indexdef(i.indexrelid)
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+                    AND n.nspname NOT LIKE 'pg\_toast%'
+                UNION ALL
+                SELECT 'trg ' || pg_get_triggerdef(t.oid)
+                FROM pg_trigger t WHERE NOT t.tgisinternal
+                UNION ALL
+                SELECT 'fun ' || p.oid::regprocedure::text || ' ' || md5(coalesce(p.prosrc, ''))
+                FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace
+                WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+                UNION ALL
+                SELECT 'typ ' || t.oid::regtype::text || ' ' || t.typtype::text || ' ' ||
+                    coalesce((SELECT string_agg(e.enumlabel, ',' ORDER BY e.enumsortorder)
+                              FROM pg_enum e WHERE e.enumtypid = t.oid), '')
+                FROM pg_type t JOIN pg_namespace n ON n.oid = t.typnamespace
+                WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+                    AND t.typtype IN ('c', 'd', 'e', 'r')
+                UNION ALL
+                SELECT 'nsp ' || nspname FROM pg_namespace
+            ) items""")
+            fingerprint = cur.fetchone()[0]
+        self.conn.commit()
+        return fingerprint
+
+    def _begin(self):
+        self._migration_started = time.time()
+        if self.schema is not None:
+            with self.cursor() as cur:
+                cur.execute("""SELECT set_config('search_path', %s, false)""",
+                            [self.db_config.get('tenant_search_path', DEFAULT_TENANT_SEARCH_PATH).\
+                             format(schema=_quote_ident(self.schema))])
+
+    def table_sizes(self, tables):
+        sizes = {}
         with self.cursor() as cur:
-            cur.execute("""INSERT INTO {table} (file) VALUES (%s)""".format(table=self.migration_table),
-                    [migration])
+            for table in tables:
+                # reltuples is -1 for tables never vacuumed or analyzed
+                cur.execute("""SELECT pg_total_relation_size(c.oid), greatest(c.reltuples, 0)::bigint
+                    FROM pg_class c WHERE c.oid = to_regclass(%s)""", [table])
+                row = cur.fetchone()
+                if row is not None:
+                    sizes[table] = (row[0], row[1])
+        self.conn.commit()
+        return sizes
+
+    def held_locks(self):
+        # only locks which block writes or DDL, on tables outside of system schemas
+        with self.conn.cursor() as cur:
+            cur.execute("""SELECT l.mode || ' on ' || n.nspname || '.' || c.relname
+                FROM pg_locks l JOIN pg_class c ON c.oid = l.relation
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE l.pid = pg_backend_pid() AND l.granted AND l.mode <> 'AccessShareLock'
+                AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                AND n.nspname NOT LIKE 'pg\_toast%'""")
+            return [row[0] for row in cur.fetchall()]
+
+    @contextlib.contextmanager
+    def rehearsal_clone(self):
+        """Create a clone using ``CREATE DATABASE ... TEMPLATE``, connecting to
+        the `maintenance_db` database (default ``postgres``). PostgreSQL requires that
+        no other sessions are connected to the cloned database.
+        """
+        if self.conn_key is None:
+            raise click.ClickException('Rehearsing requires a database specified by `dsn`')
+        with self.cursor() as cur:
+            cur.execute("""SELECT current_database()""")
+            source = cur.fetchone()[0]
+        # the template database must not be used by any session
+        self.conn.close()
+        clone = '%s_rehearse_%d' % (source[:40], os.getpid())
+        dsn = self.db_config['dsn']
+        admin = psycopg2.connect(psycopg2.extensions.make_dsn(
+            dsn, dbname=self.db_config.get('maintenance_db', 'postgres')))
+        admin.autocommit = True
+        try:
+            with admin.cursor() as cur, core.profiler.phase('clone'):
+                try:
+                    cur.execute("""CREATE DATABASE {clone} TEMPLATE {source}""".format(
+                        clone=_quote_ident(clone), source=_quote_ident(source)))
+                except psycopg2.Error as e:
+                    if e.pgcode != OBJECT_IN_USE:
+                        raise
+                    raise click.ClickException('Cannot clone %s, it must not be used by other '
+                                               'sessions: %s' % (source, str(e).strip()))
+            log.info('Created %s as a clone of %s', clone, source)
+            try:
+                yield dict(self.db_config, dsn=psycopg2.extensions.make_dsn(dsn, dbname=clone))
+            finally:
+                with admin.cursor() as cur:
+                    cur.execute("""DROP DATABASE IF EXISTS {clone}""".format(
+                        clone=_quote_ident(clone)))
+                log.info('Dropped %s', clone)
+        finally:
+            admin.close()
+            self.conn = self._connect()
+            core.connections.replace(self.conn_key, self.conn)
+
+    def _commit(self):
+        if self._single_transaction:
+            # committed by single_transaction()
+            return
+        self.conn.commit()
+        self._committed()
+        if core.connections.is_shared(self.conn_key):
+            # executors of other dbnicks sharing the connection already exist
+            _reset_session(self.conn)
+
+    @contextlib.contextmanager
+    def _progress_monitor(self):
+        """Run a :class:`ProgressMonitor` for the migration connection when `progress_interval`
+        is set (except for tenants of a fan-out dbnick and configs without `dsn`).
+        """
+        interval = self.db_config.get('progress_interval')
+        if not interval or self.schema is not None or self.db_config.get('dsn') is None:
+            yield
+            return
+        monitor = ProgressMonitor(self.db_config['dsn'], self.conn.get_backend_pid(), interval)
+        monitor.start()
+        try:
+            yield
+        finally:
+            monitor.stop()
+
+    @contextlib.contextmanager
+    def _throttled_cursors(self):
+        """Make cursors created by a Python migration wait for the governor, when
+        `max_replication_lag` is set.
+        """
+        if self.governor is None:
+            yield
+            return
+        cursor_factory = self.conn.cursor_factory
+        self.conn.cursor_factory = _throttled_cursor_class(
+            cursor_factory or psycopg2.extensions.cursor, self.governor)
+        try:
+            yield
+        finally:
+            self.conn.cursor_factory = cursor_factory
+
+    def _throttle(self):
+        if self.governor is not None:
+            self.governor.wait()
 
     def execute_python_migration(self, migration_file, module):
         assert hasattr(module, 'migrate'), 'Python module must have `migrate` function accepting ' \
             'a database connection'
-        self._call_migrate(module, self.conn)
+        try:
+            self._begin()
+            started = time.time()
+            with self._progress_monitor(), self._throttled_cursors():
+                self._call_migrate(module, self.conn)
+            self._statement_executed('migrate() of %s' % os.path.basename(migration_file), started)
+            if self.record_executed:
+                self._migration_success(migration_file)
+        except:
+            self.conn.rollback()
+            raise
+        self._commit()
+
+    def record_migration(self, migration_file):
+        try:
+            self._migration_success(migration_file)
+        except:
+            self.conn.rollback()
+            raise
+        self._commit()
+
+    def worker_config(self):
+        if self.schema is None:
+            return self.db_config
+        # a fan-out config with the single schema of this executor
+        return dict(self.db_config, schemas=[self.schema])
+
+    def _execute_statements(self, migration_file, statements):
+        try:
+            self._begin()
+            for statement, originals in self._coalesced(statements):
+                self._throttle()
+                started = time.time()
+                with self.cursor() as cur:
+                    if len(originals) == 1:
+                        cur.execute(statement)
+                    else:
+                        self._execute_merged(cur, statement, originals)
+                self._statement_executed(statement, started)
+            self._migration_success(migration_file)
+        except:
+            self.conn.rollback()
+            raise
+        self._commit()
+
+    def _execute_merged(self, cur, statement, originals):
+        cur.execute("""SAVEPOINT mschematool_merged""")
+        try:
+            cur.execute(statement)
+        except psycopg2.Error:
+            cur.execute("""ROLLBACK TO SAVEPOINT mschematool_merged""")
+            # the failing statement will raise the same error as without merging
+            for original in originals:
+                cur.execute(original)
+        cur.execute("""RELEASE SAVEPOINT mschematool_merged""")
+
+    def _execute_autocommit(self, migration_file, statements):
+        """Execute statements of a migration marked as non-transactional, each
+        in its own transaction (e.g. ``CREATE INDEX CONCURRENTLY``).
+        """
+        self.conn.rollback()
+        self.conn.autocommit = True
+        try:
+            self._begin()
+            for statement in statements:
+                self._throttle()
+                started = time.time()
+                with self.cursor() as cur:
+                    cur.execute(statement)
+                self._statement_executed(statement, started)
+        finally:
+            self.conn.autocommit = False
         self._migration_success(migration_file)
-        self.conn.commit()
+        self._commit()
 
     def execute_native_migration(self, migration_file):
-        with open(migration_file) as f:
-            content = f.read()
-        for statement in core._sqlfile_to_statements(content):
-            with self.cursor() as cur:
-                cur.execute(statement)
-        self._migration_success(migration_file)
-        self.conn.commit()
+        with self._native_statements(migration_file) as statements, self._progress_monitor():
+            if self.repository.is_non_transactional(migration_file):
+                self._execute_autocommit(migration_file, statements)
+            else:
+                self._execute_statements(migration_file, statements)
+
+    @contextlib.contextmanager
+    def single_transaction(self, migrations):
+        """Execute migrations in a single transaction, with one commit when
+        the context exits. Everything is rolled back on an exception.
+        Migrations marked as non-transactional are rejected before executing anything.
+        """
+        marked = [migration for migration in migrations
+                  if self.repository.is_non_transactional(self.repository.migration_path(migration))]
+        if marked:
+            raise click.ClickException('Migrations marked as non-transactional can\'t be executed '
+                                       'in a single transaction: %s' % ', '.join(marked))
+        if self.db_config.get('python_migration_worker') and \
+                any(self.repository.migration_type(migration) == 'py' for migration in migrations):
+            raise click.ClickException('Python migrations executed in worker processes '
+                                       '(`python_migration_worker`) can\'t be executed in a single '
+                                       'transaction')
+        self._single_transaction = True
+        try:
+            yield
+        except:
+            self._single_transaction = False
+            self.conn.rollback()
+            raise
+        self._single_transaction = False
+        self._commit()
+
+    def sync_fanout(self):
+        """Sync all tenant schemas using a pool of `fanout_connections` connections.
+        Each pending migration is parsed (or imported) only once, unless Python migrations
+        are executed by workers of `python_migration_worker`.
+        """
+        schemas = self.fetch_schemas()
+        if not schemas:
+            return
+        prepared = {}
+        prepared_lock = threading.Lock()
+
+        def prepare(migration):
+            with prepared_lock:
+                if migration not in prepared:
+                    migration_file = self.repository.migration_path(migration)
+                    if self.repository.migration_type(migration_file) == 'py':
+                        prepared[migration] = self.repository.load_module(migration_file)
+                    else:
+                        with self.repository.open_migration(migration_file) as f:
+                            prepared[migration] = list(self._iter_statements(f))
+                return prepared[migration]
+
+        pool_size = min(self.db_config.get('fanout_connections', 4), len(schemas))
+        conns = queue.Queue()
+        for _ in range(pool_size):
+            conns.put(self._connect())
+
+        def sync_schema(schema):
+            conn = conns.get()
+            executed = []
+            migration = None
+            try:
+                executor = self.for_schema(schema, conn)
+                with core.profiler.phase('fetch executed migrations'):
+                    executed_before = executor.fetch_executed_migrations()
+                to_execute = self.repository.get_migrations(exclude=executed_before)
+                for migration in to_execute:
+                    log.info('Executing %s in schema %s', migration, schema)
+                    migration_file = self.repository.migration_path(migration)
+                    if self.repository.migration_type(migration_file) == 'native':
+                        # handles migrations marked as non-transactional
+                        executor.execute_migration(migration, prepare(migration))
+                    elif self.db_config.get('python_migration_worker'):
+                        # the worker process imports the migration itself
+                        executor.execute_migration(migration)
+                    else:
+                        with core.profiler.phase('execute'):
+                            executor.execute_python_migration(migration_file, prepare(migration))
+                    executed.append(migration)
+                return schema, executed, None
+            except Exception as e:
+                log.exception('While syncing schema %s', schema)
+                conn.rollback()
+                return schema, executed, (migration, e)
+            finally:
+                conns.put(conn)
+
+        pool = ThreadPool(pool_size)
+        try:
+            for result in pool.imap(sync_schema, schemas):
+                yield result
+        finally:
+            pool.terminate()
+            while not conns.empty():
+                conns.get().close()
 
 
@@ -1,8 +1,18 @@
 import logging
 import os
+import copy
+import glob
+import contextlib
+import hashlib
+import multiprocessing
+import stat
+import time
+import tempfile
 
 import sqlite3
 
+import click
+
 from mschematool import core
 
 
@@ -18,7 +28,7 @@ class Sqlite3LoggingCursor(sqlite3.Cursor):
 
     def execute(self, sql, *args):
         if log.isEnabledFor(logging.INFO):
-            log.info('Executing SQL: <<%s>> with args: <<%s>>', core._simplify_whitespace(sql), args)
+            log.info('Executing SQL: <<%s>> with args: <<%s>>', core._statement_for_log(sql), args)
         try:
             sqlite3.Cursor.execute(self, sql, *args)
         except:
@@ -26,21 +36,81 @@ class Sqlite3LoggingCursor(sqlite3.Cursor):
             raise
 
 
+# Files created by SQLite next to a database file
+JOURNAL_SUFFIXES = ('-journal', '-wal', '-shm')
+
+# A suffix of a copy of a database migrated by Sqlite3Migrations.shadow_swap
+SHADOW_SUFFIX = '.mschematool-shadow'
+# Pages copied in a single step, so writers aren't blocked while copying a big database
+SHADOW_BACKUP_PAGES = 1024
+
+
 class Sqlite3Migrations(core.MigrationsExecutor):
 
     engine = 'sqlite3'
     filename_extensions = ['sql']
 
     TABLE = 'migration'
+    DIGEST_TABLE = 'migration_digest'
 
-    def __init__(self, db_config, repository):
-        core.MigrationsExecutor.__init__(self, db_config, repository)
-        self.conn = sqlite3.connect(self.db_config['database'], **db_config.get('connect_kwargs', {}))
-        # Ensure we return dict/tuple-based access instead of just tuples
-        self.conn.row_factory = sqlite3.Row
+    def __init__(self, db_config, repository, connection=None):
+        core.MigrationsExecutor.__init__(self, db_config, repository, connection)
+        self.fanout = 'database_glob' in self.db_config
+        self.conn_key = None
+        if connection is not None:
+            # row_factory of a connection passed by a caller is left unchanged
+            self.conn = connection
+        elif self.fanout:
+            # each database file is connected to separately
+            self.conn = None
+        else:
+            connect_kwargs = db_config.get('connect_kwargs', {})
+            self.conn_key = core._connection_key('sqlite3', self.db_config['database'], connect_kwargs)
+            self.conn = core.connections.get(
+                self.conn_key, lambda: sqlite3.connect(self.db_config['database'], **connect_kwargs))
+            # Ensure we return dict/tuple-based access instead of just tuples
+            self.conn.row_factory = sqlite3.Row
+        self._duration_column = None
+
+    @classmethod
+    def with_connect_timeout(cls, db_config, seconds):
+        # a database can't be unreachable, but it can be locked
+        return dict(db_config, connect_kwargs=dict(db_config.get('connect_kwargs', {}), timeout=seconds))
+
+    def fetch_databases(self):
+        """Return sorted paths of database files of a fan-out dbnick, matched by
+        `database_glob` (a glob pattern or a directory). Journal files and copies made
+        by :method:`shadow_swap` are skipped.
+        """
+        pattern = self.db_config['database_glob']
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*')
+        return sorted(path for path in glob.glob(pattern)
+                      if os.path.isfile(path) and not path.endswith(JOURNAL_SUFFIXES + (SHADOW_SUFFIX,)))
+
+    def for_database(self, path):
+        """Return an executor tracking migrations of a single database file of
+        a fan-out dbnick. Its connection isn't shared with other executors.
+        """
+        executor = copy.copy(self)
+        executor.fanout = False
+        executor.db_config = dict(self.db_config, database=path)
+        del executor.db_config['database_glob']
+        executor.conn = sqlite3.connect(path, **self.db_config.get('connect_kwargs', {}))
+        executor.conn.row_factory = sqlite3.Row
+        executor._duration_column = None
+        return executor
+
+    def targets(self):
+        if not self.fanout:
+            return [(None, self)]
+        # connections are opened one by one while iterating
+        return ((path, self.for_database(path)) for path in self.fetch_databases())
 
     def cursor(self):
-        return self.conn.cursor(Sqlite3LoggingCursor)
+        cur = self.conn.cursor(Sqlite3LoggingCursor)
+        cur.row_factory = sqlite3.Row
+        return cur
 
     def initialize(self):
         cur = self.cursor()
@@ -50,9 +120,20 @@ class Sqlite3Migrations(core.MigrationsExecutor):
         if not already_exists:
             cur.execute("""CREATE TABLE {table} (
                 file TEXT,
-                executed TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                executed TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                duration REAL
             )""".format(table=self.TABLE))
-            cur.connection.commit()
+        elif not self._has_duration_column():
+            # a table created by an older version
+            cur.execute("""ALTER TABLE {table} ADD COLUMN duration REAL""".format(table=self.TABLE))
+        self._duration_column = True
+        cur.execute("""CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY,
+            migration_count INTEGER NOT NULL,
+            digest TEXT NOT NULL
+        )""".format(table=self.DIGEST_TABLE))
+        self._store_digest(core.migrations_digest(self.fetch_executed_migrations()))
+        cur.connection.commit()
 
     def fetch_executed_migrations(self):
         cur = self.cursor()
@@ -60,24 +141,338 @@ class Sqlite3Migrations(core.MigrationsExecutor):
                        ORDER BY executed""".format(table=self.TABLE))
         return [row[0] for row in cur.fetchall()]
 
+    def _has_duration_column(self):
+        if self._duration_column is None:
+            cur = self.cursor()
+            cur.execute("""PRAGMA table_info({table})""".format(table=self.TABLE))
+            self._duration_column = any(row['name'] == 'duration' for row in cur.fetchall())
+        return self._duration_column
+
+    def fetch_durations(self):
+        if not self._has_duration_column():
+            return {}
+        cur = self.cursor()
+        cur.execute("""SELECT file, duration FROM {table}
+                       WHERE duration IS NOT NULL""".format(table=self.TABLE))
+        return dict((row[0], row[1]) for row in cur.fetchall())
+
+    def fetch_digest(self):
+        cur = self.cursor()
+        try:
+            cur.execute("""SELECT migration_count, digest FROM {table}
+                           WHERE id = 1""".format(table=self.DIGEST_TABLE))
+        except sqlite3.OperationalError:
+            # no digest table
+            return None
+        row = cur.fetchone()
+        return tuple(row) if row else None
+
+    def _store_digest(self, digest):
+        self.cursor().execute("""INSERT OR REPLACE INTO {table} (id, migration_count, digest)
+                                 VALUES (1, ?, ?)""".format(table=self.DIGEST_TABLE), digest)
+
     def _migration_success(self, migration_file):
-        migration = os.path.split(migration_file)[1]
-        self.cursor().execute("""INSERT INTO {table} (file) VALUES (?)""".format(table=self.TABLE),
-                              (migration,))
+        migration = core._migration_name(migration_file)
+        if self._has_duration_column():
+            self.cursor().execute("""INSERT INTO {table} (file, duration) VALUES (?, ?)""".\
+                                  format(table=self.TABLE), (migration, self._migration_duration()))
+        else:
+            self.cursor().execute("""INSERT INTO {table} (file) VALUES (?)""".format(table=self.TABLE),
+                                  (migration,))
+        self._update_digest(migration)
+
+    def schema_fingerprint(self):
+        if self.fanout:
+            # combined fingerprints of all database files
+            fingerprints = []
+            for path, executor in self.targets():
+                try:
+                    fingerprints.append((path, executor.schema_fingerprint()))
+                finally:
+                    executor.conn.close()
+            return hashlib.md5(repr(fingerprints).encode('utf-8')).hexdigest()
+        cur = self.cursor()
+        cur.execute("""SELECT type, name, tbl_name, sql FROM sqlite_master
+                       ORDER BY type, name""")
+        return hashlib.md5(repr([tuple(row) for row in cur.fetchall()]).encode('utf-8')).hexdigest()
 
     def execute_python_migration(self, migration_file, module):
         assert hasattr(module, 'migrate'), 'Python module must have `migrate` function accepting ' \
             'a database connection'
-        self._call_migrate(module, self.conn)
-        self._migration_success(migration_file)
+        try:
+            started = time.time()
+            self._call_migrate(module, self.conn)
+            self._statement_executed('migrate() of %s' % os.path.basename(migration_file), started)
+            if self.record_executed:
+                self._migration_success(migration_file)
+        except:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        self._committed()
+
+    def record_migration(self, migration_file):
+        try:
+            self._migration_success(migration_file)
+        except:
+            self.conn.rollback()
+            raise
         self.conn.commit()
+        self._committed()
+
+    def _execute_merged(self, statement, originals):
+        if not self.conn.in_transaction:
+            # a savepoint outside of a transaction would commit when released
+            self.cursor().execute("""BEGIN""")
+        cur = self.cursor()
+        cur.execute("""SAVEPOINT mschematool_merged""")
+        try:
+            cur.execute(statement)
+        except sqlite3.DatabaseError:
+            if not self.conn.in_transaction:
+                # ON CONFLICT ROLLBACK aborted the whole transaction, so the statements
+                # executed before can't be replayed
+                raise
+            # undo rows inserted before an ON CONFLICT FAIL error, so the failing
+            # original statement raises the same error as without merging
+            cur.execute("""ROLLBACK TO SAVEPOINT mschematool_merged""")
+            cur.execute("""RELEASE SAVEPOINT mschematool_merged""")
+            for original in originals:
+                self.cursor().execute(original)
+            return
+        cur.execute("""RELEASE SAVEPOINT mschematool_merged""")
 
     def execute_native_migration(self, migration_file):
-        with open(migration_file) as f:
-            content = f.read()
-        for statement in core._sqlfile_to_statements(content):
-            self.cursor().execute(statement)
-        self._migration_success(migration_file)
+        try:
+            with self._native_statements(migration_file) as statements:
+                for statement, originals in self._coalesced(statements):
+                    started = time.time()
+                    if len(originals) == 1:
+                        self.cursor().execute(statement)
+                    else:
+                        self._execute_merged(statement, originals)
+                    self._statement_executed(statement, started)
+            self._migration_success(migration_file)
+        except:
+            self.conn.rollback()
+            raise
         self.conn.commit()
+        self._committed()
+
+    def held_locks(self):
+        # SQLite locks the whole database for writing until a commit
+        return ['database write lock'] if self.conn.in_transaction else []
 
+    @contextlib.contextmanager
+    def rehearsal_clone(self):
+        """Copy the database to a temporary file next to it using the backup API.
+        """
+        if self.conn_key is None or self.db_config.get('connect_kwargs', {}).get('uri'):
+            raise click.ClickException('Rehearsing requires a database specified as a file path')
+        path = self.db_config['database']
+        fd, clone_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.rehearse-',
+                                          dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        try:
+            self.conn.commit()
+            clone = sqlite3.connect(clone_path)
+            try:
+                with core.profiler.phase('clone'):
+                    self.conn.backup(clone, pages=SHADOW_BACKUP_PAGES)
+            finally:
+                clone.close()
+            log.info('Copied %s to %s', path, clone_path)
+            yield dict(self.db_config, database=clone_path)
+        finally:
+            for leftover in [clone_path] + [clone_path + suffix for suffix in JOURNAL_SUFFIXES]:
+                if os.path.exists(leftover):
+                    os.unlink(leftover)
+
+    @contextlib.contextmanager
+    def shadow_swap(self):
+        """Execute migrations on a copy of the database, made using the backup API, and
+        replace the database file with the copy (using an atomic rename) when the context
+        exits. This is an offline mode: connections of other processes would keep using
+        the replaced file, so the database must not be open in any other process, which is
+        checked before copying and again under an exclusive lock before the rename. The copy
+        is swapped in only if nothing was committed to the database in the meantime -
+        otherwise it's discarded.
+        """
+        if self.conn_key is None or self.db_config.get('connect_kwargs', {}).get('uri'):
+            raise click.ClickException('Migrating a copy requires a database specified as '
+                                       'a file path, without a connection passed by a caller')
+        if self.db_config.get('python_migration_worker'):
+            raise click.ClickException('Migrating a copy is not supported with '
+                                       '`python_migration_worker`')
+        path = self.db_config['database']
+        live = self.conn
+        live.commit()
+        if live.execute("""PRAGMA journal_mode""").fetchone()[0].lower() == 'wal':
+            raise click.ClickException('Migrating a copy is not supported for databases in WAL '
+                                       'mode - the write-ahead log of the database would be '
+                                       'applied to the copy')
+        _check_not_open_elsewhere(path)
+        # changes when another connection commits
+        data_version = live.execute("""PRAGMA data_version""").fetchone()[0]
+        shadow_path = path + SHADOW_SUFFIX
+        if os.path.exists(shadow_path):
+            os.unlink(shadow_path)
+        shadow = sqlite3.connect(shadow_path, **self.db_config.get('connect_kwargs', {}))
+        shadow.row_factory = sqlite3.Row
+        try:
+            with core.profiler.phase('shadow copy'):
+                live.backup(shadow, pages=SHADOW_BACKUP_PAGES)
+            log.info('Copied %s to %s', path, shadow_path)
+            self.conn = shadow
+            try:
+                yield
+            finally:
+                self.conn = live
+            shadow.commit()
+            shadow.close()
+            os.chmod(shadow_path, stat.S_IMODE(os.stat(path).st_mode))
+            with core.profiler.phase('shadow swap'):
+                self._swap(live, data_version, shadow_path, path)
+        except:
+            shadow.close()
+            if os.path.exists(shadow_path):
+                os.unlink(shadow_path)
+            raise
+        live.close()
+        self.conn = sqlite3.connect(path, **self.db_config.get('connect_kwargs', {}))
+        self.conn.row_factory = sqlite3.Row
+        core.connections.replace(self.conn_key, self.conn)
+
+    def _swap(self, live, data_version, shadow_path, path):
+        # waits for other connections to finish their transactions
+        live.execute("""BEGIN EXCLUSIVE""")
+        try:
+            if live.execute("""PRAGMA data_version""").fetchone()[0] != data_version:
+                raise click.ClickException('%s was modified while migrating its copy, the copy '
+                                           'was discarded' % path)
+            # a connection opened while migrating would write to the replaced file
+            _check_not_open_elsewhere(path)
+            os.rename(shadow_path, path)
+            log.info('Replaced %s with the migrated copy', path)
+        finally:
+            live.rollback()
+
+    def sync_fanout(self):
+        """Sync all database files using a pool of `fanout_processes` processes (by default,
+        the number of CPUs). Pending native migrations are parsed once, before starting
+        the pool. A failed file doesn't stop syncing other files - running `sync` again
+        continues from the first failed migration of each file.
+        """
+        paths = self.fetch_databases()
+        if not paths:
+            return
+        processes = min(self.db_config.get('fanout_processes') or multiprocessing.cpu_count(),
+                        len(paths))
+        pool = multiprocessing.Pool(processes, _init_worker, (self.db_config, None))
+        try:
+            executed = pool.map(_fetch_executed, paths)
+        finally:
+            pool.terminate()
+        pending = set()
+        for migrations in executed:
+            if migrations is not None:
+                pending.update(self.repository.get_migrations(exclude=migrations))
+        prepared = {}
+        with contextlib.closing(core.MigrationPrefetcher(self, sorted(pending),
+                                                         len(pending))) as prefetcher:
+            for migration in sorted(pending):
+                try:
+                    statements = prefetcher.get(migration)
+                except Exception as e:
+                    # reported by workers for each file, in order
+                    log.warning('Cannot parse %s: %s', migration, e)
+                    continue
+                if statements is not None:
+                    prepared[migration] = statements
+        pool = multiprocessing.Pool(processes, _init_worker, (self.db_config, prepared))
+        try:
+            for result in pool.imap(_sync_database, paths):
+                yield result
+        finally:
+            pool.terminate()
 
+
+def _processes_using(path):
+    """Return PIDs of other processes having ``path`` open, read from ``/proc``, or ``None``
+    if it's not available. Processes of other users are visible only to root.
+    """
+    if not os.path.isdir('/proc/self/fd'):
+        return None
+    st = os.stat(path)
+    pids = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        fd_dir = os.path.join('/proc', pid, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # the process exited or belongs to another user
+            continue
+        for fd in fds:
+            try:
+                fd_st = os.stat(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if (fd_st.st_dev, fd_st.st_ino) == (st.st_dev, st.st_ino):
+                pids.append(int(pid))
+                break
+    return pids
+
+def _check_not_open_elsewhere(path):
+    pids = _processes_using(path)
+    if pids is None:
+        raise click.ClickException('Migrating a copy requires /proc to check that %s is not '
+                                   'open in other processes' % path)
+    if pids:
+        raise click.ClickException('Migrating a copy requires exclusive use of the database, but '
+                                   '%s is open in processes %s' % (path, ', '.join(map(str, sorted(pids)))))
+
+
+# State of a process syncing database files of a fan-out dbnick, set by _init_worker
+_worker = {}
+
+def _init_worker(db_config, prepared):
+    _worker['db_config'] = dict(db_config)
+    del _worker['db_config']['database_glob']
+    _worker['repository'] = core._make_repository(
+        db_config, Sqlite3Migrations.supported_filename_globs())
+    _worker['prepared'] = prepared
+
+def _file_executor(path):
+    return Sqlite3Migrations(dict(_worker['db_config'], database=path), _worker['repository'])
+
+def _fetch_executed(path):
+    """Return executed migrations of a database file, or ``None`` if they can't be read.
+    """
+    with core.connections.scope():
+        try:
+            return _file_executor(path).fetch_executed_migrations()
+        except Exception:
+            return None
+
+def _sync_database(path):
+    """Sync a database file in a worker process. Return a ``(path, executed migrations,
+    error)`` tuple like :method:`Sqlite3Migrations.sync_fanout`, with an error message
+    instead of an exception, which could not be pickled.
+    """
+    executed = []
+    migration = None
+    with core.connections.scope():
+        try:
+            executor = _file_executor(path)
+            to_execute = _worker['repository'].get_migrations(
+                exclude=executor.fetch_executed_migrations())
+            for migration in to_execute:
+                log.info('Executing %s in %s', migration, path)
+                executor.execute_migration(migration, _worker['prepared'].get(migration))
+                executed.append(migration)
+            return path, executed, None
+        except Exception as e:
+            log.exception('While syncing %s', path)
+            return path, executed, (migration, '%s: %s' % (e.__class__.__name__, e))
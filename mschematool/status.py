@@ -0,0 +1,122 @@
+"""Status of many databases fetched concurrently, e.g. for checking which databases
+are behind before a release. Repositories are listed once for all dbnicks using them,
+and databases are queried by a pool of threads with connection timeouts, so a single
+unreachable database doesn't stall the others.
+"""
+
+from multiprocessing.pool import ThreadPool
+
+import click
+
+from mschematool import core
+
+
+log = core.log
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_JOBS = 16
+
+
+class DatabaseStatus(object):
+    """Status of a single target of a dbnick. ``target`` is ``None`` unless the dbnick
+    tracks migrations of multiple tenants. ``latest`` is the latest executed migration.
+    When the status can't be fetched, ``error`` is a message and counts are ``None``.
+    """
+
+    def __init__(self, dbnick, target=None, applied=None, pending=None, latest=None, error=None):
+        self.dbnick = dbnick
+        self.target = target
+        self.applied = applied
+        self.pending = pending
+        self.latest = latest
+        self.error = error
+
+    @property
+    def name(self):
+        return self.dbnick if self.target is None else '%s/%s' % (self.dbnick, self.target)
+
+    def as_dict(self):
+        return {'dbnick': self.dbnick, 'target': self.target, 'applied': self.applied,
+                'pending': self.pending, 'latest': self.latest, 'error': self.error}
+
+    def __repr__(self):
+        return 'DatabaseStatus(%r)' % self.as_dict()
+
+
+def _error_message(e):
+    lines = str(e).strip().splitlines()
+    return lines[0] if lines else e.__class__.__name__
+
+
+def _prepare(config, dbnick, timeout, repositories):
+    """Return ``(executor class, db_config, repository)`` for ``dbnick``. Repositories
+    are shared by dbnicks using the same engine and location, and listed only once.
+    """
+    db_config = config.databases.get(dbnick)
+    if db_config is None:
+        raise click.ClickException('Not found in DATABASES in config: %s' % dbnick)
+    engine_cls = core.engine_class(dbnick, db_config)
+    key = (db_config['engine'], core._repository_location(db_config))
+    if key not in repositories:
+        repository = core._make_repository(db_config, engine_cls.supported_filename_globs())
+        repository.get_migrations()
+        repositories[key] = repository
+    return engine_cls, engine_cls.with_connect_timeout(db_config, timeout), repositories[key]
+
+
+def _fetch(dbnick, engine_cls, db_config, repository):
+    with core.connections.scope():
+        executor = engine_cls(db_config, repository)
+        statuses = []
+        for label, target in executor.targets():
+            executed = target.fetch_executed_migrations()
+            pending = repository.get_migrations(exclude=executed)
+            statuses.append(DatabaseStatus(dbnick, label, len(executed), len(pending),
+                                           executed[-1] if executed else None))
+        return statuses
+
+
+def collect(config, dbnicks, timeout=DEFAULT_TIMEOUT, jobs=DEFAULT_JOBS):
+    """Return a list of :class:`DatabaseStatus` objects for ``dbnicks``, in the same order.
+    Databases are queried by ``jobs`` threads, and connecting to a database fails after
+    ``timeout`` seconds. Errors are reported in the returned objects instead of raising.
+    """
+    repositories = {}
+    tasks = []
+    for dbnick in dbnicks:
+        try:
+            tasks.append((dbnick, _prepare(config, dbnick, timeout, repositories)))
+        except Exception as e:
+            tasks.append((dbnick, e))
+
+    def fetch(task):
+        dbnick, prepared = task
+        if isinstance(prepared, Exception):
+            return [DatabaseStatus(dbnick, error=_error_message(prepared))]
+        try:
+            return _fetch(dbnick, *prepared)
+        except Exception as e:
+            log.warning('Cannot fetch status of %s: %s', dbnick, e)
+            return [DatabaseStatus(dbnick, error=_error_message(e))]
+
+    if not tasks:
+        return []
+    pool = ThreadPool(max(min(jobs, len(tasks)), 1))
+    try:
+        return [status for statuses in pool.map(fetch, tasks) for status in statuses]
+    finally:
+        pool.terminate()
+
+
+def format_table(statuses):
+    """Return lines of a table with a row for each of ``statuses``.
+    """
+    rows = [('dbnick', 'applied', 'pending', 'latest')]
+    for status in statuses:
+        if status.error is not None:
+            rows.append((status.name, '-', '-', 'error: %s' % status.error))
+        else:
+            rows.append((status.name, str(status.applied), str(status.pending),
+                         status.latest or '-'))
+    width = max(len(row[0]) for row in rows)
+    return [('%-*s %7s %7s  %s' % ((width,) + row)).rstrip() for row in rows]
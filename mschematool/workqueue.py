@@ -0,0 +1,329 @@
+"""Coordination of syncing many databases by multiple worker processes, possibly
+running on different hosts. Dbnicks to sync are stored in a coordination table
+in a PostgreSQL or SQLite3 database (a "coordinator" dbnick). Workers claim entries
+with leases, which they renew while syncing. Entries of crashed workers are claimed
+again when their leases expire.
+"""
+
+import os
+import socket
+import threading
+import time
+
+import click
+
+from mschematool import core
+from mschematool import api
+
+
+log = core.log
+
+DEFAULT_QUEUE_TABLE = 'mschematool_queue'
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def default_worker_id():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """A queue of dbnicks stored in a coordination table. Entries have a status:
+    ``pending``, ``running`` (claimed by a worker until ``lease_until``), ``done``
+    or ``failed``.
+
+    :param executor: a :class:`core.MigrationsExecutor` of the coordination database,
+        providing a connection
+    :param table: a name of the coordination table
+    """
+
+    def __init__(self, executor, table):
+        self.executor = executor
+        self.conn = executor.conn
+        self.table = table
+
+    def initialize(self):
+        """Create the coordination table if it doesn't exist.
+        """
+        raise NotImplementedError()
+
+    def add(self, dbnicks):
+        """Add ``dbnicks`` as pending entries. Existing entries are reset.
+        """
+        raise NotImplementedError()
+
+    def claim(self, worker, lease_seconds, max_attempts):
+        """Claim a pending entry or an entry with an expired lease and return its dbnick
+        (or ``None`` if there are no such entries). Entries with expired leases which were
+        claimed ``max_attempts`` times are marked as failed.
+        """
+        raise NotImplementedError()
+
+    def renew(self, dbnick, worker, lease_seconds):
+        """Extend a lease of an entry claimed by ``worker``. Return ``False`` if
+        the lease was lost.
+        """
+        raise NotImplementedError()
+
+    def finish(self, dbnick, worker, ok, result):
+        """Record a result of syncing a claimed entry.
+        """
+        raise NotImplementedError()
+
+    def entries(self):
+        """Return a list of ``(dbnick, status, worker, attempts, result)`` tuples.
+        """
+        cur = self.executor.cursor()
+        cur.execute("""SELECT dbnick, status, worker, attempts, result FROM {table}
+                       ORDER BY dbnick""".format(table=self.table))
+        rows = [tuple(row) for row in cur.fetchall()]
+        self.conn.commit()
+        return rows
+
+
+class PostgresWorkQueue(WorkQueue):
+    """Entries are claimed using ``FOR UPDATE SKIP LOCKED``, so workers don't wait
+    for each other. Leases use the database clock.
+    """
+
+    def initialize(self):
+        with self.executor.cursor() as cur:
+            cur.execute("""CREATE TABLE IF NOT EXISTS {table} (
+                dbnick TEXT PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until TIMESTAMP WITH TIME ZONE,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                updated TIMESTAMP WITH TIME ZONE DEFAULT now()
+            )""".format(table=self.table))
+        self.conn.commit()
+
+    def add(self, dbnicks):
+        with self.executor.cursor() as cur:
+            for dbnick in dbnicks:
+                cur.execute("""INSERT INTO {table} (dbnick) VALUES (%s)
+                    ON CONFLICT (dbnick) DO UPDATE SET status = 'pending', worker = NULL,
+                    lease_until = NULL, attempts = 0, result = NULL, updated = now()""".\
+                            format(table=self.table), [dbnick])
+        self.conn.commit()
+
+    def claim(self, worker, lease_seconds, max_attempts):
+        with self.executor.cursor() as cur:
+            cur.execute("""UPDATE {table} SET status = 'failed', worker = NULL, lease_until = NULL,
+                result = 'lease expired after ' || attempts || ' attempts', updated = now()
+                WHERE dbnick IN (SELECT dbnick FROM {table}
+                    WHERE status = 'running' AND lease_until < now() AND attempts >= %s
+                    FOR UPDATE SKIP LOCKED)""".format(table=self.table), [max_attempts])
+            cur.execute("""UPDATE {table} SET status = 'running', worker = %s,
+                lease_until = now() + make_interval(secs => %s), attempts = attempts + 1,
+                updated = now()
+                WHERE dbnick = (SELECT dbnick FROM {table}
+                    WHERE status = 'pending' OR (status = 'running' AND lease_until < now())
+                    ORDER BY updated, dbnick LIMIT 1
+                    FOR UPDATE SKIP LOCKED)
+                RETURNING dbnick""".format(table=self.table), [worker, lease_seconds])
+            row = cur.fetchone()
+        self.conn.commit()
+        return row[0] if row else None
+
+    def renew(self, dbnick, worker, lease_seconds):
+        with self.executor.cursor() as cur:
+            cur.execute("""UPDATE {table} SET lease_until = now() + make_interval(secs => %s)
+                WHERE dbnick = %s AND worker = %s AND status = 'running'""".\
+                        format(table=self.table), [lease_seconds, dbnick, worker])
+            renewed = cur.rowcount == 1
+        self.conn.commit()
+        return renewed
+
+    def finish(self, dbnick, worker, ok, result):
+        with self.executor.cursor() as cur:
+            cur.execute("""UPDATE {table} SET status = %s, lease_until = NULL, result = %s,
+                updated = now() WHERE dbnick = %s AND worker = %s""".format(table=self.table),
+                        ['done' if ok else 'failed', result, dbnick, worker])
+        self.conn.commit()
+
+
+class Sqlite3WorkQueue(WorkQueue):
+    """Entries are claimed in ``BEGIN IMMEDIATE`` transactions, which lock the database
+    for writing. Leases use clocks of workers, so they should be synchronized.
+    """
+
+    def initialize(self):
+        cur = self.executor.cursor()
+        cur.execute("""CREATE TABLE IF NOT EXISTS {table} (
+            dbnick TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            updated REAL
+        )""".format(table=self.table))
+        self.conn.commit()
+
+    def add(self, dbnicks):
+        cur = self.executor.cursor()
+        for dbnick in dbnicks:
+            cur.execute("""INSERT OR REPLACE INTO {table} (dbnick, status, updated)
+                           VALUES (?, 'pending', ?)""".format(table=self.table),
+                        (dbnick, time.time()))
+        self.conn.commit()
+
+    def claim(self, worker, lease_seconds, max_attempts):
+        self.conn.commit()
+        cur = self.executor.cursor()
+        cur.execute("""BEGIN IMMEDIATE""")
+        try:
+            now = time.time()
+            cur.execute("""UPDATE {table} SET status = 'failed', worker = NULL, lease_until = NULL,
+                           result = 'lease expired after ' || attempts || ' attempts', updated = ?
+                           WHERE status = 'running' AND lease_until < ? AND attempts >= ?""".\
+                        format(table=self.table), (now, now, max_attempts))
+            cur.execute("""SELECT dbnick FROM {table}
+                           WHERE status = 'pending' OR (status = 'running' AND lease_until < ?)
+                           ORDER BY updated, dbnick LIMIT 1""".format(table=self.table), (now,))
+            row = cur.fetchone()
+            if row is not None:
+                cur.execute("""UPDATE {table} SET status = 'running', worker = ?, lease_until = ?,
+                               attempts = attempts + 1, updated = ? WHERE dbnick = ?""".\
+                            format(table=self.table), (worker, now + lease_seconds, now, row[0]))
+        except:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        return row[0] if row else None
+
+    def renew(self, dbnick, worker, lease_seconds):
+        cur = self.executor.cursor()
+        cur.execute("""UPDATE {table} SET lease_until = ?
+                       WHERE dbnick = ? AND worker = ? AND status = 'running'""".\
+                    format(table=self.table), (time.time() + lease_seconds, dbnick, worker))
+        renewed = cur.rowcount == 1
+        self.conn.commit()
+        return renewed
+
+    def finish(self, dbnick, worker, ok, result):
+        cur = self.executor.cursor()
+        cur.execute("""UPDATE {table} SET status = ?, lease_until = NULL, result = ?, updated = ?
+                       WHERE dbnick = ? AND worker = ?""".format(table=self.table),
+                    ('done' if ok else 'failed', result, time.time(), dbnick, worker))
+        self.conn.commit()
+
+
+ENGINE_TO_QUEUE = {
+    'postgres': PostgresWorkQueue,
+    'sqlite3': Sqlite3WorkQueue,
+}
+
+
+def open_queue(config, coordinator):
+    """Return a :class:`WorkQueue` stored in the database of ``coordinator`` dbnick.
+    The dbnick doesn't need to specify migrations. The table name can be set with
+    the `queue_table` option.
+    """
+    db_config = config.databases.get(coordinator)
+    if db_config is None:
+        raise click.ClickException('Not found in DATABASES in config: %s' % coordinator)
+    engine = db_config.get('engine')
+    if engine not in ENGINE_TO_QUEUE:
+        raise click.ClickException('A coordination database must use one of engines: %s' %
+                                   ', '.join(sorted(ENGINE_TO_QUEUE)))
+    executor = core._import_class(core.ENGINE_TO_IMPL[engine])(db_config, None)
+    return ENGINE_TO_QUEUE[engine](executor, db_config.get('queue_table', DEFAULT_QUEUE_TABLE))
+
+
+class LeaseLost(Exception):
+    """Raised by :method:`LeaseRenewer.check` when another worker could claim the entry.
+    """
+
+
+class LeaseRenewer(threading.Thread):
+    """A thread renewing a lease of a claimed entry every third of the lease time,
+    using its own connection to the coordination database. The lease is lost when
+    another worker claimed the entry, or when it couldn't be renewed and would expire
+    before the next attempt. :method:`check` is called before each migration, so a sync
+    stops instead of running concurrently with a sync of another worker.
+    """
+
+    def __init__(self, config, coordinator, dbnick, worker, lease_seconds):
+        threading.Thread.__init__(self, name='mschematool-lease')
+        self.daemon = True
+        self.config = config
+        self.coordinator = coordinator
+        self.dbnick = dbnick
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self._stopped = threading.Event()
+        self._lost = threading.Event()
+        # the entry was claimed just before
+        self._renewed = time.time()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def check(self):
+        if self._lost.is_set():
+            raise LeaseLost('Lease of %s was lost, the sync was stopped' % self.dbnick)
+
+    def run(self):
+        with core.connections.scope():
+            queue = open_queue(self.config, self.coordinator)
+            while not self._stopped.wait(self.lease_seconds / 3.0):
+                attempted = time.time()
+                try:
+                    if not queue.renew(self.dbnick, self.worker, self.lease_seconds):
+                        log.warning('Lease of %s was lost', self.dbnick)
+                        self._lost.set()
+                        return
+                    self._renewed = attempted
+                except Exception:
+                    log.exception('While renewing a lease of %s', self.dbnick)
+                    if time.time() - self._renewed > self.lease_seconds * 2 / 3.0:
+                        log.warning('Lease of %s would expire before it\'s renewed', self.dbnick)
+                        self._lost.set()
+                        return
+
+
+def sync_dbnick(config, dbnick, before_migration=None):
+    """Sync ``dbnick`` and return a pair ``(ok, result message)``. Connections
+    opened for the sync are closed.
+
+    :param before_migration: passed to :method:`api.MSchema.sync`
+    """
+    with core.connections.scope():
+        try:
+            result = api.MSchema(core.MSchemaTool(config, dbnick)).sync(
+                before_migration=before_migration)
+        except Exception as e:
+            log.exception('While syncing %s', dbnick)
+            return False, 'error: %s' % e
+    if not result.ok:
+        failed = [m for m in result.migrations if not m.ok][0]
+        return False, 'error while executing %s after %d migrations: %s' % (
+            failed.name, len(result.executed), failed.error)
+    return True, 'executed %d migrations' % len(result.executed)
+
+
+def work(config, coordinator, worker=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+         max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Claim and sync entries of the queue until there are no entries to claim.
+    Yield ``(dbnick, ok, result message)`` tuples.
+    """
+    worker = worker or default_worker_id()
+    queue = open_queue(config, coordinator)
+    while True:
+        dbnick = queue.claim(worker, lease_seconds, max_attempts)
+        if dbnick is None:
+            return
+        log.info('Worker %s claimed %s', worker, dbnick)
+        renewer = LeaseRenewer(config, coordinator, dbnick, worker, lease_seconds)
+        renewer.start()
+        try:
+            ok, result = sync_dbnick(config, dbnick, renewer.check)
+        finally:
+            renewer.stop()
+        # doesn't change an entry claimed by another worker
+        queue.finish(dbnick, worker, ok, result)
+        yield dbnick, ok, result
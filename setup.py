@@ -16,6 +16,7 @@ setup(
         extras_require = {
             'postgresql': ['psycopg2'],
             'cassandra': ['cassandra-driver'],
+            'zstd': ['zstandard'],
         },
 
         author = 'Artur Siekielski',
@@ -31,6 +32,9 @@ See description at `<https://github.com/aartur/mschematool>`_.
             'Topic :: Database',
             'Environment :: Console',
             'License :: OSI Approved :: BSD License',
-            'Programming Language :: Python :: 2.7',
+            'Programming Language :: Python :: 3',
+            'Programming Language :: Python :: 3 :: Only',
+            'Programming Language :: Python :: 3.9',
         ],
+        python_requires = '>=3.9',
 )
@@ -0,0 +1,3 @@
+CREATE TABLE comment (id int, article_id int);
+CREATE INDEX comment_article ON comment (article_id);
+ALTER TABLE comment ADD COLUMN created timestamp DEFAULT clock_timestamp();
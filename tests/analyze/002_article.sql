@@ -0,0 +1,11 @@
+-- changing the type rewrites the existing table
+ALTER TABLE article ALTER COLUMN body TYPE varchar(200);
+ALTER TABLE article ADD COLUMN title text;
+-- serial and identity columns are filled for existing rows
+ALTER TABLE article ADD COLUMN seq bigserial;
+ALTER TABLE article ADD COLUMN num int GENERATED BY DEFAULT AS IDENTITY;
+ALTER TABLE article ADD CONSTRAINT article_id_positive CHECK (id > 0) NOT VALID;
+ALTER TABLE article VALIDATE CONSTRAINT article_id_positive;
+UPDATE article SET title = body;
+ALTER TABLE article ALTER COLUMN id SET NOT NULL;
+INSERT INTO comment (id, article_id) VALUES (1, 1);
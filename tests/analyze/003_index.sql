@@ -0,0 +1 @@
+CREATE INDEX CONCURRENTLY article_id ON article (id);
@@ -0,0 +1,16 @@
+CREATE TABLE article (id int PRIMARY KEY, body text);
+CREATE TABLE author (name text);
+INSERT INTO article (id, body) VALUES (1, 'art1');
+INSERT INTO article (id, body) VALUES (2, 'it''s (2), (3)');
+INSERT INTO article (id, body) VALUES (3, 'art3');
+INSERT INTO author (name) VALUES ('someone');
+INSERT INTO article (id, body) VALUES (4, 'art4');
+INSERT INTO article (id,body) VALUES (5, 'art5');
+UPDATE article SET body = 'art1 updated' WHERE id = 1;
+INSERT INTO article (id, body) VALUES (6, 'art6');
+CREATE TABLE counter (id int, "a  b" text);
+INSERT INTO counter (id, "a  b") VALUES ((SELECT coalesce(max(id), 0) + 1 FROM counter), 'x');
+INSERT INTO counter (id, "a  b") VALUES ((SELECT coalesce(max(id), 0) + 1 FROM counter), 'x');
+INSERT INTO counter (id, "a  b") VALUES ((SELECT coalesce(max(id), 0) + 1 FROM counter), 'x');
+INSERT INTO counter (id, "a  b") VALUES (10, 'y');
+INSERT INTO counter (id, "a  b") VALUES (-11.0, NULL);
@@ -0,0 +1,5 @@
+CREATE TABLE article (id int PRIMARY KEY, body text);
+INSERT INTO article (id, body) VALUES (1, 'art1');
+INSERT INTO article (id, body) VALUES (2, 'art2');
+INSERT INTO article (id, body) VALUES (2, 'duplicate');
+INSERT INTO article (id, body) VALUES (3, 'art3');
@@ -0,0 +1,6 @@
+CREATE TABLE uniq (id INTEGER UNIQUE ON CONFLICT ROLLBACK);
+-- not merged
+INSERT INTO uniq (id) SELECT 1;
+-- merged; the conflict rolls back the whole transaction, including the row above
+INSERT INTO uniq (id) VALUES (2);
+INSERT INTO uniq (id) VALUES (1);
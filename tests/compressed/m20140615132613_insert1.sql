@@ -0,0 +1 @@
+INSERT INTO article (id, body) VALUES (1, 'art1');
@@ -37,6 +37,132 @@ DATABASES = {
             'migration_table': 'hooli.migration'
         },
 
+        'fanout': {
+            'migrations_dir': os.path.join(BASE_DIR, 'fanout'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'schemas': ['tenant1', 'tenant2', 'tenant3'],
+            'fanout_connections': 2,
+        },
+
+        'fanout_query': {
+            'migrations_dir': os.path.join(BASE_DIR, 'fanout'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'schemas_query': "SELECT nspname FROM pg_namespace WHERE nspname LIKE 'tenant%' ORDER BY nspname",
+        },
+
+        'fanout_public': {
+            'migrations_dir': os.path.join(BASE_DIR, 'fanout_public'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'schemas': ['tenant1', 'tenant2', 'tenant3'],
+        },
+
+        'fanout_non_transactional': {
+            'migrations_dir': os.path.join(BASE_DIR, 'non_transactional'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'schemas': ['tenant1', 'tenant2', 'tenant3'],
+        },
+
+        'fanout_worker': {
+            'migrations_zip': '/tmp/pgtest_fanout_migrations.zip',
+            'migrations_zip_dir': 'migrations',
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'schemas': ['tenant1', 'tenant2', 'tenant3'],
+            'python_migration_worker': 'spawn',
+        },
+
+        'coalesce': {
+            'migrations_dir': os.path.join(BASE_DIR, 'coalesce'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'coalesce_inserts': 2,
+        },
+
+        'coalesce_error': {
+            'migrations_dir': os.path.join(BASE_DIR, 'coalesce_error'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'coalesce_inserts': True,
+        },
+
+        'compressed': {
+            'migrations_dir': os.path.join(BASE_DIR, 'compressed'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+        },
+
+        'progress': {
+            'migrations_dir': os.path.join(BASE_DIR, 'progress'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'progress_interval': 0.2,
+        },
+
+        'replication_lag': {
+            'migrations_dir': os.path.join(BASE_DIR, 'replication_lag'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'max_replication_lag': 1,
+            'replication_lag_interval': 0.2,
+            # lag simulated by tests
+            'replication_lag_query': 'SELECT lag FROM fake_lag',
+        },
+
+        'analyze': {
+            'migrations_dir': os.path.join(BASE_DIR, 'analyze'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+        },
+
+        'python_worker': {
+            'migrations_dir': os.path.join(BASE_DIR, 'python_worker'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'python_migration_worker': True,
+        },
+
+        'single_transaction': {
+            'migrations_dir': os.path.join(BASE_DIR, 'single_transaction'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+        },
+
+        'non_transactional': {
+            'migrations_dir': os.path.join(BASE_DIR, 'non_transactional'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+        },
+
+        'session_settings1': {
+            'migrations_dir': os.path.join(BASE_DIR, 'session_settings1'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'migration_table': 'public.migration_settings1',
+        },
+
+        'session_settings2': {
+            'migrations_dir': os.path.join(BASE_DIR, 'session_settings2'),
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+            'migration_table': 'public.migration_settings2',
+        },
+
+        'pg_unreachable': {
+            'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
+            'engine': 'postgres',
+            # a non-routable address
+            'dsn': 'host=10.255.255.1 dbname=mtest1',
+        },
+
+        'pg_coordinator': {
+            'engine': 'postgres',
+            'dsn': _postgres_dsn,
+        },
+
         'cass_default': {
             'migrations_dir': os.path.join(BASE_DIR, 'cass1'),
             'engine': 'cassandra',
@@ -49,6 +175,194 @@ DATABASES = {
             },
         },
 
+        'cass_batch': {
+            'migrations_dir': os.path.join(BASE_DIR, 'cass_batch'),
+            'engine': 'cassandra',
+            'cqlsh_path': '/opt/cassandra/bin/cqlsh',
+            'pylib_path': '/opt/cassandra/pylib',
+            'keyspace': 'migrations',
+            'cluster_kwargs': {
+                'contact_points': ['127.0.0.1'],
+                'port': 9042,
+            },
+        },
+
+        'cass_schema_agreement': {
+            'migrations_dir': os.path.join(BASE_DIR, 'cass1'),
+            'engine': 'cassandra',
+            'cqlsh_path': '/opt/cassandra/bin/cqlsh',
+            'pylib_path': '/opt/cassandra/pylib',
+            'keyspace': 'migrations',
+            'cluster_kwargs': {
+                'contact_points': ['127.0.0.1'],
+                'port': 9042,
+            },
+            'schema_agreement': 'batch',
+            'schema_agreement_wait': 30,
+        },
+
+        'sqlite3_after_sync': {
+            'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test_after_sync.sql',
+            'after_sync': 'touch /tmp/sqlite3test_after_sync.done',
+            'after_sync_if_schema_changed': True,
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_after_sync_timeout': {
+            'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test_after_sync.sql',
+            'after_sync': 'sleep 10',
+            'after_sync_timeout': 0.5,
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_coalesce_rollback': {
+            'migrations_dir': os.path.join(BASE_DIR, 'coalesce_rollback'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test.sql',
+            'coalesce_inserts': True,
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_coalesce': {
+            'migrations_dir': os.path.join(BASE_DIR, 'coalesce'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test.sql',
+            'coalesce_inserts': 2,
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_coalesce_error': {
+            'migrations_dir': os.path.join(BASE_DIR, 'coalesce_error'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test.sql',
+            'coalesce_inserts': True,
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_compressed': {
+            'migrations_dir': os.path.join(BASE_DIR, 'compressed'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test.sql',
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_staging': {
+            'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test_staging.sql',
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_zip': {
+            'migrations_zip': '/tmp/sqlite3test_migrations.zip',
+            'migrations_zip_dir': 'migrations',
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test.sql',
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_coordinator': {
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test_coordinator.sql',
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_fleet1': {
+            'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test_fleet1.sql',
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_fleet2': {
+            'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test_fleet2.sql',
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_slow_fleet': {
+            'migrations_dir': os.path.join(BASE_DIR, 'lease_lost'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test_fleet_slow.sql',
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_python_worker': {
+            'migrations_dir': os.path.join(BASE_DIR, 'python_worker'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test.sql',
+            'connect_kwargs': {
+            },
+            'python_migration_worker': True,
+        },
+
+        'sqlite3_python_worker_fork': {
+            'migrations_dir': os.path.join(BASE_DIR, 'python_worker'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test.sql',
+            'connect_kwargs': {
+            },
+            'python_migration_worker': 'fork',
+        },
+
+        'sqlite3_python_worker_limit': {
+            'migrations_dir': os.path.join(BASE_DIR, 'python_worker_limit'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test.sql',
+            'connect_kwargs': {
+            },
+            'python_migration_worker': 'spawn',
+            'python_migration_memory_limit': 512,
+        },
+
+        'sqlite3_prefetch': {
+            'migrations_dir': os.path.join(BASE_DIR, 'prefetch'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test.sql',
+            'connect_kwargs': {
+            },
+        },
+
+        'sqlite3_shards': {
+            'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
+            'engine': 'sqlite3',
+            'database_glob': '/tmp/sqlite3test_shards/*.db',
+            'fanout_processes': 2,
+        },
+
+        'sqlite3_shards_after_sync': {
+            'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
+            'engine': 'sqlite3',
+            'database_glob': '/tmp/sqlite3test_shards/*.db',
+            'after_sync': 'touch /tmp/sqlite3test_shards/after_sync.done',
+            'after_sync_if_schema_changed': True,
+        },
+
+        'sqlite3_shadow': {
+            'migrations_dir': os.path.join(BASE_DIR, 'shadow'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test.sql',
+            'connect_kwargs': {
+            },
+        },
+
         'sqlite3_default': {
             'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
             'engine': 'sqlite3',
@@ -0,0 +1,23 @@
+import os.path
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def DATABASES(dbnick):
+    if dbnick == 'broken':
+        raise Exception('broken dbnick must not be resolved')
+    if not dbnick.startswith('sqlite3_lazy'):
+        return None
+    return {
+        'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
+        'engine': 'sqlite3',
+        'database': '/tmp/sqlite3test_%s.sql' % dbnick,
+        'connect_kwargs': {
+        },
+    }
+
+
+def DATABASE_NICKS():
+    yield 'sqlite3_lazy1'
+    yield 'sqlite3_lazy2'
+    yield 'broken'
@@ -0,0 +1,17 @@
+import os.path
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+DATABASES = {
+        'sqlite3_logging': {
+            'migrations_dir': os.path.join(BASE_DIR, 'migrations1'),
+            'engine': 'sqlite3',
+            'database': '/tmp/sqlite3test_logging.sql',
+            'connect_kwargs': {
+            },
+        },
+}
+
+LOG_FILE = '/tmp/mtest_logging.log'
+LOG_ASYNC = True
+LOG_STATEMENT_MAX_LENGTH = 60
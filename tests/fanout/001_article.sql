@@ -0,0 +1,2 @@
+CREATE TABLE article (id int, body text);
+INSERT INTO article (id, body) VALUES (1, 'art1');
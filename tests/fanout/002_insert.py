@@ -0,0 +1,3 @@
+def migrate(connection):
+    cur = connection.cursor()
+    cur.execute("""INSERT INTO article (id, body) VALUES (2, 'art2')""")
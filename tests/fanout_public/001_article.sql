@@ -0,0 +1,3 @@
+-- tenant_greeting() is created in the public schema
+CREATE TABLE article (id int, body text);
+INSERT INTO article (id, body) VALUES (1, tenant_greeting());
@@ -0,0 +1,7 @@
+import time
+
+
+def migrate(conn):
+    # gives tests time to take the lease over
+    time.sleep(2)
+    conn.execute("""CREATE TABLE slow (id INTEGER)""")
@@ -0,0 +1 @@
+CREATE TABLE article (id INTEGER);
@@ -0,0 +1,4 @@
+-- Indexes built concurrently can't be created inside a transaction.
+-- mschematool: no-transaction
+CREATE INDEX CONCURRENTLY article_id ON article (id);
+CREATE INDEX CONCURRENTLY article_body ON article (body);
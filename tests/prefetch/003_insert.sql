@@ -0,0 +1 @@
+INSERT INTO article VALUES (1, 'art1');
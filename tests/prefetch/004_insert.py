@@ -0,0 +1,2 @@
+def migrate(conn):
+    conn.execute("""INSERT INTO article VALUES (2, 'art2')""")
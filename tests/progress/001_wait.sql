@@ -0,0 +1,2 @@
+SELECT pg_sleep(0.5);
+SELECT COUNT(*) FROM progress_locked;
@@ -0,0 +1 @@
+CREATE TABLE article (id int, body text);
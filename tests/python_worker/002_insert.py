@@ -0,0 +1,8 @@
+import multiprocessing
+
+
+def migrate(connection):
+    cur = connection.cursor()
+    # the name of a worker process differs from MainProcess
+    cur.execute("""INSERT INTO article (id, body) VALUES (1, '%s')""" %
+                multiprocessing.current_process().name)
@@ -0,0 +1,4 @@
+def migrate(connection):
+    # exceeds python_migration_memory_limit
+    data = bytearray(1024 * 1024 * 1024)
+    connection.cursor().execute("""CREATE TABLE allocated (size int)""")
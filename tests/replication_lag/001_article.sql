@@ -0,0 +1,2 @@
+CREATE TABLE article (id INTEGER, body TEXT);
+INSERT INTO article VALUES (1, 'art1');
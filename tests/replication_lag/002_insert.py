@@ -0,0 +1,3 @@
+def migrate(conn):
+    with conn.cursor() as cur:
+        cur.execute("""INSERT INTO article (id, body) VALUES (2, 'art2')""")
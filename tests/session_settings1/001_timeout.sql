@@ -0,0 +1,3 @@
+-- a session setting which must not leak into migrations of other dbnicks
+SET statement_timeout = '1234s';
+CREATE TABLE article (id int, body text);
@@ -0,0 +1 @@
+CREATE TABLE setting AS SELECT current_setting('statement_timeout') AS value;
@@ -0,0 +1,7 @@
+import time
+
+
+def migrate(conn):
+    # gives tests time to modify the database
+    time.sleep(1)
+    conn.execute("""INSERT INTO article VALUES (2, 'art2')""")
@@ -0,0 +1 @@
+CREATE TABLE article_log (id int);
@@ -0,0 +1,3 @@
+def migrate(conn):
+    with conn.cursor() as cur:
+        cur.execute("""INSERT INTO article (id, body) VALUES (1, 'art1')""")
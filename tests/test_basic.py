@@ -32,9 +32,15 @@ import subprocess
 import sys
 import imp
 import traceback
+import json
+import time
+import threading
+import shutil
+import sqlite3
 
 
 sys.path.append('.')
+sys.path.append('..')
 
 
 class RunnerBase(object):
@@ -45,9 +51,11 @@ class RunnerBase(object):
         self.config_module = imp.load_source('mschematool_config', self.config)
         self.last_retcode = None
 
-    def run(self, cmd):
+    def run(self, cmd, dbnick=None, options=''):
         os.environ['PYTHONPATH'] = '..'
-        full_cmd = '../mschematool/cli.py --config {self.config} --verbose {self.dbnick} {cmd}'.format(self=self,
+        full_cmd = '../mschematool/cli.py --config {self.config} --verbose {options} {dbnick} {cmd}'.format(self=self,
+                                                                                         options=options,
+                                                                                         dbnick=dbnick or self.dbnick,
                                                                                          cmd=cmd)
         sys.stderr.write(full_cmd + '\n')
         try:
@@ -64,6 +72,12 @@ class RunnerBase(object):
         sys.stderr.write(out.decode('unicode_escape'))
         return out.decode('unicode_escape').strip()
 
+    def db_config(self):
+        databases = self.config_module.DATABASES
+        if callable(databases):
+            return databases(self.dbnick)
+        return databases[self.dbnick]
+
     def close(self):
         pass
 
@@ -116,7 +130,7 @@ class RunnerSqlite3(RunnerBase):
 
         RunnerBase.__init__(self, config, dbnick)
 
-        dbconfig = self.config_module.DATABASES[self.dbnick]
+        dbconfig = self.db_config()
         try:
             os.unlink(dbconfig['database'])
         except OSError:
@@ -129,12 +143,20 @@ class RunnerSqlite3(RunnerBase):
 
     def close(self):
         try:
-            dbconfig = self.config_module.DATABASES[self.dbnick]
+            dbconfig = self.db_config()
             os.unlink(dbconfig['database'])
         except OSError:
             pass
 
 
+COMPRESSED_MIGRATIONS = [
+    'm20140615132455_init.sql',
+    'm20140615132456_init2.sql',
+    'm20140615132613_insert1.sql',
+    'm20140615133009_insert2.sql',
+]
+
+
 ### Tests common to all databases
 
 class CommonTests(object):
@@ -198,6 +220,36 @@ class PostgresTestBasic(PostgresTestBase, CommonTests):
         out = self.r.run('latest_synced')
         assert out.endswith('m20140615135414_insert3.py')
 
+    def testToSyncCheck(self):
+        self.r.run('init_db')
+        self.r.run('to_sync --check')
+        self.assertEqual(1, self.r.last_retcode)
+        self.r.run('sync')
+        self.r.run('to_sync --check')
+        self.assertEqual(0, self.r.last_retcode)
+
+    def testDigest(self):
+        from mschematool import core
+
+        self.r.run('init_db')
+        self.r.run('sync')
+        with self.r.cursor() as cur:
+            cur.execute("""SELECT migration_count, digest FROM public.migration_digest""")
+            stored = tuple(cur.fetchone())
+        synced = self.r.run('synced').splitlines()
+        self.assertEqual(core.migrations_digest(synced), stored)
+
+    def testWithoutDigestTable(self):
+        # databases initialized by older versions
+        self.r.run('init_db')
+        with self.r.cursor() as cur:
+            cur.execute("""DROP TABLE public.migration_digest""")
+        self.r.conn.commit()
+        self.r.run('sync')
+        self.assertEqual(0, self.r.last_retcode)
+        self.r.run('to_sync --check')
+        self.assertEqual(0, self.r.last_retcode)
+
     def testForceSyncSingle(self):
         self.r.run('init_db')
         self.r.run('force_sync_single m20140615132456_init2.sql')
@@ -279,6 +331,475 @@ class PostgresTestDifferentSchema(PostgresTestBase):
         assert out.endswith('004_phone.sql')
 
 
+class PostgresTestMultipleDbnicks(PostgresTestBase):
+
+    def setUp(self):
+        PostgresTestBase.setUp(self)
+        with self.r.cursor() as cur:
+            cur.execute("""CREATE SCHEMA hooli""")
+            cur.execute("""COMMIT""")
+
+    def testSync(self):
+        self.r.run('init_db', dbnick='default,different_schema')
+        out = self.r.run('sync', dbnick='default,different_schema')
+        self.assertIn('[different_schema]', out)
+
+        out = self.r.run('latest_synced', dbnick='different_schema')
+        assert out.endswith('004_phone.sql')
+        with self.r.cursor() as cur:
+            cur.execute("""SELECT COUNT(*) FROM article""")
+            self.assertEqual(4, cur.fetchone()[0])
+
+    def testPattern(self):
+        out = self.r.run('init_db', dbnick='d*')
+        self.assertEqual(['[default]', '[different_schema]'], out.splitlines())
+
+    def testSessionSettingsDontLeak(self):
+        self.r.run('init_db', dbnick='session_settings*')
+        self.r.run('sync', dbnick='session_settings*')
+        self.assertEqual(0, self.r.last_retcode)
+        with self.r.cursor() as cur:
+            cur.execute("""SELECT value FROM setting""")
+            self.assertEqual('0', cur.fetchone()[0])
+
+
+class PostgresTestFanout(PostgresTestBase):
+    dbnick = 'fanout'
+    schemas = ['tenant1', 'tenant2', 'tenant3']
+
+    def setUp(self):
+        PostgresTestBase.setUp(self)
+        with self.r.cursor() as cur:
+            for schema in self.schemas:
+                cur.execute("""CREATE SCHEMA %s""" % schema)
+            cur.execute("""COMMIT""")
+
+    def testSync(self):
+        self.r.run('init_db')
+        out = self.r.run('to_sync')
+        self.assertEqual(6, len(out.splitlines()))
+
+        out = self.r.run('sync')
+        self.assertEqual(['%s: Executed 2 migrations, latest 002_insert.py' % schema
+                          for schema in self.schemas], out.splitlines())
+        for schema in self.schemas:
+            with self.r.cursor() as cur:
+                cur.execute("""SELECT id FROM %s.article ORDER BY id""" % schema)
+                self.assertEqual([1, 2], [r[0] for r in cur.fetchall()])
+
+        out = self.r.run('latest_synced')
+        self.assertEqual(['%s: 002_insert.py' % schema for schema in self.schemas],
+                         out.splitlines())
+
+    def testSchemasQuery(self):
+        self.r.run('init_db', dbnick='fanout_query')
+        self.r.run('force_sync_single 001_article.sql', dbnick='fanout_query')
+        out = self.r.run('sync', dbnick='fanout_query')
+        self.assertEqual(['%s: Executed 1 migrations, latest 002_insert.py' % schema
+                          for schema in self.schemas], out.splitlines())
+
+    def testFailedTenant(self):
+        with self.r.cursor() as cur:
+            cur.execute("""CREATE TABLE tenant2.article (id int)""")
+            cur.execute("""COMMIT""")
+        self.r.run('init_db')
+        out = self.r.run('sync')
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertIn('tenant2: Error while executing 001_article.sql', out)
+        out = self.r.run('latest_synced')
+        self.assertEqual(['tenant1: 002_insert.py', 'tenant2: No synced migrations',
+                          'tenant3: 002_insert.py'], out.splitlines())
+
+    def testPublicInSearchPath(self):
+        with self.r.cursor() as cur:
+            cur.execute("""CREATE FUNCTION public.tenant_greeting() RETURNS text
+                           AS $$ SELECT 'hello'::text $$ LANGUAGE sql""")
+            cur.execute("""COMMIT""")
+        self.r.run('init_db', dbnick='fanout_public')
+        self.r.run('sync', dbnick='fanout_public')
+        self.assertEqual(0, self.r.last_retcode)
+        for schema in self.schemas:
+            with self.r.cursor() as cur:
+                cur.execute("""SELECT body FROM %s.article""" % schema)
+                self.assertEqual(['hello'], [r[0] for r in cur.fetchall()])
+        with self.r.cursor() as cur:
+            cur.execute("""SELECT to_regclass('public.article')""")
+            self.assertIsNone(cur.fetchone()[0])
+
+    def testNonTransactional(self):
+        self.r.run('init_db', dbnick='fanout_non_transactional')
+        out = self.r.run('sync', dbnick='fanout_non_transactional')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertEqual(['%s: Executed 2 migrations, latest 002_index.sql' % schema
+                          for schema in self.schemas], out.splitlines())
+        with self.r.cursor() as cur:
+            cur.execute("""SELECT schemaname FROM pg_indexes WHERE indexname = 'article_body'
+                           ORDER BY schemaname""")
+            self.assertEqual(self.schemas, [r[0] for r in cur.fetchall()])
+
+    def testPythonMigrationWorker(self):
+        import zipfile
+
+        archive = '/tmp/pgtest_fanout_migrations.zip'
+        with zipfile.ZipFile(archive, 'w') as zf:
+            for fn in ['001_article.sql', '002_insert.py']:
+                zf.write(os.path.join('python_worker', fn), 'migrations/%s' % fn)
+        try:
+            self.r.run('init_db', dbnick='fanout_worker')
+            out = self.r.run('sync', dbnick='fanout_worker')
+        finally:
+            os.unlink(archive)
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertEqual(['%s: Executed 2 migrations, latest 002_insert.py' % schema
+                          for schema in self.schemas], out.splitlines())
+        for schema in self.schemas:
+            with self.r.cursor() as cur:
+                cur.execute("""SELECT body FROM %s.article""" % schema)
+                self.assertEqual(['mschematool-migration'], [r[0] for r in cur.fetchall()])
+
+
+class PostgresTestCoalesceInserts(PostgresTestBase):
+    dbnick = 'coalesce'
+
+    def testSync(self):
+        self.r.run('init_db')
+        self.r.run('sync')
+        with self.r.cursor() as cur:
+            cur.execute("""SELECT id, body FROM article ORDER BY id""")
+            rows = [tuple(r) for r in cur.fetchall()]
+        self.assertEqual([(1, 'art1 updated'), (2, "it's (2), (3)"), (3, 'art3'),
+                          (4, 'art4'), (5, 'art5'), (6, 'art6')], rows)
+        with self.r.cursor() as cur:
+            # rows with subqueries aren't merged, so each one sees the preceding ones
+            cur.execute("""SELECT id, "a  b" FROM counter ORDER BY id""")
+            rows = [tuple(r) for r in cur.fetchall()]
+        self.assertEqual([(-11, None), (1, 'x'), (2, 'x'), (3, 'x'), (10, 'y')], rows)
+
+    def testError(self):
+        self.r.run('init_db', dbnick='coalesce_error')
+        self.r.run('sync', dbnick='coalesce_error')
+        self.assertNotEqual(0, self.r.last_retcode)
+        out = self.r.run('synced', dbnick='coalesce_error')
+        self.assertEqual('', out)
+
+
+class PostgresTestCompressed(PostgresTestBase):
+    dbnick = 'compressed'
+
+    def testSync(self):
+        self.r.run('init_db')
+        out = self.r.run('to_sync')
+        self.assertEqual(COMPRESSED_MIGRATIONS, out.splitlines())
+        self.r.run('sync')
+        out = self.r.run('synced')
+        self.assertEqual(COMPRESSED_MIGRATIONS, out.splitlines())
+        with self.r.cursor() as cur:
+            cur.execute("""SELECT COUNT(*) FROM article""")
+            self.assertEqual(3, cur.fetchone()[0])
+
+
+class PostgresTestProgress(PostgresTestBase):
+    dbnick = 'progress'
+
+    def testLockWait(self):
+        import threading
+
+        with self.r.cursor() as cur:
+            cur.execute("""CREATE TABLE progress_locked (id int)""")
+            self.r.conn.commit()
+            cur.execute("""LOCK TABLE progress_locked IN ACCESS EXCLUSIVE MODE""")
+        release = threading.Timer(1.5, self.r.conn.rollback)
+        release.start()
+        self.r.run('init_db')
+        out = self.r.run('sync')
+        release.join()
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertTrue('[progress]' in out and 'running SELECT pg_sleep(0.5)' in out, out)
+        self.assertTrue('waiting for AccessShareLock on relation progress_locked, blocked by' in out,
+                        out)
+        out = self.r.run('synced')
+        self.assertEqual('001_wait.sql', out)
+
+
+class PostgresTestRehearse(PostgresTestBase):
+
+    def setUp(self):
+        PostgresTestBase.setUp(self)
+        # the cloned database must not be used by other sessions
+        self.r.conn.close()
+
+    def databases(self):
+        return subprocess.check_output(['psql', '-d', 'postgres', '-Atc',
+                                        'SELECT datname FROM pg_database']).decode().split()
+
+    def testRehearse(self):
+        self.r.run('init_db')
+        out = self.r.run('rehearse --top 1')
+        self.assertEqual(0, self.r.last_retcode)
+        lines = out.splitlines()
+        self.assertTrue(lines[0].startswith('m20140615132455_init.sql '), lines)
+        self.assertIn('  lock AccessExclusiveLock on public.article held ', out)
+        self.assertIn('  lock RowExclusiveLock on public.article held ', out)
+        self.assertTrue(lines[-2].startswith('Total: '), lines)
+        self.assertTrue(lines[-1].startswith('Longest lock: '), lines)
+        # only the first of two statements of insert2
+        self.assertEqual(1, len([line for line in lines if 'INSERT INTO article (id, body) VALUES (2' in line
+                                 or 'INSERT INTO article (id, body) VALUES (3' in line]))
+        self.assertEqual('', self.r.run('synced'))
+        self.assertEqual(5, len(self.r.run('to_sync').splitlines()))
+        self.assertEqual([], [db for db in self.databases() if 'rehearse' in db])
+
+    def testFailed(self):
+        self.r.run('init_db', dbnick='error')
+        out = self.r.run('rehearse', dbnick='error')
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertIn(', failed: ', out)
+        self.assertEqual([], [db for db in self.databases() if 'rehearse' in db])
+
+
+class PostgresTestReplicationLag(PostgresTestBase):
+    dbnick = 'replication_lag'
+
+    def setLag(self, lag):
+        cur = self.r.cursor()
+        cur.execute("""UPDATE fake_lag SET lag = %s""", [lag])
+        self.r.conn.commit()
+
+    def setUp(self):
+        PostgresTestBase.setUp(self)
+        cur = self.r.cursor()
+        cur.execute("""CREATE TABLE fake_lag (lag FLOAT)""")
+        cur.execute("""INSERT INTO fake_lag VALUES (0)""")
+        self.r.conn.commit()
+        self.r.run('init_db')
+
+    def testNoLag(self):
+        out = self.r.run('sync')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertNotIn('[throttle]', out)
+        self.assertNotIn('Throttled', out)
+
+    def testThrottled(self):
+        self.setLag(5)
+        timer = threading.Timer(1, self.setLag, [0.5])
+        timer.start()
+        out = self.r.run('sync')
+        timer.join()
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertIn('[throttle] Replication lag 5.0s is above 1s, pausing', out)
+        self.assertIn('Throttled for', out)
+
+    def testPassedConnectionWithoutDsn(self):
+        from mschematool import api
+
+        db_config = dict(self.r.db_config())
+        del db_config['dsn']
+        db_config['progress_interval'] = 1
+        self.setLag(5)
+        # the password of a passed connection isn't available for side connections
+        with api.from_db_config(db_config, connection=self.r.conn) as schema:
+            self.assertIsNone(schema.tool.migrations.governor)
+            self.assertTrue(schema.sync().ok)
+        self.assertEqual(['001_article.sql', '002_insert.py'], self.r.run('synced').splitlines())
+        cur = self.r.cursor()
+        cur.execute("""SELECT COUNT(*) FROM article""")
+        self.assertEqual(2, cur.fetchone()[0])
+
+    def testThrottledPython(self):
+        self.r.run('force_sync_single 001_article.sql')
+        self.setLag(5)
+        timer = threading.Timer(1, self.setLag, [0])
+        timer.start()
+        out = self.r.run('sync')
+        timer.join()
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertEqual(['Executing 002_insert.py',
+                          '  [throttle] Replication lag 5.0s is above 1s, pausing'], out.splitlines()[:2])
+        self.assertTrue(out.splitlines()[-1].startswith('Throttled for 1.'), out)
+
+
+class PostgresTestAnalyze(PostgresTestBase):
+    dbnick = 'analyze'
+
+    def setUp(self):
+        PostgresTestBase.setUp(self)
+        cur = self.r.cursor()
+        cur.execute("""CREATE TABLE article (id int, body text)""")
+        cur.execute("""INSERT INTO article SELECT i, repeat('x', 100) FROM generate_series(1, 1000) i""")
+        cur.execute("""ANALYZE article""")
+        self.r.conn.commit()
+        self.r.run('init_db')
+
+    def testAnalyze(self):
+        out = self.r.run('analyze')
+        self.assertEqual(1, self.r.last_retcode)
+        lines = out.splitlines()
+        self.assertIn('  ok      CREATE INDEX comment_article ON comment (article_id)', lines)
+        self.assertIn('          SHARE lock on comment, new table', lines)
+        self.assertIn('  DANGER  ALTER TABLE article ALTER COLUMN body TYPE varchar(200)', lines)
+        self.assertIn('          ACCESS EXCLUSIVE lock on article, rewrite of ', out)
+        self.assertIn('~1000 rows', out)
+        self.assertIn('  warning ALTER TABLE article ADD COLUMN title text', lines)
+        self.assertIn('  DANGER  ALTER TABLE article ADD COLUMN seq bigserial', lines)
+        self.assertIn('  DANGER  ALTER TABLE article ADD COLUMN num int GENERATED BY DEFAULT AS IDENTITY', lines)
+        self.assertIn('  warning ALTER TABLE article VALIDATE CONSTRAINT article_id_positive', lines)
+        self.assertIn('  warning UPDATE article SET title = body', lines)
+        self.assertIn('  DANGER  ALTER TABLE article ALTER COLUMN id SET NOT NULL', lines)
+        self.assertIn('  error   CREATE INDEX CONCURRENTLY article_id ON article (id)', lines)
+        self.assertNotIn('INSERT INTO comment', out)
+        self.assertEqual('13 statements analyzed: 4 dangerous, 4 warnings, 1 errors', lines[-1])
+        self.assertEqual('', self.r.run('synced'))
+
+    def testRewritingColumns(self):
+        from mschematool import analysis
+
+        for statement in ['ALTER TABLE article ADD COLUMN IF NOT EXISTS seq serial4',
+                          'ALTER TABLE article ADD seq smallserial NOT NULL',
+                          'ALTER TABLE article ADD COLUMN num bigint GENERATED ALWAYS AS IDENTITY']:
+            finding = analysis.analyze_statement('m', statement)
+            self.assertEqual((analysis.ACCESS_EXCLUSIVE, analysis.REWRITE), (finding.lock, finding.effect))
+        finding = analysis.analyze_statement('m', 'ALTER TABLE article ADD COLUMN serial_no int')
+        self.assertIsNone(finding.effect)
+
+    def testIndexRules(self):
+        from mschematool import analysis
+
+        for statement, lock in [('CREATE INDEX ON article (id)', analysis.SHARE),
+                                ('CREATE UNIQUE INDEX IF NOT EXISTS "article id" ON ONLY article (id)',
+                                 analysis.SHARE),
+                                ('CREATE INDEX CONCURRENTLY ON article (id)', analysis.SHARE_UPDATE_EXCLUSIVE),
+                                ('CREATE INDEX CONCURRENTLY IF NOT EXISTS article_id ON article (id)',
+                                 analysis.SHARE_UPDATE_EXCLUSIVE)]:
+            finding = analysis.analyze_statement('m', statement)
+            self.assertEqual(('article', lock, analysis.SCAN), (finding.table, finding.lock, finding.effect))
+
+
+class PostgresTestPythonWorker(PostgresTestBase):
+    dbnick = 'python_worker'
+
+    def testSync(self):
+        self.r.run('init_db')
+        out = self.r.run('sync')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertIn('Peak RSS of the worker process: ', out)
+        self.assertEqual(['001_article.sql', '002_insert.py'], self.r.run('synced').splitlines())
+        cur = self.r.cursor()
+        cur.execute("""SELECT body FROM article""")
+        self.assertEqual(['mschematool-migration'], [row[0] for row in cur.fetchall()])
+
+    def testSingleTransaction(self):
+        self.r.run('init_db')
+        self.r.run('sync --single-transaction')
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertEqual('', self.r.run('synced'))
+
+
+class PostgresTestSingleTransaction(PostgresTestBase):
+    dbnick = 'single_transaction'
+
+    def _table_exists(self, table):
+        with self.r.cursor() as cur:
+            cur.execute("""SELECT to_regclass(%s) IS NOT NULL""", [table])
+            exists = cur.fetchone()[0]
+        self.r.conn.rollback()
+        return exists
+
+    def testSync(self):
+        self.r.run('init_db')
+        out = self.r.run('sync --single-transaction')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertTrue(out.endswith('Committed 3 migrations'), out)
+        out = self.r.run('synced')
+        self.assertEqual(['001_article.sql', '002_log.sql', '003_insert.py'], out.splitlines())
+        with self.r.cursor() as cur:
+            cur.execute("""SELECT COUNT(*) FROM article""")
+            self.assertEqual(1, cur.fetchone()[0])
+
+    def testRollback(self):
+        self.r.run('init_db')
+        with self.r.cursor() as cur:
+            cur.execute("""CREATE TABLE article_log (id int)""")
+        self.r.conn.commit()
+        self.r.run('sync --single-transaction')
+        self.assertNotEqual(0, self.r.last_retcode)
+        self.assertEqual('', self.r.run('synced'))
+        self.assertFalse(self._table_exists('article'))
+
+    def testRejectNonTransactional(self):
+        self.r.run('init_db', dbnick='non_transactional')
+        self.r.run('sync --single-transaction', dbnick='non_transactional')
+        self.assertNotEqual(0, self.r.last_retcode)
+        self.assertEqual('', self.r.run('synced', dbnick='non_transactional'))
+        self.assertFalse(self._table_exists('article'))
+
+    def testNonTransactional(self):
+        self.r.run('init_db', dbnick='non_transactional')
+        self.r.run('sync', dbnick='non_transactional')
+        self.assertEqual(0, self.r.last_retcode)
+        out = self.r.run('synced', dbnick='non_transactional')
+        self.assertEqual(['001_article.sql', '002_index.sql'], out.splitlines())
+        self.assertTrue(self._table_exists('article_body'))
+
+
+class PostgresTestWorkQueue(PostgresTestBase):
+    dbnick = 'pg_coordinator'
+
+    def setUp(self):
+        PostgresTestBase.setUp(self)
+        self.fleet = [RunnerSqlite3('config_basic.py', 'sqlite3_fleet1'),
+                      RunnerSqlite3('config_basic.py', 'sqlite3_fleet2')]
+
+    def tearDown(self):
+        for r in self.fleet:
+            r.close()
+        PostgresTestBase.tearDown(self)
+
+    def testParallelWorkers(self):
+        for r in self.fleet:
+            r.run('init_db')
+        self.r.run("queue_add 'sqlite3_fleet*'")
+        workers = [subprocess.Popen(shlex.split('../mschematool/cli.py --config config_basic.py '
+                                                'pg_coordinator queue_work --worker-id w%d' % i),
+                                    stdout=subprocess.PIPE) for i in range(2)]
+        for worker in workers:
+            worker.communicate()
+            self.assertEqual(0, worker.returncode)
+        out = self.r.run('queue_status')
+        self.assertEqual(2, len(out.splitlines()))
+        self.assertTrue(all(': done w' in line and line.endswith(' 1 executed 5 migrations')
+                            for line in out.splitlines()), out)
+        for r in self.fleet:
+            cur = r.cursor()
+            cur.execute("""SELECT COUNT(*) FROM article""")
+            self.assertEqual(4, cur.fetchone()[0])
+
+
+class PostgresTestStatus(PostgresTestBase):
+
+    def testUnreachable(self):
+        self.r.run('init_db')
+        self.r.run('sync')
+        started = time.time()
+        out = self.r.run('status --timeout 2', dbnick='pg_unreachable,default')
+        self.assertLess(time.time() - started, 10)
+        self.assertEqual(1, self.r.last_retcode)
+        header, unreachable, default = out.splitlines()
+        self.assertTrue(unreachable.startswith('pg_unreachable       -       -  error: '), unreachable)
+        self.assertEqual('default              5       0  m20140615135414_insert3.py', default)
+
+    def testQueryTimeout(self):
+        self.r.run('init_db')
+        with self.r.cursor() as cur:
+            # status waits for the lock until the transaction ends
+            cur.execute("""LOCK TABLE public.migration IN ACCESS EXCLUSIVE MODE""")
+            started = time.time()
+            out = self.r.run('status --timeout 1')
+            self.assertLess(time.time() - started, 10)
+        self.r.conn.rollback()
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertIn('error: canceling statement due to statement timeout', out)
+
+
 ### Cassandra tests
 
 
@@ -334,6 +855,47 @@ class CassandraTestBasic(unittest.TestCase, CommonTests):
         assert out.endswith('_xxx.cql'), out
 
 
+class CassandraTestSchemaAgreement(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerCassandra('config_basic.py', 'cass_schema_agreement')
+
+    def tearDown(self):
+        s = self.r.session()
+        s.execute("""DROP KEYSPACE IF EXISTS migrations""")
+        s.execute("""DROP KEYSPACE IF EXISTS mtest""")
+        self.r.close()
+
+    def testSync(self):
+        self.r.run('init_db')
+        self.r.run('sync')
+        s = self.r.session()
+        rows = s.execute("""SELECT COUNT(*) FROM mtest.article""")
+        self.assertEqual(4, rows[0].count)
+        out = self.r.run('latest_synced')
+        assert out.endswith('m20140615133009_insert2.cql'), repr(out)
+
+
+class CassandraTestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerCassandra('config_basic.py', 'cass_batch')
+
+    def tearDown(self):
+        s = self.r.session()
+        s.execute("""DROP KEYSPACE IF EXISTS migrations""")
+        s.execute("""DROP KEYSPACE IF EXISTS mtest""")
+        self.r.close()
+
+    def testSync(self):
+        self.r.run('init_db')
+        self.r.run('sync')
+        self.assertEqual(0, self.r.last_retcode)
+        s = self.r.session()
+        rows = s.execute("""SELECT COUNT(*) FROM mtest.article""")
+        self.assertEqual(101, rows[0].count)
+
+
 ### Sqlite3 tests
 
 class Sqlite3TestBasic(unittest.TestCase, CommonTests):
@@ -369,6 +931,14 @@ class Sqlite3TestBasic(unittest.TestCase, CommonTests):
         out = self.r.run('latest_synced')
         assert out.endswith('m20140615135414_insert3.py')
 
+    def testToSyncCheck(self):
+        self.r.run('init_db')
+        self.r.run('to_sync --check')
+        self.assertEqual(1, self.r.last_retcode)
+        self.r.run('sync')
+        self.r.run('to_sync --check')
+        self.assertEqual(0, self.r.last_retcode)
+
     def testForceSyncSingle(self):
         self.r.run('init_db')
         self.r.run('force_sync_single m20140615132456_init2.sql')
@@ -390,5 +960,697 @@ class Sqlite3TestBasic(unittest.TestCase, CommonTests):
         assert out.endswith('_xxx.py'), out
 
 
+class Sqlite3TestCoalesceInserts(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_coalesce')
+
+    def tearDown(self):
+        self.r.close()
+
+    def testSync(self):
+        self.r.run('init_db')
+        self.r.run('sync')
+        cur = self.r.cursor()
+        cur.execute("""SELECT id, body FROM article ORDER BY id""")
+        self.assertEqual([(1, 'art1 updated'), (2, "it's (2), (3)"), (3, 'art3'),
+                          (4, 'art4'), (5, 'art5'), (6, 'art6')], cur.fetchall())
+        cur.execute("""SELECT id, "a  b" FROM counter ORDER BY id""")
+        self.assertEqual([(-11, None), (1, 'x'), (2, 'x'), (3, 'x'), (10, 'y')], cur.fetchall())
+
+    def testError(self):
+        self.r.run('init_db', dbnick='sqlite3_coalesce_error')
+        self.r.run('sync', dbnick='sqlite3_coalesce_error')
+        self.assertNotEqual(0, self.r.last_retcode)
+        out = self.r.run('synced', dbnick='sqlite3_coalesce_error')
+        self.assertEqual('', out)
+
+    def testConflictRollback(self):
+        self.r.run('init_db', dbnick='sqlite3_coalesce_rollback')
+        self.r.run('sync', dbnick='sqlite3_coalesce_rollback')
+        self.assertNotEqual(0, self.r.last_retcode)
+        self.assertEqual('', self.r.run('synced', dbnick='sqlite3_coalesce_rollback'))
+
+
+class Sqlite3TestCompressed(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_compressed')
+
+    def tearDown(self):
+        self.r.close()
+
+    def testSync(self):
+        self.r.run('init_db')
+        out = self.r.run('to_sync')
+        self.assertEqual(COMPRESSED_MIGRATIONS, out.splitlines())
+        self.r.run('sync')
+        out = self.r.run('synced')
+        self.assertEqual(COMPRESSED_MIGRATIONS, out.splitlines())
+        cur = self.r.cursor()
+        cur.execute("""SELECT body FROM article WHERE id = 3""")
+        self.assertEqual('art3;\nmultiline', cur.fetchone()[0])
+
+
+class Sqlite3TestPythonWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_python_worker')
+        self.r.run('init_db')
+
+    def tearDown(self):
+        self.r.close()
+
+    def testSync(self):
+        out = self.r.run('sync')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertEqual(['Executing 001_article.sql', 'Executing 002_insert.py'],
+                         out.splitlines()[:2])
+        self.assertTrue(out.splitlines()[2].startswith('Peak RSS of the worker process: '), out)
+        self.assertEqual(['001_article.sql', '002_insert.py'], self.r.run('synced').splitlines())
+        cur = self.r.cursor()
+        cur.execute("""SELECT body FROM article""")
+        self.assertEqual(['mschematool-migration'], [row[0] for row in cur.fetchall()])
+
+    def testForkWithThreads(self):
+        # the prefetching thread is running
+        self.r.run('sync', dbnick='sqlite3_python_worker_fork')
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertEqual(['001_article.sql'], self.r.run('synced').splitlines())
+        self.r.run('sync --prefetch 0', dbnick='sqlite3_python_worker_fork')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertEqual(['001_article.sql', '002_insert.py'], self.r.run('synced').splitlines())
+
+    def testMemoryLimit(self):
+        self.r.run('init_db', dbnick='sqlite3_python_worker_limit')
+        out = self.r.run('sync', dbnick='sqlite3_python_worker_limit')
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertEqual('', self.r.run('synced', dbnick='sqlite3_python_worker_limit'))
+        cur = self.r.cursor()
+        cur.execute("""SELECT name FROM sqlite_master WHERE name = 'allocated'""")
+        self.assertEqual(None, cur.fetchone())
+
+
+class Sqlite3TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_prefetch')
+        self.r.run('init_db')
+
+    def tearDown(self):
+        self.r.close()
+
+    def _testErrorInOrder(self, options):
+        out = self.r.run('sync ' + options)
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertEqual(['Executing 001_article.sql', 'Executing 002_broken.sql'],
+                         out.splitlines()[:2])
+        self.assertEqual(['001_article.sql'], self.r.run('synced').splitlines())
+
+    def testErrorInOrder(self):
+        self._testErrorInOrder('')
+
+    def testErrorInOrderWithoutPrefetch(self):
+        self._testErrorInOrder('--prefetch 0')
+
+    def testSync(self):
+        self.r.run('force_sync_single 001_article.sql')
+        # the broken migration is marked as executed, the rest is prefetched
+        cur = self.r.cursor()
+        cur.execute("""INSERT INTO migration (file, executed) VALUES ('002_broken.sql', 0)""")
+        self.r.conn.commit()
+        out = self.r.run('sync --prefetch 1')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertEqual(['Executing 003_insert.sql', 'Executing 004_insert.py'], out.splitlines())
+        cur.execute("""SELECT COUNT(*) FROM article""")
+        self.assertEqual(2, cur.fetchone()[0])
+
+
+class Sqlite3TestEstimate(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_default')
+        self.staging = RunnerSqlite3('config_basic.py', 'sqlite3_staging')
+
+    def tearDown(self):
+        self.r.close()
+        self.staging.close()
+
+    def testHeuristic(self):
+        self.r.run('init_db')
+        out = self.r.run('estimate --source sqlite3_default').splitlines()
+        self.assertEqual(6, len(out))
+        self.assertTrue(out[0].startswith('m20140615132455_init.sql ~'))
+        self.assertTrue(all(line.endswith('(heuristic)') for line in out[:5]))
+        self.assertTrue(out[5].startswith('Total: ~'))
+        self.assertTrue(out[5].endswith('for 5 migrations'))
+
+    def testRecorded(self):
+        self.staging.run('init_db')
+        self.staging.run('sync')
+        self.r.run('init_db')
+        self.r.run('force_sync_single m20140615132455_init.sql')
+        out = self.r.run('estimate --source sqlite3_staging').splitlines()
+        self.assertEqual(5, len(out))
+        self.assertTrue(out[0].startswith('m20140615132456_init2.sql ~'))
+        self.assertTrue(all(line.endswith('(recorded on sqlite3_staging)') for line in out[:4]))
+
+    def testSyncProgress(self):
+        self.r.run('init_db')
+        out = self.r.run('sync --progress').splitlines()
+        self.assertTrue(out[0].startswith('Estimated time: ~'))
+        self.assertTrue(out[-1].startswith('Done 5/5 in '))
+        out = self.r.run('estimate --source sqlite3_default')
+        self.assertEqual('No migrations to sync', out.strip())
+
+
+class Sqlite3TestProfile(unittest.TestCase):
+    profile_out = '/tmp/sqlite3test.prof'
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_default')
+
+    def tearDown(self):
+        self.r.close()
+        try:
+            os.unlink(self.profile_out)
+        except OSError:
+            pass
+
+    def testProfileOut(self):
+        import pstats
+
+        self.r.run('init_db')
+        self.r.run('sync', options='--profile --profile-out %s' % self.profile_out)
+        self.assertEqual(0, self.r.last_retcode)
+        out = self.r.run('synced')
+        self.assertEqual(5, len(out.splitlines()))
+        stats = pstats.Stats(self.profile_out)
+        self.assertTrue(stats.total_calls > 0)
+
+
+class Sqlite3TestZip(unittest.TestCase):
+    archive = '/tmp/sqlite3test_migrations.zip'
+
+    def setUp(self):
+        import gzip
+        import zipfile
+
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_zip')
+        with zipfile.ZipFile(self.archive, 'w') as zf:
+            for fn in sorted(os.listdir('migrations1')):
+                if not fn.startswith('m'):
+                    continue
+                with open(os.path.join('migrations1', fn), 'rb') as f:
+                    content = f.read()
+                if fn == 'm20140615133009_insert2.sql':
+                    zf.writestr('migrations/%s.gz' % fn, gzip.compress(content))
+                else:
+                    zf.writestr('migrations/%s' % fn, content)
+            zf.writestr('other/m20140615140000_ignored.sql', 'CREATE TABLE ignored (id int);')
+
+    def tearDown(self):
+        self.r.close()
+        os.unlink(self.archive)
+
+    def testSync(self):
+        self.r.run('init_db')
+        out = self.r.run('to_sync')
+        self.assertEqual(5, len(out.split('\n')))
+        self.r.run('sync')
+        cur = self.r.cursor()
+        cur.execute("""SELECT COUNT(*) FROM article""")
+        self.assertEqual(4, cur.fetchone()[0])
+        out = self.r.run('latest_synced')
+        assert out.endswith('m20140615135414_insert3.py')
+
+    def testPrintNew(self):
+        out = self.r.run('print_new xxx')
+        assert out.startswith('m') and out.endswith('_xxx.sql'), out
+
+
+class Sqlite3TestLazyDatabases(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_lazy.py', 'sqlite3_lazy1')
+        self.r2 = RunnerSqlite3('config_lazy.py', 'sqlite3_lazy2')
+
+    def tearDown(self):
+        self.r.close()
+        self.r2.close()
+
+    def testSingle(self):
+        self.r.run('init_db')
+        self.assertEqual(0, self.r.last_retcode)
+        self.r.run('sync')
+        cur = self.r.cursor()
+        cur.execute("""SELECT COUNT(*) FROM article""")
+        self.assertEqual(4, cur.fetchone()[0])
+
+    def testPattern(self):
+        self.r.run('init_db', dbnick="'sqlite3_lazy*'")
+        self.assertEqual(0, self.r.last_retcode)
+        out = self.r.run('to_sync', dbnick="'sqlite3_lazy*'")
+        self.assertEqual(12, len(out.splitlines()))
+
+    def testNotFound(self):
+        self.r.run('to_sync', dbnick='sqlite3_other')
+        self.assertEqual(1, self.r.last_retcode)
+
+
+class Sqlite3TestApi(unittest.TestCase):
+    database = '/tmp/sqlite3test_api.sql'
+
+    def setUp(self):
+        import sqlite3
+        from mschematool import api
+
+        self.tearDown()
+        self.conn = sqlite3.connect(self.database)
+        self.schema = api.from_db_config({
+            'migrations_dir': 'migrations1',
+            'engine': 'sqlite3',
+        }, connection=self.conn)
+
+    def tearDown(self):
+        try:
+            os.unlink(self.database)
+        except OSError:
+            pass
+
+    def testSync(self):
+        self.schema.initialize()
+        pending = self.schema.pending()
+        self.assertEqual(5, len(pending))
+        self.assertEqual('m20140615132455_init.sql', pending[0].name)
+        result = self.schema.sync()
+        self.assertTrue(result.ok)
+        self.assertEqual([m.name for m in pending], [m.name for m in result.executed])
+        self.assertEqual([], self.schema.pending())
+        applied = self.schema.applied()
+        self.assertEqual([m.name for m in pending], [m.name for m in applied])
+        self.assertTrue(all(m.duration is not None for m in applied))
+        self.assertTrue(self.schema.is_synced())
+        # the connection passed by the caller is used and left without a row factory
+        self.assertEqual((4,), self.conn.execute("""SELECT COUNT(*) FROM article""").fetchone())
+
+    def testError(self):
+        self.schema.initialize()
+        self.conn.execute("""CREATE TABLE article (id int)""")
+        self.conn.commit()
+        result = self.schema.sync()
+        self.assertFalse(result.ok)
+        self.assertEqual(1, len(result.migrations))
+        self.assertEqual('m20140615132455_init.sql', result.migrations[0].name)
+        self.assertTrue('already exists' in str(result.errors[0]))
+        self.assertEqual([], self.schema.applied())
+
+    def testOwnConnections(self):
+        import sqlite3
+        from mschematool import api
+
+        db_config = {'migrations_dir': 'migrations1', 'engine': 'sqlite3', 'database': self.database}
+        with api.from_db_config(db_config) as schema:
+            schema.initialize()
+            conn = schema.tool.migrations.conn
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute, 'SELECT 1')
+        # a recreated database file is opened again
+        self.tearDown()
+        schema = api.from_db_config(db_config)
+        self.assertIsNot(conn, schema.tool.migrations.conn)
+        schema.initialize()
+        self.assertTrue(schema.sync().ok)
+        schema.close()
+
+    def testLoggingNotConfigured(self):
+        import logging
+        from mschematool import api
+
+        logger = logging.getLogger('mschematool')
+        handlers, level = list(logger.handlers), logger.level
+        for _ in range(3):
+            api.open('config_basic.py', 'sqlite3_default').close()
+        self.assertEqual(handlers, logger.handlers)
+        self.assertEqual(level, logger.level)
+
+
+class Sqlite3TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_coordinator')
+        self.fleet = [RunnerSqlite3('config_basic.py', 'sqlite3_fleet1'),
+                      RunnerSqlite3('config_basic.py', 'sqlite3_fleet2')]
+        for r in self.fleet:
+            r.run('init_db')
+
+    def tearDown(self):
+        self.r.close()
+        for r in self.fleet:
+            r.close()
+
+    def testWork(self):
+        out = self.r.run("queue_add 'sqlite3_fleet*'")
+        self.assertEqual('Added 2 dbnicks', out)
+        out = self.r.run('queue_work --worker-id w1')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertEqual(['sqlite3_fleet1: executed 5 migrations',
+                          'sqlite3_fleet2: executed 5 migrations'], out.splitlines())
+        out = self.r.run('queue_status')
+        self.assertEqual(['sqlite3_fleet1: done w1 1 executed 5 migrations',
+                          'sqlite3_fleet2: done w1 1 executed 5 migrations'], out.splitlines())
+
+    def testExpiredLeases(self):
+        self.r.run('queue_add sqlite3_fleet1,sqlite3_fleet2')
+        cur = self.r.cursor()
+        # a crashed worker, and a database which crashed workers too many times
+        cur.execute("""UPDATE mschematool_queue SET status = 'running', worker = 'crashed',
+                       lease_until = 1, attempts = 1 WHERE dbnick = 'sqlite3_fleet1'""")
+        cur.execute("""UPDATE mschematool_queue SET status = 'running', worker = 'crashed',
+                       lease_until = 1, attempts = 3 WHERE dbnick = 'sqlite3_fleet2'""")
+        self.r.conn.commit()
+        out = self.r.run('queue_work --worker-id w1')
+        self.assertEqual('sqlite3_fleet1: executed 5 migrations', out)
+        out = self.r.run('queue_status')
+        self.assertEqual(['sqlite3_fleet1: done w1 2 executed 5 migrations',
+                          'sqlite3_fleet2: failed 3 lease expired after 3 attempts'], out.splitlines())
+
+    def testSyncError(self):
+        self.fleet[1].cursor().execute("""DROP TABLE migration""")
+        self.fleet[1].conn.commit()
+        self.r.run('queue_add sqlite3_fleet2')
+        out = self.r.run('queue_work')
+        self.assertNotEqual(0, self.r.last_retcode)
+        self.assertTrue(out.startswith('sqlite3_fleet2: error'), out)
+
+    def testLeaseLost(self):
+        slow = RunnerSqlite3('config_basic.py', 'sqlite3_slow_fleet')
+        slow.run('init_db')
+        self.r.run('queue_add sqlite3_slow_fleet')
+
+        def take_over():
+            # another worker claims the entry while the first migration is executed
+            conn = sqlite3.connect(self.r.db_config()['database'])
+            try:
+                while conn.execute("""SELECT worker FROM mschematool_queue""").fetchone()[0] != 'w1':
+                    time.sleep(0.05)
+                conn.execute("""UPDATE mschematool_queue SET worker = 'w2', lease_until = ?""",
+                             (time.time() + 60,))
+                conn.commit()
+            finally:
+                conn.close()
+        thread = threading.Thread(target=take_over)
+        thread.start()
+        try:
+            out = self.r.run('queue_work --worker-id w1 --lease 0.9')
+        finally:
+            thread.join()
+            synced = slow.run('synced')
+            slow.close()
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertEqual('sqlite3_slow_fleet: error: Lease of sqlite3_slow_fleet was lost, the sync '
+                         'was stopped', out)
+        self.assertEqual('001_slow.py', synced)
+        out = self.r.run('queue_status')
+        self.assertTrue(out.startswith('sqlite3_slow_fleet: running w2'), out)
+
+
+class Sqlite3TestStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.fleet = [RunnerSqlite3('config_basic.py', 'sqlite3_fleet1'),
+                      RunnerSqlite3('config_basic.py', 'sqlite3_fleet2')]
+
+    def tearDown(self):
+        for r in self.fleet:
+            r.close()
+
+    def testTable(self):
+        self.fleet[0].run('init_db')
+        self.fleet[0].run('force_sync_single m20140615132455_init.sql')
+        self.fleet[1].run('init_db')
+        self.fleet[1].run('sync')
+        out = self.fleet[0].run('status', dbnick="'sqlite3_fleet*,sqlite3_missing'")
+        self.assertEqual(1, self.fleet[0].last_retcode)
+        self.assertEqual(['dbnick          applied pending  latest',
+                          'sqlite3_fleet1        1       4  m20140615132455_init.sql',
+                          'sqlite3_fleet2        5       0  m20140615135414_insert3.py',
+                          'sqlite3_missing       -       -  error: Not found in DATABASES in config: sqlite3_missing'],
+                         out.splitlines())
+
+    def testJson(self):
+        out = self.fleet[0].run('status --format json --jobs 1', dbnick='sqlite3_fleet1')
+        self.assertEqual(1, self.fleet[0].last_retcode)
+        self.assertEqual([{'dbnick': 'sqlite3_fleet1', 'target': None, 'applied': None,
+                           'pending': None, 'latest': None, 'error': 'no such table: migration'}],
+                         json.loads(out))
+        self.fleet[0].run('init_db')
+        out = self.fleet[0].run('status --format json', dbnick='sqlite3_fleet1')
+        self.assertEqual(0, self.fleet[0].last_retcode)
+        self.assertEqual(5, json.loads(out)[0]['pending'])
+
+
+class Sqlite3TestShards(unittest.TestCase):
+    shards_dir = '/tmp/sqlite3test_shards'
+
+    def setUp(self):
+        shutil.rmtree(self.shards_dir, ignore_errors=True)
+        os.mkdir(self.shards_dir)
+        self.paths = [os.path.join(self.shards_dir, 'customer%d.db' % i) for i in range(3)]
+        for path in self.paths:
+            sqlite3.connect(path).close()
+        # not a database file
+        open(os.path.join(self.shards_dir, 'customer0.db-journal'), 'w').close()
+        self.r = RunnerBase('config_basic.py', 'sqlite3_shards')
+
+    def tearDown(self):
+        shutil.rmtree(self.shards_dir, ignore_errors=True)
+
+    def count(self, path):
+        conn = sqlite3.connect(path)
+        try:
+            return conn.execute("""SELECT COUNT(*) FROM article""").fetchone()[0]
+        finally:
+            conn.close()
+
+    def testSync(self):
+        self.r.run('init_db')
+        out = self.r.run('to_sync')
+        self.assertEqual(15, len(out.splitlines()))
+        self.assertTrue(out.startswith('%s: m20140615132455_init.sql' % self.paths[0]), out)
+        out = self.r.run('sync')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertEqual(['%s: Executed 5 migrations, latest m20140615135414_insert3.py' % path
+                          for path in self.paths], out.splitlines())
+        for path in self.paths:
+            self.assertEqual(4, self.count(path))
+        out = self.r.run('sync')
+        self.assertEqual(['%s: No migrations to sync' % path for path in self.paths], out.splitlines())
+
+    def testAfterSyncIfSchemaChanged(self):
+        done_file = os.path.join(self.shards_dir, 'after_sync.done')
+        self.r.run('init_db', dbnick='sqlite3_shards_after_sync')
+        self.r.run('force_sync_single m20140615132455_init.sql', dbnick='sqlite3_shards_after_sync')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertTrue(os.path.exists(done_file))
+        os.unlink(done_file)
+
+        out = self.r.run('force_sync_single m20140615132613_insert1.sql', dbnick='sqlite3_shards_after_sync')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertIn('Schema not changed', out)
+        self.assertFalse(os.path.exists(done_file))
+
+        self.r.run('sync', dbnick='sqlite3_shards_after_sync')
+        self.assertTrue(os.path.exists(done_file))
+
+    def testFailedFileDoesNotBlockOthers(self):
+        self.r.run('init_db')
+        conn = sqlite3.connect(self.paths[1])
+        conn.execute("""CREATE TABLE article (id INTEGER)""")
+        conn.commit()
+        conn.close()
+        out = self.r.run('sync')
+        self.assertEqual(1, self.r.last_retcode)
+        lines = out.splitlines()
+        self.assertTrue(lines[1].startswith('%s: Error while executing m20140615132455_init.sql '
+                                            'after 0 migrations: OperationalError' % self.paths[1]),
+                        lines[1])
+        self.assertEqual(4, self.count(self.paths[0]))
+        self.assertEqual(4, self.count(self.paths[2]))
+        # resuming after fixing the file
+        conn = sqlite3.connect(self.paths[1])
+        conn.execute("""DROP TABLE article""")
+        conn.commit()
+        conn.close()
+        out = self.r.run('sync')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertEqual(['%s: No migrations to sync' % self.paths[0],
+                          '%s: Executed 5 migrations, latest m20140615135414_insert3.py' % self.paths[1],
+                          '%s: No migrations to sync' % self.paths[2]], out.splitlines())
+
+    def testUninitializedFile(self):
+        self.r.run('init_db')
+        sqlite3.connect(os.path.join(self.shards_dir, 'customer3.db')).close()
+        out = self.r.run('sync')
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertIn('customer3.db: Error while executing None after 0 migrations: '
+                      'OperationalError: no such table: migration', out)
+        self.assertEqual(4, self.count(self.paths[2]))
+
+
+class Sqlite3TestShadowSwap(unittest.TestCase):
+    database = '/tmp/sqlite3test.sql'
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_shadow')
+        self.r.run('init_db')
+
+    def tearDown(self):
+        self.r.close()
+
+    def query(self, sql):
+        conn = sqlite3.connect(self.database)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def testSwap(self):
+        self.r.conn.close()
+        inode = os.stat(self.database).st_ino
+        out = self.r.run('sync --shadow-swap')
+        self.assertEqual(0, self.r.last_retcode)
+        self.assertEqual(['Executing 001_article.sql', 'Executing 002_slow.py',
+                          'Replaced the database with a migrated copy'], out.splitlines())
+        self.assertNotEqual(inode, os.stat(self.database).st_ino)
+        self.assertFalse(os.path.exists(self.database + '.mschematool-shadow'))
+        self.assertEqual([(2,)], self.query("""SELECT COUNT(*) FROM article"""))
+        self.assertEqual(['001_article.sql', '002_slow.py'], self.r.run('synced').splitlines())
+
+    def testModifiedWhileMigrating(self):
+        def modify():
+            conn = sqlite3.connect(self.database)
+            conn.execute("""CREATE TABLE session (id INTEGER)""")
+            conn.commit()
+            conn.close()
+        self.r.conn.close()
+        timer = threading.Timer(0.5, modify)
+        timer.start()
+        out = self.r.run('sync --shadow-swap')
+        timer.join()
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertEqual(['Executing 001_article.sql', 'Executing 002_slow.py'], out.splitlines())
+        self.assertFalse(os.path.exists(self.database + '.mschematool-shadow'))
+        self.assertEqual([], self.query("""SELECT name FROM sqlite_master WHERE name = 'article'"""))
+        self.assertEqual('', self.r.run('synced'))
+
+    def testOpenInOtherProcess(self):
+        # the connection of the test runner stays open
+        out = self.r.run('sync --shadow-swap')
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertEqual('', out)
+        self.assertFalse(os.path.exists(self.database + '.mschematool-shadow'))
+        self.assertEqual('', self.r.run('synced'))
+
+    def testOpenedWhileMigrating(self):
+        self.r.conn.close()
+        opened = []
+        timer = threading.Timer(0.5, lambda: opened.append(sqlite3.connect(self.database, check_same_thread=False)))
+        timer.start()
+        out = self.r.run('sync --shadow-swap')
+        timer.join()
+        opened[0].close()
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertEqual(['Executing 001_article.sql', 'Executing 002_slow.py'], out.splitlines())
+        self.assertFalse(os.path.exists(self.database + '.mschematool-shadow'))
+        self.assertEqual('', self.r.run('synced'))
+
+    def testWalRejected(self):
+        self.query("""PRAGMA journal_mode=WAL""")
+        out = self.r.run('sync --shadow-swap')
+        self.assertEqual(1, self.r.last_retcode)
+        self.assertEqual('', out)
+        self.assertEqual('', self.r.run('synced'))
+
+
+class Sqlite3TestRehearse(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_default')
+        self.r.run('init_db')
+
+    def tearDown(self):
+        self.r.close()
+
+    def testRehearse(self):
+        self.r.run('force_sync_single m20140615132455_init.sql')
+        out = self.r.run('rehearse')
+        self.assertEqual(0, self.r.last_retcode)
+        lines = out.splitlines()
+        self.assertEqual(['m20140615132456_init2.sql', 'm20140615132613_insert1.sql',
+                          'm20140615133009_insert2.sql', 'm20140615135414_insert3.py'],
+                         [line.split()[0] for line in lines if not line.startswith(' ')][:4])
+        self.assertIn('      0.0s  migrate() of m20140615135414_insert3.py', lines)
+        self.assertIn('  lock database write lock held 0.0s', lines)
+        self.assertEqual(['m20140615132455_init.sql'], self.r.run('synced').splitlines())
+        self.assertEqual([], [fn for fn in os.listdir('/tmp') if '.rehearse-' in fn])
+        self.r.run('sync')
+        self.assertEqual('No migrations to sync', self.r.run('rehearse'))
+
+
+class Sqlite3TestLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_logging.py', 'sqlite3_logging')
+
+    def tearDown(self):
+        self.r.close()
+
+    def testLogStatementMaxLength(self):
+        log_file = self.r.config_module.LOG_FILE
+        offset = os.path.getsize(log_file) if os.path.exists(log_file) else 0
+        self.r.run('init_db')
+        with open(log_file) as f:
+            f.seek(offset)
+            logged = [line for line in f if 'Executing SQL' in line]
+        self.assertTrue(logged)
+        for line in logged:
+            statement = line.split('<<', 1)[1].split('>>', 1)[0]
+            self.assertLessEqual(len(statement.split('... [')[0]), 60)
+        self.assertTrue(any('characters]>>' in line for line in logged))
+
+
+class Sqlite3TestAfterSync(unittest.TestCase):
+    done_file = '/tmp/sqlite3test_after_sync.done'
+
+    def setUp(self):
+        self.r = RunnerSqlite3('config_basic.py', 'sqlite3_after_sync')
+        self.tearDown()
+
+    def tearDown(self):
+        self.r.close()
+        try:
+            os.unlink(self.done_file)
+        except OSError:
+            pass
+
+    def testSkipWhenSchemaNotChanged(self):
+        self.r.run('init_db')
+        self.r.run('force_sync_single m20140615132455_init.sql')
+        self.assertTrue(os.path.exists(self.done_file))
+        os.unlink(self.done_file)
+
+        out = self.r.run('force_sync_single m20140615132613_insert1.sql')
+        self.assertIn('Schema not changed', out)
+        self.assertFalse(os.path.exists(self.done_file))
+
+        self.r.run('sync')
+        self.assertTrue(os.path.exists(self.done_file))
+
+    def testTimeout(self):
+        self.r.run('init_db', dbnick='sqlite3_after_sync_timeout')
+        out = self.r.run('sync', dbnick='sqlite3_after_sync_timeout')
+        self.assertEqual(1, self.r.last_retcode)
+
+
 if __name__ == '__main__':
     unittest.main()